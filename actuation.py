@@ -0,0 +1,57 @@
+#!/usr/bin/python3.10
+"""
+Actuation latency histograms and polling rates of remote control confirmations (test_sequences.actuate)
+"""
+import bisect
+
+# Adaptive polling of status register, interval doubles from min to max while condition is not met
+__POLL_INTERVAL_MIN__ = 0.005
+__POLL_INTERVAL_MAX__ = 0.1
+# Histogram bucket upper bounds in ms
+__LATENCY_BUCKETS__ = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class LatencyHistogram:
+    """
+    Latency histogram with fixed ms buckets, min, max and mean
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'total', 'minimum', 'maximum')
+
+    def __init__(self, buckets: tuple = __LATENCY_BUCKETS__):
+        self.buckets = buckets
+        # Last bucket collects values over the highest bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value: float) -> None:
+        """
+        :param value: Latency in ms
+        :return: None
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def statistics(self) -> dict:
+        """
+        :return: Summary and non-empty buckets {'<=bound': count}
+        """
+        labels = ["<=" + str(bound) for bound in self.buckets] + [">" + str(self.buckets[-1])]
+        return {'count': self.count, 'min_ms': round(self.minimum or 0.0, 3), 'max_ms': round(self.maximum or 0.0, 3),
+                'avg_ms': round(self.total / (self.count or 1), 3),
+                'buckets': {label: count for label, count in zip(labels, self.counts) if count}}
+
+    def render(self, width: int = 40) -> list:
+        """
+        :param width: Width of the longest bar
+        :return: Text lines of the histogram
+        """
+        peak = max(self.counts) or 1
+        labels = ["<=" + str(bound) + " ms" for bound in self.buckets] + [">" + str(self.buckets[-1]) + " ms"]
+        return [label.rjust(10) + " " + str(count).rjust(6) + " " + "#" * round(count / peak * width)
+                for label, count in zip(labels, self.counts) if count]
@@ -2,7 +2,43 @@
 """
 Additions module for modbus_protocol.py
 """
-import pymysql
+import csv
+import json
+import math
+import os
+import queue
+import sys
+import tempfile
+import threading
+from datetime import date, datetime
+from report_renderer import load_template, render
+from serialization import write_binary, write_json
+from deadband import DeadbandFilter, __MAX_SILENCE__
+from decoding import BlockDecoder
+from metrics import METRICS
+
+# DB writer settings
+__DB_POOL_SIZE__ = 2
+__DB_BATCH_SIZE__ = 500
+__DB_QUEUE_SIZE__ = 64
+__DB_POOLS__ = {}
+__DB_TIME_FORMAT__ = '%Y-%m-%d %H:%M:%S.%f'
+# Base table columns (test_score is score of the Evaluation section, NULL for results without it)
+__DB_BASE_COLUMNS__ = ['test_id', 'test_timestamp', 'device_id', 'device_status', 'device_motor_status', 'unit_status',
+                       't_on_c_break', 't_off_c_break', 't_reset_c_break', 'test_score']
+# Schema version 2 columns (db/create_table_v2.sql)
+__DB_TEST_COLUMNS__ = ['test_id', 'device', 'test_timestamp', 'device_id', 'device_status', 'device_motor_status',
+                       'unit_status', 't_on_c_break', 't_off_c_break', 't_reset_c_break', 'test_score']
+# Aggregates per value_name (db/add_measurement_statistic.sql), written if statistic_table is configured
+__DB_STATISTIC_COLUMNS__ = ['test_id', 'measurement_type', 'value_name', 'sample_count', 'nan_count', 'min_value',
+                            'max_value', 'mean_value', 'stdev_value', 'p5_value', 'p50_value', 'p95_value',
+                            'low_limit', 'high_limit', 'violations']
+__DB_VALUE_COLUMNS__ = ['device', 'test_id', 'probe_number', 'measurement_type', 'value_name', 'probe_timestamp',
+                        'value']
+# Measurement table columns after measurement_id, test_id, test_timestamp and probe_number
+__DB_MEASUREMENT_COLUMNS__ = ['voltage', 'voltage_unbalance', 'current', 'current_unbalance', 'power',
+                              'reactive_power', 'apparent_power', 'efficiency', 'base_efficiency', 'frequency',
+                              'base_reactive_power', 'distortion', 'global_harm_dist']
 
 
 def create_db_connection(db_config: dict) -> list:
@@ -11,6 +47,8 @@ def create_db_connection(db_config: dict) -> list:
     :param db_config: test config
     :return: [cursor,connection,error]
     """
+    # DB driver is imported only when results are written to DB (output db)
+    import pymysql  # pylint: disable=import-outside-toplevel
     error = ""
     sql_cur = None
     sql_conn = None
@@ -32,6 +70,7 @@ def execute_query(query: str, db_config: dict) -> list:
     :param db_config: db connection config
     :return: [data, err]
     """
+    import pymysql  # pylint: disable=import-outside-toplevel
     data = []
     # Creates connection to DB
     curr, conn, err = create_db_connection(db_config)
@@ -58,16 +97,67 @@ def generate_test_report_json(results: dict, config: dict) -> None:
     :return: None
     """
     try:
-        file = open(config['dump_dir'] + str(results['TestID']) + ".json", 'w', encoding='utf-8')
-        # replaces single ' for double "
-        file.write(str(results).replace("\'", "\""))
-        file.close()
+        # Streams valid JSON, NaN readings are written as null
+        with METRICS.span('report', (('format', 'json'),), test_id=results['TestID']):
+            write_json(results, config['dump_dir'] + str(results['TestID']) + ".json")
     except FileNotFoundError:
         print("Wrong file path!")
         exit(2)
     print("Test data saved: " + config['dump_dir'] + str(results['TestID']) + ".json")
 
 
+def generate_test_report_binary(results: dict, config: dict) -> None:
+    """
+    Creates report in columnar binary format, load with serialization.load_binary
+    :param results: dict of test results
+    :param config: dict of test configuration
+    :return: None
+    """
+    try:
+        with METRICS.span('report', (('format', 'binary'),), test_id=results['TestID']):
+            write_binary(results, config['dump_dir'] + str(results['TestID']) + ".mbr")
+    except FileNotFoundError:
+        print("Wrong file path!")
+        exit(2)
+    print("Test data saved: " + config['dump_dir'] + str(results['TestID']) + ".mbr")
+
+
+def build_report_context(results: dict) -> dict:
+    """
+    Creates template values of the HTML report
+    :param results: dict of test results
+    :return: Template context
+    """
+    measurements = []
+    probes = results['ReadValuesTest']
+    first = probes[next(iter(probes))] if probes else {}
+    for index, measurement_type in enumerate(first):
+        entry = first[measurement_type]
+        measurements.append({
+            'index': chr(ord('a') + index), 'title': entry.get('title', measurement_type),
+            'unit': entry.get('unit', ''), 'value_names': entry['value_name'],
+            'rows': [{'probe': probe, 'values': probes[probe][measurement_type]['reading']} for probe in probes]})
+    evaluation = results.get('Evaluation', {})
+    statistics = []
+    for measurement_type, values in evaluation.get('values', {}).items():
+        entry = first[measurement_type] if measurement_type in first else {}
+        for value_name, aggregates in values.items():
+            # Undefined aggregates (no samples, no limit) are left empty
+            statistics.append(dict({key: "" if value is None else value for key, value in aggregates.items()},
+                                   title=entry.get('title', measurement_type), unit=entry.get('unit', ''),
+                                   value_name=value_name))
+    return {'test_id': results['TestID'], 'test_time': results['TestTime'],
+            't_on': bool(results['ControlTest']['t_on_c_break']['status']),
+            't_off': bool(results['ControlTest']['t_off_c_break']['status']),
+            't_reset': bool(results['ControlTest']['t_reset_c_break']['status']),
+            'dev_status': results['ReadInfoTest']['get_dev_status']['reading'], 'dev_id': 1,
+            'motor_status': results['ReadInfoTest']['get_dev_motor_status']['reading'],
+            'unit_status': results['ReadInfoTest']['get_unit_status']['reading'],
+            'measurements': measurements, 'score': evaluation.get('score', ""),
+            'verdict': evaluation.get('verdict', ""), 'pass_score': evaluation.get('pass_score', ""),
+            'statistics': statistics}
+
+
 def generate_test_report_html(results: dict, config: dict) -> None:
     """
     Creates report in HTML format
@@ -75,79 +165,458 @@ def generate_test_report_html(results: dict, config: dict) -> None:
     :param config: dict of test configuration
     :return: None
     """
-    report, template = None, None
     try:
-        # Opens template file and creates new file object for the report
-        template = open(config['template_dir'] + config['report_template_file'], 'r', encoding='utf-8').read()
+        # Template is compiled once and cached until the file changes
+        template = load_template(config['template_dir'] + config['report_template_file'])
         report = open(config['report_dir'] + str(results['TestID']) + ".html", 'w', encoding='utf-8')
     except FileNotFoundError:
         print("Wrong file path!")
         exit(2)
-    # Replaces dummy values in the template for real values from results dictionary
-    template = template.replace("test_id", str(results['TestID']))
-    template = template.replace("stamp", str(results['TestTime']))
-    template = template.replace("t_on_val", str(bool(results['ControlTest']['t_on_c_break']['status'])))
-    template = template.replace("t_off_val", str(bool(results['ControlTest']['t_off_c_break']['status'])))
-    template = template.replace("t_res_val", str(bool(results['ControlTest']['t_reset_c_break']['status'])))
-
-    template = template.replace("dev_stat_val", str(results['ReadInfoTest']['get_dev_status']['reading']))
-    template = template.replace("dev_id_val", str(1))
-    template = template.replace("mot_stat_val", str(results['ReadInfoTest']['get_dev_motor_status']['reading']))
-    template = template.replace("unit_stat_val", str(results['ReadInfoTest']['get_unit_status']['reading']))
-
-    for test_no in results['ReadValuesTest']:
-        for value in results['ReadValuesTest'][test_no]:
-            for reading in results['ReadValuesTest'][test_no][value]['value_name']:
-                index = list(results['ReadValuesTest'][test_no][value]['value_name']).index(reading)
-                replace_string = (str(int(test_no)) + "_" + str(reading).lower())
-                value_string = str(results['ReadValuesTest'][test_no][value]['reading'][index])
-                if "base_reactive_power" in value:
-                    replace_string = replace_string.replace("q", "r")
-                template = template.replace(replace_string, value_string)
-    report.write(template)
-    report.close()
+    with METRICS.span('report', (('format', 'html'),), test_id=results['TestID']):
+        report.write(render(template, build_report_context(results)))
+        report.close()
     print("-> Generated report saved! See: " + config['report_dir'] + str(results['TestID']) + ".html")
 
 
-def write_test_results_2_db(results: dict, db_config: dict) -> None:
+def connect_mysql(db_config: dict):
+    """
+    Default connect factory of DbConnectionPool
+    :param db_config: db connection config
+    :return: PyMySQL connection
+    """
+    # DB driver is imported only when the pool opens its first MySQL connection
+    import pymysql  # pylint: disable=import-outside-toplevel
+    return pymysql.connect(host=db_config['address'], port=db_config.get('port', 3306), user=db_config['user'],
+                           password=db_config['password'], database=db_config['db_name'], charset='utf8',
+                           autocommit=False, local_infile=db_config.get('bulk_load', False))
+
+
+def driver_error(connection, name: str) -> type:
+    """
+    Looks up DB-API exception class of the driver that opened the connection (PyMySQL, sqlite3)
+    :param connection: DB-API connection
+    :param name: Exception name (IntegrityError, OperationalError)
+    :return: Exception class, connection attribute (DB-API extension) or class of the driver module
+    """
+    error = getattr(connection, name, None) or getattr(
+        sys.modules.get(type(connection).__module__.split('.')[0]), name, None)
+    # Driver without the class never raises it
+    return error if isinstance(error, type) else type(name, (Exception,), {})
+
+
+class DbConnectionPool:
+    """
+    Small pool of reused DB connections
+    """
+
+    def __init__(self, db_config: dict, size: int = __DB_POOL_SIZE__, connect=None):
+        self.db_config = db_config
+        self.connect = connect or (lambda: connect_mysql(db_config))
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.semaphore = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        """
+        Returns idle connection or opens new one, blocks if all connections are in use
+        :return: Connection
+        """
+        self.semaphore.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            try:
+                return self.connect()
+            except Exception:
+                self.semaphore.release()
+                raise
+
+    def release(self, connection, broken: bool = False) -> None:
+        """
+        Returns connection to the pool
+        :param connection: Connection
+        :param broken: Closes connection instead of reusing it
+        :return: None
+        """
+        if broken:
+            connection.close()
+        else:
+            self.idle.put_nowait(connection)
+        self.semaphore.release()
+
+    def close(self) -> None:
+        """
+        Closes idle connections
+        :return: None
+        """
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+def get_db_pool(db_config: dict) -> DbConnectionPool:
+    """
+    Returns shared pool for DB config
+    :param db_config: db connection config
+    :return: Pool
+    """
+    key = (db_config['address'], db_config.get('port', 3306), db_config['user'], db_config['db_name'])
+    if key not in __DB_POOLS__:
+        __DB_POOLS__[key] = DbConnectionPool(db_config, db_config.get('pool_size', __DB_POOL_SIZE__))
+    return __DB_POOLS__[key]
+
+
+def build_test_rows(results: dict) -> tuple:
+    """
+    Creates rows of the base and measurement tables from test results
+    :param results: dict of test results
+    :return: (base_row, measurement_rows)
+    """
+    base_row = (str(results['TestID']), str(results['TestTime']),
+                json.dumps(results['ReadInfoTest']['device_id']['reading']),
+                results['ReadInfoTest']['get_dev_status']['reading'],
+                results['ReadInfoTest']['get_dev_motor_status']['reading'],
+                results['ReadInfoTest']['get_unit_status']['reading'],
+                results['ControlTest']['t_on_c_break']['status'],
+                results['ControlTest']['t_off_c_break']['status'],
+                results['ControlTest']['t_reset_c_break']['status'],
+                results.get('Evaluation', {}).get('score'))
+    measurement_rows = []
+    for entry in results['ReadValuesTest']:
+        probe = results['ReadValuesTest'][entry]
+        measurement_rows.append((str(results['TestID']) + "-" + str(entry), str(results['TestID']),
+                                 str(results['TestTime']), int(entry),
+                                 *[str(probe[value]['reading']) for value in __DB_MEASUREMENT_COLUMNS__]))
+    return base_row, measurement_rows
+
+
+def write_test_results_2_db(results: dict, db_config: dict, pool: DbConnectionPool = None,
+                            placeholder: str = "%s", max_silence: float = __MAX_SILENCE__) -> None:
     """
-    Writes test results into MySQL DB
+    Writes test results into MySQL DB in one transaction, measurement rows are inserted in batches
     :param results: dict of test results
     :param db_config: dict of db config
+    :param pool: Connection pool, default shared pool of db_config
+    :param placeholder: Parameter placeholder of the DB driver (%s for PyMySQL)
+    :param max_silence: Max seconds between stored values with deadband (plan deadband_max_silence)
     :return: None
     """
+    if db_config.get('schema_version', 1) == 2:
+        write_test_results_2_db_v2(results, db_config, pool, placeholder, max_silence)
+        return
+    pool = pool or get_db_pool(db_config)
+    batch_size = db_config.get('batch_size', __DB_BATCH_SIZE__)
+    base_row, measurement_rows = build_test_rows(results)
+    # Table names come from config, values are always passed as parameters
+    base_test_query = "INSERT INTO `" + db_config['base_table'] + "` (" + ", ".join(
+        __DB_BASE_COLUMNS__) + ") VALUES (" + ", ".join([placeholder] * len(base_row)) + ")"
+    measurement_query = "INSERT INTO `" + db_config['measurement_table'] + "` VALUES (" + ", ".join(
+        [placeholder] * (4 + len(__DB_MEASUREMENT_COLUMNS__))) + ")"
+    connection = pool.acquire()
+    integrity_error = driver_error(connection, 'IntegrityError')
+    operational_error = driver_error(connection, 'OperationalError')
+    broken = False
     try:
-        # Query for first table
-        base_test_query = "INSERT INTO " + db_config['base_table'] + " VALUES ('" + str(
-            results['TestID']) + "','" + str(
-            results['TestTime']) + "','" + str(results['ReadInfoTest']['device_id']['reading']).replace("'",
-                                                                                                        "\"") + "'," + str(
-            results['ReadInfoTest']['get_dev_status']['reading']) + "," + str(
-            results['ReadInfoTest']['get_dev_motor_status']['reading']) + "," + str(
-            results['ReadInfoTest']['get_unit_status']['reading']) + "," + str(
-            results['ControlTest']['t_on_c_break']['status']) + "," + str(
-            results['ControlTest']['t_off_c_break']['status']) + "," + str(
-            results['ControlTest']['t_reset_c_break']['status']) + ");"
-        execute_query(base_test_query, db_config)[0]
-        for entry in results['ReadValuesTest']:
-            # Query for measurement table
-            measurement_query = "INSERT INTO " + db_config['measurement_table'] + " VALUES ('" + str(
-                results['TestID']) + "-" + str(entry) + "','" + str(results['TestID']) + "','" + str(
-                results['TestTime']) + "'," + str(entry) + ",'" + str(
-                results['ReadValuesTest'][entry]['voltage']['reading']) + "','" + str(
-                results['ReadValuesTest'][entry]['voltage_unbalance']['reading']) + "','" + str(
-                results['ReadValuesTest'][entry]['current']['reading']) + "','" + str(
-                results['ReadValuesTest'][entry]['current_unbalance']['reading']) + "','" + str(
-                results['ReadValuesTest'][entry]['power']['reading']) + "','" + str(
-                results['ReadValuesTest'][entry]['reactive_power']['reading']) + "','" + str(
-                results['ReadValuesTest'][entry]['apparent_power']['reading']) + "','" + str(
-                results['ReadValuesTest'][entry]['efficiency']['reading']) + "','" + str(
-                results['ReadValuesTest'][entry]['base_efficiency']['reading']) + "','" + str(
-                results['ReadValuesTest'][entry]['frequency']['reading']) + "','" + str(
-                results['ReadValuesTest'][entry]['base_reactive_power']['reading']) + "','" + str(
-                results['ReadValuesTest'][entry]['distortion']['reading']) + "','" + str(
-                results['ReadValuesTest'][entry]['global_harm_dist']['reading']) + "');"
-            execute_query(measurement_query, db_config)[0]
+        with METRICS.span('db_transaction', (('schema', '1'),), test_id=results['TestID']):
+            cursor = connection.cursor()
+            cursor.execute(base_test_query, base_row)
+            # PyMySQL rewrites executemany of INSERT ... VALUES into multi-row inserts
+            for index in range(0, len(measurement_rows), batch_size):
+                cursor.executemany(measurement_query, measurement_rows[index:index + batch_size])
+            connection.commit()
+        METRICS.inc('db_rows', (('schema', '1'),), len(measurement_rows) + 1)
         print("-> Writing to DB successful!")
-    except pymysql.err.IntegrityError:
+    except integrity_error:
+        connection.rollback()
+        METRICS.inc('db_errors', (('error', 'integrity'),))
         print("Writing to DB failed, TestID exists, please run test again!")
+    except operational_error:
+        broken = True
+        METRICS.inc('db_errors', (('error', 'operational'),))
+        print("Writing to DB failed, connection problem!")
+    except Exception:
+        # Transaction state is unknown, connection is closed instead of being reused
+        broken = True
+        METRICS.inc('db_errors', (('error', 'other'),))
+        try:
+            connection.rollback()
+        except Exception:  # pylint: disable=broad-except
+            # Original error is raised, connection is closed anyway
+            pass
+        raise
+    finally:
+        pool.release(connection, broken)
+
+
+def build_measurement_value_rows(results: dict, deadband: bool = False, max_silence: float = __MAX_SILENCE__) -> list:
+    """
+    Creates rows of the normalized measurement_value table (schema version 2)
+    :param results: dict of test results
+    :param deadband: Only values leaving their deadband (or silent for max_silence) get a row, readers hold the
+                     last value of each value_name until its next row
+    :param max_silence: Default max seconds between rows of one value_name, deadband max_silence of entry overrides
+    :return: [(device, test_id, probe_number, measurement_type, value_name, probe_timestamp, value)]
+    """
+    rows = []
+    filters = {}
+    device = str(results.get('Device', {}).get('name', ''))
+    test_time = datetime.strptime(str(results['TestTime']), '%Y-%m-%d %H:%M:%S').strftime(__DB_TIME_FORMAT__)
+    probes = results['ReadValuesTest']
+    for entry in probes:
+        # Probe store keeps capture time of each probe, replayed results use test time
+        probe_time = datetime.fromtimestamp(probes.wall_time(int(entry))).strftime(__DB_TIME_FORMAT__) \
+            if hasattr(probes, 'wall_time') else test_time
+        probe = probes[entry]
+        # Silence is measured in probe capture time, replayed results count one second per probe
+        seconds = probes.wall_time(int(entry)) if hasattr(probes, 'wall_time') else float(entry)
+        for measurement_type in probe:
+            measurement = probe[measurement_type]
+            # Not available values are null in JSON results
+            reading = [math.nan if value is None else value for value in measurement['reading']]
+            values = zip(measurement['value_name'], reading)
+            if deadband:
+                if measurement_type not in filters:
+                    filters[measurement_type] = DeadbandFilter(measurement, max_silence)
+                values = [(measurement['value_name'][index], value) for index, value in
+                          filters[measurement_type].changes(reading, seconds)]
+            for value_name, value in values:
+                rows.append((device, str(results['TestID']), int(entry), measurement_type, value_name, probe_time,
+                             None if value is None or math.isnan(value) else float(value)))
+    return rows
+
+
+def build_statistic_rows(results: dict) -> list:
+    """
+    Creates rows of the measurement_statistic table from Evaluation section
+    :param results: dict of test results
+    :return: Rows in __DB_STATISTIC_COLUMNS__ order
+    """
+    rows = []
+    for measurement_type, values in results.get('Evaluation', {}).get('values', {}).items():
+        for value_name, aggregates in values.items():
+            rows.append((str(results['TestID']), measurement_type, value_name, aggregates['count'], aggregates['nan'],
+                         aggregates['min'], aggregates['max'], aggregates['mean'], aggregates['stdev'],
+                         aggregates.get('p5'), aggregates.get('p50'), aggregates.get('p95'), aggregates['low'],
+                         aggregates['high'], aggregates['violations']))
+    return rows
+
+
+def bulk_load_rows(cursor, table: str, columns: list, rows: list) -> None:
+    """
+    Loads rows through temporary CSV file and LOAD DATA LOCAL INFILE
+    :param cursor: DB cursor
+    :param table: Table name
+    :param columns: Column names
+    :param rows: Rows
+    :return: None
+    """
+    handle, path = tempfile.mkstemp(suffix=".csv")
+    try:
+        with os.fdopen(handle, 'w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file, lineterminator="\n")
+            # \N is NULL for LOAD DATA
+            writer.writerows([["\\N" if value is None else value for value in row] for row in rows])
+        cursor.execute("LOAD DATA LOCAL INFILE %s INTO TABLE `" + table + "` FIELDS TERMINATED BY ',' "
+                       "OPTIONALLY ENCLOSED BY '\"' LINES TERMINATED BY '\\n' (" + ", ".join(columns) + ")", (path,))
+    finally:
+        os.remove(path)
+
+
+def write_test_results_2_db_v2(results: dict, db_config: dict, pool: DbConnectionPool = None,
+                               placeholder: str = "%s", max_silence: float = __MAX_SILENCE__) -> None:
+    """
+    Writes test results into normalized schema (db/create_table_v2.sql) in one transaction
+    :param results: dict of test results
+    :param db_config: dict of db config
+    :param pool: Connection pool, default shared pool of db_config
+    :param placeholder: Parameter placeholder of the DB driver (%s for PyMySQL)
+    :param max_silence: Max seconds between stored values with deadband (plan deadband_max_silence)
+    :return: None
+    """
+    pool = pool or get_db_pool(db_config)
+    batch_size = db_config.get('batch_size', __DB_BATCH_SIZE__)
+    base_row = build_test_rows(results)[0]
+    test_row = (base_row[0], str(results.get('Device', {}).get('name', '')), base_row[1], *base_row[2:])
+    value_rows = build_measurement_value_rows(results, db_config.get('deadband', False), max_silence)
+    statistic_rows = build_statistic_rows(results) if db_config.get('statistic_table') else []
+    statistic_query = "INSERT INTO `" + str(db_config.get('statistic_table')) + "` (" + ", ".join(
+        __DB_STATISTIC_COLUMNS__) + ") VALUES (" + ", ".join([placeholder] * len(__DB_STATISTIC_COLUMNS__)) + ")"
+    test_query = "INSERT INTO `" + db_config.get('test_table', 'device_test') + "` (" + ", ".join(
+        __DB_TEST_COLUMNS__) + ") VALUES (" + ", ".join([placeholder] * len(test_row)) + ")"
+    value_query = "INSERT INTO `" + db_config.get('value_table', 'measurement_value') + "` (" + ", ".join(
+        __DB_VALUE_COLUMNS__) + ") VALUES (" + ", ".join([placeholder] * len(__DB_VALUE_COLUMNS__)) + ")"
+    connection = pool.acquire()
+    integrity_error = driver_error(connection, 'IntegrityError')
+    operational_error = driver_error(connection, 'OperationalError')
+    broken = False
+    try:
+        with METRICS.span('db_transaction', (('schema', '2'),), test_id=results['TestID']):
+            cursor = connection.cursor()
+            cursor.execute(test_query, test_row)
+            if db_config.get('bulk_load', False):
+                bulk_load_rows(cursor, db_config.get('value_table', 'measurement_value'), __DB_VALUE_COLUMNS__,
+                               value_rows)
+            else:
+                for index in range(0, len(value_rows), batch_size):
+                    cursor.executemany(value_query, value_rows[index:index + batch_size])
+            if statistic_rows:
+                cursor.executemany(statistic_query, statistic_rows)
+            connection.commit()
+        METRICS.inc('db_rows', (('schema', '2'),), len(value_rows) + len(statistic_rows) + 1)
+        print("-> Writing to DB successful! (" + str(len(value_rows)) + " values)")
+    except integrity_error:
+        connection.rollback()
+        METRICS.inc('db_errors', (('error', 'integrity'),))
+        print("Writing to DB failed, TestID exists, please run test again!")
+    except operational_error:
+        broken = True
+        METRICS.inc('db_errors', (('error', 'operational'),))
+        print("Writing to DB failed, connection problem!")
+    except Exception:
+        # Transaction state is unknown, connection is closed instead of being reused
+        broken = True
+        METRICS.inc('db_errors', (('error', 'other'),))
+        try:
+            connection.rollback()
+        except Exception:  # pylint: disable=broad-except
+            # Original error is raised, connection is closed anyway
+            pass
+        raise
+    finally:
+        pool.release(connection, broken)
+
+
+def migrate_reading(decoder: BlockDecoder, values: list, legacy: bool = None) -> list:
+    """
+    Interprets stringified reading of schema version 1, tests before config driven decoding stored raw registers
+    :param decoder: Decoder of measurement type
+    :param values: Parsed reading
+    :param legacy: True raw registers, False decoded values, None unknown (test on the cut-over day)
+    :return: Decoded values, None if reading does not fit or raw and decoded interpretation differ
+    """
+    raw = len(values) == decoder.count and all(isinstance(value, int) for value in values)
+    decoded = len(values) == decoder.value_count
+    if legacy is None:
+        if raw and decoded:
+            # Ambiguous unless decoding does not change the values (scale 1, no NaN or sign conversion)
+            return values if decoder.decode(values) == values else None
+        legacy = raw
+    if legacy:
+        return decoder.decode(values) if raw else None
+    return values if decoded else None
+
+
+def migrate_measurements_v1_to_v2(db_config: dict, readings_sequence: dict, scaled_since: str = None,
+                                  pool: DbConnectionPool = None, placeholder: str = "%s") -> int:
+    """
+    Migrates stringified measurement lists of schema version 1 into measurement_value rows,
+    run db/create_table_v2.sql and db/migrate_v1_to_v2.sql first, device comes from device_map like in the script
+    :param db_config: dict of db config (v1 table names, value_table and device_map_table)
+    :param readings_sequence: test_readings_sequence section of the config, maps list positions to value_name
+    :param scaled_since: First test date (YYYY-MM-DD) with decoded readings, older readings are raw registers and
+                         get decoded, default db_config scaled_since; readings of unknown format are refused
+    :param pool: Connection pool, default shared pool of db_config
+    :param placeholder: Parameter placeholder of the DB driver (%s for PyMySQL)
+    :return: Count of migrated values
+    """
+    pool = pool or get_db_pool(db_config)
+    batch_size = db_config.get('batch_size', __DB_BATCH_SIZE__)
+    scaled_since = scaled_since or db_config.get('scaled_since')
+    cutover = date.fromisoformat(str(scaled_since)) if scaled_since else None
+    decoders = {measurement_type: BlockDecoder(entry) for measurement_type, entry in readings_sequence.items()}
+    value_query = "INSERT INTO `" + db_config.get('value_table', 'measurement_value') + "` (" + ", ".join(
+        __DB_VALUE_COLUMNS__) + ") VALUES (" + ", ".join([placeholder] * len(__DB_VALUE_COLUMNS__)) + ")"
+    # Keyset pages keep one connection usable for reads and writes (pool size 1, no unbuffered cursor)
+    page_query = "SELECT m.*, COALESCE(d.device, '') FROM `" + db_config['measurement_table'] + "` m LEFT JOIN `" + \
+        db_config['base_table'] + "` b ON b.test_id = m.test_id LEFT JOIN `" + \
+        db_config.get('device_map_table', 'device_map') + "` d ON d.device_id = b.device_id " + \
+        "WHERE m.measurement_id > " + placeholder + " ORDER BY m.measurement_id LIMIT " + str(int(batch_size))
+    connection = pool.acquire()
+    broken = True
+    migrated, refused, unmapped, last_id = 0, [], set(), ""
+    try:
+        cursor = connection.cursor()
+        while True:
+            cursor.execute(page_query, (last_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            value_rows = []
+            for row in rows:
+                if not row[-1]:
+                    unmapped.add(row[1])
+                test_date = row[2] if isinstance(row[2], date) else date.fromisoformat(str(row[2])[:10])
+                test_date = test_date.date() if isinstance(test_date, datetime) else test_date
+                probe_time = datetime.combine(test_date, datetime.min.time()).strftime(__DB_TIME_FORMAT__)
+                # Day granularity of v1 timestamps, tests on the cut-over day are checked reading by reading
+                legacy = None if cutover is None or test_date == cutover else test_date < cutover
+                for measurement_type, readings in zip(__DB_MEASUREMENT_COLUMNS__, row[4:4 + len(
+                        __DB_MEASUREMENT_COLUMNS__)]):
+                    values = json.loads(str(readings).replace("nan", "NaN")) if readings else []
+                    if not values:
+                        continue
+                    values = migrate_reading(decoders[measurement_type], values, legacy)
+                    if values is None:
+                        refused.append(row[0] + ":" + measurement_type)
+                        continue
+                    for value_name, value in zip(readings_sequence[measurement_type]['value_name'], values):
+                        value_rows.append((row[-1], row[1], row[3], measurement_type, value_name,
+                                           probe_time, None if math.isnan(value) else float(value)))
+            cursor.executemany(value_query, value_rows)
+            connection.commit()
+            migrated += len(value_rows)
+            last_id = rows[-1][0]
+        broken = False
+        print("-> Migrated " + str(migrated) + " values to schema version 2")
+        if unmapped:
+            print("-> " + str(len(unmapped)) + " tests without device_map entry were migrated with empty device")
+        if refused:
+            print("-> Refused " + str(len(refused)) + " readings, raw registers or decoded values can not be told "
+                  "apart (check scaled_since): " + ", ".join(refused[:10]))
+    finally:
+        pool.release(connection, broken)
+    return migrated
+
+
+class BackgroundDbWriter:
+    """
+    Writes test results from bounded queue in background thread, so DB latency does not stall testing
+    """
+
+    def __init__(self, db_config: dict, queue_size: int = __DB_QUEUE_SIZE__, pool: DbConnectionPool = None,
+                 placeholder: str = "%s", max_silence: float = __MAX_SILENCE__):
+        self.db_config = db_config
+        self.pool = pool or get_db_pool(db_config)
+        self.placeholder = placeholder
+        self.max_silence = max_silence
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, results: dict) -> None:
+        """
+        Queues test results, blocks only when the queue is full
+        :param results: dict of test results
+        :return: None
+        """
+        self.queue.put(results)
+
+    def _run(self) -> None:
+        """
+        Writer loop
+        :return: None
+        """
+        while True:
+            results = self.queue.get()
+            if results is None:
+                break
+            try:
+                write_test_results_2_db(results, self.db_config, self.pool, self.placeholder, self.max_silence)
+            except Exception as error:
+                print("Writing to DB failed: " + str(error))
+
+    def close(self) -> None:
+        """
+        Writes queued results and stops the thread
+        :return: None
+        """
+        self.queue.put(None)
+        self.thread.join()
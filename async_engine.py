@@ -0,0 +1,607 @@
+#!/usr/bin/python3.10
+"""
+Asyncio engine for concurrent testing of many circuit breakers
+"""
+import argparse
+import asyncio
+import itertools
+import uuid
+from collections import deque
+from datetime import datetime
+from time import perf_counter_ns
+import yaml
+import modbus_frames as frames
+from modbus_protocol import __TIME_FORMAT__, __DEFAULT_DEVICE_PORT__, __DEFAULT_DEVICE_UNIT_ID__
+from modbus_protocol import load_test_configuration, write_output
+from modbus_transport import __RECONNECT_ATTEMPTS__, __RECONNECT_BACKOFF__, __RECONNECT_BACKOFF_MAX__
+from test_plan import TestPlan, __PLAN_CACHE_DIR__
+import test_sequences as sequences
+from test_sequences import run_async, __WRITE_TIMEOUT__, __PROBE_OFFSET__, __PROBE_COUNT__
+from evaluation import Evaluator, evaluate_results
+from metrics import METRICS, add_metrics_arguments, export_metrics, start_metrics
+
+# Concurrency limits
+__GLOBAL_CONCURRENCY__ = 64
+__DEVICE_CONCURRENCY__ = 1
+# Request timeout
+__REQUEST_TIMEOUT__ = 2
+# Requests in flight on shared gateway connection, serial gateways handle one at a time
+__GATEWAY_DEPTH__ = 1
+# Consecutive timeouts after which requests of a gateway unit fail fast for cooldown seconds
+__UNIT_FAILURES__ = 2
+__UNIT_COOLDOWN__ = 5.0
+
+
+class AsyncGateway:
+    """
+    Shared connection of a Modbus TCP gateway (e.g. TCP-to-serial) serving many unit IDs. Requests are queued per
+    unit and dispatched round robin over units with queued requests, one request per unit in flight, so a slow or
+    offline unit can't starve the others. Timeout of a unit fails only its request, late responses are dropped by
+    transaction ID and the connection stays open. Unit timing out repeatedly is suspended for a cooldown, its
+    requests fail without occupying the gateway until one request after the cooldown is answered.
+    """
+
+    def __init__(self, host: str, port: int = __DEFAULT_DEVICE_PORT__, depth: int = __GATEWAY_DEPTH__,
+                 timeout: float = __REQUEST_TIMEOUT__):
+        self.host = host
+        self.port = port
+        self.depth = max(1, depth)
+        self.timeout = timeout
+        self.reader, self.writer, self.reader_task = None, None, None
+        self.lock = asyncio.Lock()
+        self.users = 0
+        # unit_id -> deque of (pdu, future, timeout)
+        self.queues = {}
+        # Units with queued requests and none in flight, in order of service
+        self.ready = deque()
+        # transaction_id -> (unit_id, future, timeout handle)
+        self.pending = {}
+        self.busy = set()
+        # unit_id -> consecutive timeouts, unit_id -> loop time until which unit is suspended
+        self.failures = {}
+        self.suspended = {}
+        self.transaction_ids = itertools.cycle(range(1, 65536))
+
+    @property
+    def is_open(self) -> bool:
+        """
+        :return: True if connection is open
+        """
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self) -> bool:
+        """
+        Opens shared connection unless it is open, lost connection is reopened by the next request
+        :return: Status of connection
+        """
+        async with self.lock:
+            if self.is_open:
+                return True
+            try:
+                self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                                  self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                return False
+            self.reader_task = asyncio.create_task(self._read_responses())
+            return True
+
+    async def open(self) -> bool:
+        """
+        Registers user of the gateway
+        :return: Status of connection
+        """
+        if not await self.connect():
+            return False
+        self.users += 1
+        return True
+
+    async def release(self) -> None:
+        """
+        Unregisters user, connection is closed after the last one
+        :return: None
+        """
+        self.users -= 1
+        if self.users <= 0:
+            await self.close()
+
+    async def close(self) -> None:
+        """
+        Closes connection and fails queued and pending requests
+        :return: None
+        """
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+        self.fail(ConnectionError("Connection closed"))
+
+    def fail(self, error: Exception) -> None:
+        """
+        Fails queued and pending requests of all units
+        :param error: Exception set to the requests
+        :return: None
+        """
+        futures = [future for _, future, _ in self.pending.values()]
+        futures.extend(future for queue in self.queues.values() for _, future, _ in queue)
+        for _, _, handle in self.pending.values():
+            handle.cancel()
+        self.pending.clear()
+        self.queues.clear()
+        self.ready.clear()
+        self.busy.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _read_responses(self) -> None:
+        """
+        Reads response frames and completes pending requests by transaction ID
+        :return: None
+        """
+        try:
+            while True:
+                header = await self.reader.readexactly(frames.__MBAP_HEADER_SIZE__)
+                transaction_id, _, length = frames.decode_header(header)
+                self.complete(transaction_id, await self.reader.readexactly(length))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if self.writer:
+                self.writer.close()
+            self.fail(ConnectionError("Connection lost"))
+
+    def dispatch(self) -> None:
+        """
+        Sends next request of the units in order of service while the gateway has free slots
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        while self.ready and len(self.pending) < self.depth and self.is_open:
+            unit_id = self.ready.popleft()
+            queue = self.queues[unit_id]
+            pdu, future, timeout = queue.popleft()
+            if future.done():
+                # Caller gave up (cancelled) before the request was sent
+                if queue:
+                    self.ready.append(unit_id)
+                continue
+            transaction_id = next(self.transaction_ids)
+            # Timeout of the unit runs from sending, time queued behind other units is not counted
+            handle = loop.call_later(timeout, self.complete, transaction_id, None)
+            self.pending[transaction_id] = (unit_id, future, handle)
+            self.busy.add(unit_id)
+            self.writer.write(frames.encode_frame(transaction_id, unit_id, pdu))
+
+    def complete(self, transaction_id: int, response: bytes = None) -> None:
+        """
+        Completes request, unit is queued for service again behind the other units
+        :param transaction_id: Transaction ID of the request
+        :param response: Response PDU, None on timeout
+        :return: None
+        """
+        entry = self.pending.pop(transaction_id, None)
+        if entry is None:
+            # Late response of timed out request
+            return
+        unit_id, future, handle = entry
+        handle.cancel()
+        self.busy.discard(unit_id)
+        if response is None:
+            self.failures[unit_id] = self.failures.get(unit_id, 0) + 1
+            if self.failures[unit_id] >= __UNIT_FAILURES__:
+                self.suspend(unit_id)
+        else:
+            self.failures.pop(unit_id, None)
+            self.suspended.pop(unit_id, None)
+        if self.queues.get(unit_id):
+            self.ready.append(unit_id)
+        if not future.done():
+            if response is None:
+                future.set_exception(asyncio.TimeoutError())
+            else:
+                future.set_result(response)
+        self.dispatch()
+
+    def suspend(self, unit_id: int) -> None:
+        """
+        Suspends unit for cooldown, its queued requests fail
+        :param unit_id: Slave unit ID
+        :return: None
+        """
+        self.suspended[unit_id] = asyncio.get_running_loop().time() + __UNIT_COOLDOWN__
+        for _, future, _ in self.queues.pop(unit_id, ()):
+            if not future.done():
+                future.set_exception(ConnectionError("Unit suspended"))
+
+    async def request(self, unit_id: int, pdu: bytes, timeout: float = None) -> bytes:
+        """
+        Queues request of the unit and waits for its response
+        :param unit_id: Slave unit ID
+        :param pdu: Request PDU
+        :param timeout: Response timeout of the unit
+        :return: Response PDU
+        :raise asyncio.TimeoutError: Unit did not answer within timeout
+        :raise ConnectionError: Gateway connection is lost or unit is suspended
+        """
+        if self.suspended.get(unit_id, 0) > asyncio.get_running_loop().time():
+            raise ConnectionError("Unit suspended")
+        if not self.is_open and not await self.connect():
+            raise ConnectionError("Gateway not reachable")
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(unit_id, deque()).append((pdu, future, timeout or self.timeout))
+        if unit_id not in self.busy and unit_id not in self.ready:
+            self.ready.append(unit_id)
+        self.dispatch()
+        return await future
+
+
+def build_gateways(inventory: list) -> dict:
+    """
+    Creates shared gateway connection for every (address, port) serving more than one inventory entry
+    :param inventory: List of inventory entries, optional gateway_depth sets requests in flight of the gateway
+    :return: {(address, port): AsyncGateway}
+    """
+    endpoints = {}
+    for device in inventory:
+        endpoints.setdefault((device['address'], device.get('port', __DEFAULT_DEVICE_PORT__)), []).append(device)
+    return {endpoint: AsyncGateway(*endpoint, max(device.get('gateway_depth', __GATEWAY_DEPTH__)
+                                                  for device in devices))
+            for endpoint, devices in endpoints.items() if len(devices) > 1}
+
+
+class AsyncModbusClient:
+    """
+    Asyncio Modbus TCP client, responses are matched to requests by MBAP transaction ID. Lost connection is reopened
+    with exponential backoff and the request repeated once (same as ModbusTransport). Client of a unit behind
+    a gateway sends its requests over the shared gateway connection.
+    """
+
+    def __init__(self, host: str, port: int = __DEFAULT_DEVICE_PORT__, unit_id: int = __DEFAULT_DEVICE_UNIT_ID__,
+                 device_limit: int = __DEVICE_CONCURRENCY__, global_limit: asyncio.Semaphore = None,
+                 timeout: float = __REQUEST_TIMEOUT__, gateway: AsyncGateway = None,
+                 attempts: int = __RECONNECT_ATTEMPTS__, backoff: float = __RECONNECT_BACKOFF__):
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+        self.timeout = timeout
+        self.attempts = attempts
+        self.backoff = backoff
+        self.connects = 0
+        self.lock = asyncio.Lock()
+        self.device_limit = asyncio.Semaphore(device_limit)
+        # Requests in flight, planned blocks are read concurrently above 1 (same as pipelined ModbusTransport)
+        self.depth = device_limit
+        self.global_limit = global_limit
+        self.gateway = gateway
+        self.reader, self.writer, self.reader_task = None, None, None
+        self.pending = {}
+        self.transaction_ids = itertools.cycle(range(1, 65536))
+        self.device_labels = (('device', host + ":" + str(port) + "/" + str(unit_id)),)
+
+    @property
+    def is_open(self) -> bool:
+        """
+        :return: True if connection is open
+        """
+        if self.gateway:
+            return self.gateway.is_open
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self) -> bool:
+        """
+        Opens TCP connection unless it is open and starts response reader, retries with exponential backoff
+        :return: Status of connection
+        """
+        if self.is_open:
+            return True
+        async with self.lock:
+            if self.is_open:
+                return True
+            delay = self.backoff
+            for attempt in range(self.attempts):
+                try:
+                    self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                                      self.timeout)
+                except (OSError, asyncio.TimeoutError):
+                    if attempt + 1 < self.attempts:
+                        await asyncio.sleep(delay)
+                        delay = min(delay * 2, __RECONNECT_BACKOFF_MAX__)
+                    continue
+                if self.connects:
+                    METRICS.inc('modbus_reconnects', self.device_labels)
+                self.connects += 1
+                self.reader_task = asyncio.create_task(self._read_responses(self.reader, self.writer))
+                return True
+            METRICS.inc('modbus_connect_failures', self.device_labels)
+            return False
+
+    async def open(self) -> bool:
+        """
+        Opens own or registers at gateway connection
+        :return: Status of connection
+        """
+        if self.gateway:
+            return await self.gateway.open()
+        return await self.connect()
+
+    async def close(self) -> None:
+        """
+        Closes connection and fails pending requests
+        :return: None
+        """
+        if self.gateway:
+            await self.gateway.release()
+            return
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed"))
+        self.pending.clear()
+
+    async def _read_responses(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Reads response frames and resolves pending requests by transaction ID, connection closed by the device is
+        closed here too, so the next request reopens it
+        :param reader: Stream of the connection
+        :param writer: Writer of the connection
+        :return: None
+        """
+        try:
+            while True:
+                header = await reader.readexactly(frames.__MBAP_HEADER_SIZE__)
+                transaction_id, _, length = frames.decode_header(header)
+                pdu = await reader.readexactly(length)
+                future = self.pending.pop(transaction_id, None)
+                if future and not future.done():
+                    future.set_result(pdu)
+        except (asyncio.IncompleteReadError, OSError):
+            writer.close()
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection lost"))
+            self.pending.clear()
+
+    async def _request(self, pdu: bytes) -> bytes:
+        """
+        Sends request over own or gateway connection
+        :param pdu: Request PDU
+        :return: Response PDU
+        :raise asyncio.TimeoutError: No response within timeout
+        :raise ConnectionError: Connection is lost
+        """
+        if self.gateway:
+            return await self.gateway.request(self.unit_id, pdu, self.timeout)
+        if not self.is_open:
+            raise ConnectionError("Connection closed")
+        transaction_id = next(self.transaction_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[transaction_id] = future
+        try:
+            self.writer.write(frames.encode_frame(transaction_id, self.unit_id, pdu))
+            await self.writer.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self.pending.pop(transaction_id, None)
+
+    async def execute(self, pdu: bytes):
+        """
+        Sends request and waits for decoded response, connection is reopened and request repeated once if it was lost
+        :param pdu: Request PDU
+        :return: Decoded response, None on error (same as pyModbusTCP)
+        """
+        if self.global_limit:
+            await self.global_limit.acquire()
+        try:
+            async with self.device_limit:
+                for attempt in range(2):
+                    # Gateway reopens its shared connection itself
+                    if not self.gateway and not await self.connect():
+                        return None
+                    if attempt:
+                        METRICS.inc('modbus_retries', self.device_labels)
+                    start_ns = perf_counter_ns()
+                    try:
+                        response = await self._request(pdu)
+                        self.record(pdu, response, start_ns)
+                        return frames.decode_response(response)
+                    except asyncio.TimeoutError:
+                        # Late response is dropped by transaction ID, connection stays open
+                        METRICS.inc('modbus_timeouts', self.device_labels)
+                        return None
+                    except frames.ModbusExceptionResponse:
+                        return None
+                    except ConnectionError:
+                        if self.gateway:
+                            return None
+                return None
+        finally:
+            if self.global_limit:
+                self.global_limit.release()
+
+    def record(self, pdu: bytes, response: bytes, start_ns: int) -> None:
+        """
+        Records request latency, bytes and exception code
+        :param pdu: Request PDU
+        :param response: Response PDU
+        :param start_ns: perf_counter_ns() when request was sent
+        :return: None
+        """
+        if not METRICS.enabled:
+            return
+        function_code, address = frames.describe_request(pdu)
+        labels = self.device_labels + (('function', str(function_code)), ('block', str(address)))
+        METRICS.observe('modbus_request', labels, (perf_counter_ns() - start_ns) / 1e6)
+        METRICS.inc('modbus_bytes_sent', self.device_labels, frames.__MBAP_HEADER_SIZE__ + len(pdu))
+        METRICS.inc('modbus_bytes_received', self.device_labels, frames.__MBAP_HEADER_SIZE__ + len(response))
+        if response[0] & 0x80:
+            METRICS.inc('modbus_exceptions', labels + (('code', str(response[1])),))
+
+    async def read_holding_registers(self, address: int, count: int = 1) -> list:
+        """
+        FC3 read
+        :param address: Start register
+        :param count: Count of registers
+        :return: Registers or None
+        """
+        return await self.execute(frames.read_holding_registers_pdu(address, count))
+
+    async def write_single_register(self, address: int, value: int) -> bool:
+        """
+        FC6 write
+        :param address: Register address
+        :param value: Register value
+        :return: Status of write or None
+        """
+        return await self.execute(frames.write_single_register_pdu(address, value))
+
+    async def write_multiple_registers(self, address: int, values: list) -> bool:
+        """
+        FC16 write
+        :param address: Start register
+        :param values: Register values
+        :return: Status of write or None
+        """
+        return await self.execute(frames.write_multiple_registers_pdu(address, values))
+
+    async def read_blocks(self, blocks: list) -> list:
+        """
+        Concurrent FC3 reads, limited by device_limit
+        :param blocks: (address, count) pairs
+        :return: Registers or None per block
+        """
+        return list(await asyncio.gather(*(self.read_holding_registers(address, count) for address, count in blocks)))
+
+    async def read_device_identification(self) -> list:
+        """
+        FC43/14 basic device identification
+        :return: [vendor, product code, revision] or None
+        """
+        information = await self.execute(frames.read_device_information_pdu())
+        if information is None:
+            return None
+        return [value.decode('ascii', 'replace') for _, value in sorted(information.items())]
+
+
+async def test_device(device: dict, plan: TestPlan, global_limit: asyncio.Semaphore,
+                      device_limit: int = __DEVICE_CONCURRENCY__, gateways: dict = None) -> dict:
+    """
+    Runs all tests on one device, test sequences are shared with modbus_protocol.py
+    :param device: Inventory entry {name, address, port, unit_id, device_limit, single_writes, timeout,
+                   probe_count, probe_offset}
+    :param plan: Compiled test plan
+    :param global_limit: Semaphore shared by all devices
+    :param device_limit: Default count of concurrent requests per device
+    :param gateways: {(address, port): AsyncGateway} shared by units behind one gateway
+    :return: Test results in the same shape as modbus_protocol.main()
+    """
+    results = {"TestID": str(uuid.uuid4()).rsplit('-', maxsplit=1)[-1],
+               "TestTime": datetime.now().strftime(__TIME_FORMAT__),
+               "Device": {"name": device.get('name', device['address']), "address": device['address'],
+                          "port": device.get('port', __DEFAULT_DEVICE_PORT__),
+                          "unit_id": device.get('unit_id', __DEFAULT_DEVICE_UNIT_ID__)}}
+    client = AsyncModbusClient(device['address'], results['Device']['port'], results['Device']['unit_id'],
+                               device.get('device_limit', device_limit), global_limit,
+                               device.get('timeout', __REQUEST_TIMEOUT__),
+                               (gateways or {}).get((device['address'], results['Device']['port'])))
+    if not await client.open():
+        print("-> " + results['Device']['name'] + ": Connection problem, check device address!")
+        results.update({"Error": "ConnectionError"})
+        return results
+    # Test phases are timed per device, spans are traced on one track per device
+    span = {'test_id': results['TestID'], 'track': client.device_labels[0][1]}
+    # Device quirk replans write batches only
+    plan = plan.with_single_writes(device.get('single_writes', plan.single_writes))
+    evaluator = Evaluator(plan.readings_sequence())
+    try:
+        with METRICS.span('test_phase', client.device_labels + (('phase', 'control'),), **span):
+            results.update({"ControlTest": await run_async(sequences.remote_control_test(plan), client)})
+        await asyncio.sleep(__WRITE_TIMEOUT__)
+        with METRICS.span('test_phase', client.device_labels + (('phase', 'info'),), **span):
+            results.update({"ReadInfoTest": await run_async(sequences.device_information_read_test(plan), client)})
+        await asyncio.sleep(__WRITE_TIMEOUT__)
+        with METRICS.span('test_phase', client.device_labels + (('phase', 'measurement'),), **span):
+            results.update({"ReadValuesTest": await run_async(sequences.device_measurement_read_test(
+                plan, device.get('probe_count', __PROBE_COUNT__), device.get('probe_offset', __PROBE_OFFSET__),
+                None, evaluator), client)})
+    finally:
+        await client.close()
+    results.update({"Evaluation": evaluate_results(results, evaluator, plan.pass_score)})
+    print("-> " + results['Device']['name'] + ": Done! TestID: " + results['TestID'] + ", score: " +
+          str(results['Evaluation']['score']) + " " + results['Evaluation']['verdict'])
+    return results
+
+
+async def run_fleet(inventory: list, plan: TestPlan, global_limit: int = __GLOBAL_CONCURRENCY__,
+                    device_limit: int = __DEVICE_CONCURRENCY__) -> list:
+    """
+    Tests all devices of the inventory concurrently, units behind one gateway share its connection
+    :param inventory: List of inventory entries
+    :param plan: Compiled test plan
+    :param global_limit: Max count of concurrent requests across all devices
+    :param device_limit: Default max count of concurrent requests per device
+    :return: List of per-device results
+    """
+    limit = asyncio.Semaphore(global_limit)
+    gateways = build_gateways(inventory)
+    return await asyncio.gather(*(test_device(device, plan, limit, device_limit, gateways)
+                                  for device in inventory))
+
+
+def load_inventory(file: str) -> list:
+    """
+    Loads device inventory
+    :param file: Path to inventory file
+    :return: List of devices
+    """
+    try:
+        return yaml.safe_load(open(file, 'r', encoding="utf-8"))['devices']
+    except FileNotFoundError:
+        print("Inventory file not found. Check inventory file.")
+        exit(2)
+
+
+def main() -> None:
+    """
+    Runs tests across device inventory and writes per-device outputs
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Schneider circuit breaker fleet Tester')
+    parser.add_argument('--inventory', dest='inventory', type=str,
+                        help="Path to inventory file, default: config/inventory.yaml",
+                        default="config/inventory.yaml", required=False)
+    parser.add_argument('--config', dest='config', type=str,
+                        help="Path to configuration file, default: config/config.yaml",
+                        default="config/config.yaml", required=False)
+    parser.add_argument('--global_limit', dest='global_limit', type=int,
+                        help="Max concurrent requests across all devices, default: 64",
+                        default=__GLOBAL_CONCURRENCY__, required=False)
+    parser.add_argument('--device_limit', dest='device_limit', type=int,
+                        help="Max concurrent requests per device, default: 1",
+                        default=__DEVICE_CONCURRENCY__, required=False)
+    parser.add_argument('--output', dest='output', type=str, help="json, binary, pdf, dump, db", default="dump",
+                        required=False)
+    parser.add_argument('--plan_cache', dest='plan_cache', type=str,
+                        help="Compiled test plan cache directory, empty disables cache, default: " +
+                             __PLAN_CACHE_DIR__, default=__PLAN_CACHE_DIR__, required=False)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    start_metrics(args)
+
+    # Configuration is validated and compiled before any device is contacted
+    plan = load_test_configuration(args.config, None, args.plan_cache)
+    inventory = load_inventory(args.inventory)
+    print("-> Testing " + str(len(inventory)) + " device(s)")
+    fleet_results = asyncio.run(run_fleet(inventory, plan, args.global_limit, args.device_limit))
+
+    for results in fleet_results:
+        if "Error" not in results:
+            write_output(results, args.output, plan.output_config())
+    export_metrics(args)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Exiting on Interupt!")
@@ -0,0 +1,124 @@
+#!/usr/bin/python3.10
+"""
+Benchmark of DB writes, per-row connections (old write path) against pooled batched writer.
+Runs against SQLite stand-in by default or against MariaDB from the test config (--target mariadb).
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import uuid
+from time import perf_counter
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# pylint: disable=wrong-import-position
+from addons import DbConnectionPool, __DB_BASE_COLUMNS__, __DB_MEASUREMENT_COLUMNS__
+from addons import build_test_rows, execute_query, write_test_results_2_db
+
+
+def build_results(config: dict, probe_count: int) -> dict:
+    """
+    Creates synthetic test results
+    :param config: Test configuration
+    :param probe_count: Count of probes
+    :return: dict of test results
+    """
+    readings = {}
+    for probe in range(probe_count):
+        readings[str(probe)] = {key: dict(entry, reading=[probe + offset for offset in range(len(entry['value_name']))])
+                                for key, entry in config['test_readings_sequence'].items()}
+    return {"TestID": uuid.uuid4().hex[-12:], "TestTime": "2022-04-22 10:00:00",
+            "ControlTest": {key: dict(entry, status=1) for key, entry in config['remote_control_sequence'].items()},
+            "ReadInfoTest": dict({key: dict(entry, reading=entry['pass_msg'])
+                                  for key, entry in config['device_info'].items()},
+                                 device_id=dict(config['device_id'], reading=["Schneider Electric", "LV434011"])),
+            "ReadValuesTest": readings}
+
+
+def create_sqlite_tables(path: str, db_config: dict) -> None:
+    """
+    Creates SQLite equivalents of db/create_table.sql
+    :param path: Path to SQLite file
+    :param db_config: dict of db config
+    :return: None
+    """
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE `" + db_config['base_table'] + "` (test_id TEXT PRIMARY KEY, test_timestamp TEXT,"
+                       " device_id TEXT, device_status INT, device_motor_status INT, unit_status INT,"
+                       " t_on_c_break INT, t_off_c_break INT, t_reset_c_break INT, test_score TEXT)")
+    connection.execute("CREATE TABLE `" + db_config['measurement_table'] + "` (measurement_id TEXT PRIMARY KEY,"
+                       " test_id TEXT, test_timestamp TEXT, probe_number INT, " +
+                       ", ".join(column + " TEXT" for column in __DB_MEASUREMENT_COLUMNS__) + ")")
+    connection.commit()
+    connection.close()
+
+
+def legacy_write(results: dict, db_config: dict, connect) -> None:
+    """
+    Old write path, one connection and commit per concatenated INSERT
+    :param results: dict of test results
+    :param db_config: dict of db config
+    :param connect: Connection factory, None uses execute_query
+    :return: None
+    """
+    base_row, measurement_rows = build_test_rows(results)
+    queries = ["INSERT INTO " + db_config['base_table'] + " (" + ", ".join(__DB_BASE_COLUMNS__) + ") VALUES (" +
+               ",".join("'" + str(value).replace("'", "\"") + "'" for value in base_row) + ");"]
+    for row in measurement_rows:
+        queries.append("INSERT INTO " + db_config['measurement_table'] + " VALUES (" +
+                       ",".join("'" + str(value) + "'" for value in row) + ");")
+    for query in queries:
+        if connect is None:
+            execute_query(query, db_config)
+            continue
+        connection = connect()
+        connection.cursor().execute(query)
+        connection.commit()
+        connection.close()
+
+
+def main() -> None:
+    """
+    Runs benchmark and prints rows per second
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='DB writer benchmark')
+    parser.add_argument('--config', dest='config', type=str, default="config/config.yaml", required=False)
+    parser.add_argument('--target', dest='target', type=str, help="sqlite, mariadb", default="sqlite",
+                        required=False)
+    parser.add_argument('--probes', dest='probes', type=int, default=1000, required=False)
+    parser.add_argument('--tests', dest='tests', type=int, default=5, required=False)
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config, 'r', encoding="utf-8"))
+    db_config = config['config']['db']
+
+    if args.target == "sqlite":
+        path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+        create_sqlite_tables(path, db_config)
+        connect = lambda: sqlite3.connect(path, check_same_thread=False)
+        pool, placeholder = DbConnectionPool(db_config, 1, connect), "?"
+    else:
+        connect, pool, placeholder = None, None, "%s"
+
+    rows = args.tests * (args.probes + 1)
+    legacy_tests = [build_results(config, args.probes) for _ in range(args.tests)]
+    batched_tests = [build_results(config, args.probes) for _ in range(args.tests)]
+    start = perf_counter()
+    for results in legacy_tests:
+        legacy_write(results, db_config, connect)
+    legacy = rows / (perf_counter() - start)
+
+    start = perf_counter()
+    for results in batched_tests:
+        write_test_results_2_db(results, db_config, pool, placeholder)
+    batched = rows / (perf_counter() - start)
+
+    print("-> " + args.target + ", " + str(rows) + " rows: per-row connections " + str(round(legacy)) +
+          " rows/s, pooled batched writer " + str(round(batched)) + " rows/s (" + str(round(batched / legacy, 1)) +
+          "x)")
+
+
+if __name__ == '__main__':
+    main()
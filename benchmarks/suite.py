@@ -0,0 +1,345 @@
+#!/usr/bin/python3.10
+"""
+Benchmark suite of test run phases against local simulated device fleet (simulator.py).
+Protocol: connect, read_holding_registers, measurement loop by probe count, fleet run by device count, units behind
+one gateway.
+Outputs: HTML, JSON, binary reports and DB writes (SQLite stand-in) by probe and device count.
+Results are written as JSON, --compare prints ratios against previous results and flags regressions.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from statistics import median
+from time import perf_counter
+import yaml
+
+__ROOT__ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, __ROOT__)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# pylint: disable=wrong-import-position
+import modbus_protocol
+import test_sequences
+import async_engine
+import sharding
+from addons import DbConnectionPool, generate_test_report_binary, generate_test_report_html
+from addons import generate_test_report_json, write_test_results_2_db
+from modbus_transport import ModbusTransport
+from probe_store import ProbeStore
+from evaluation import Evaluator, evaluate_results
+from test_plan import compile_plan
+from db_writer import build_results, create_sqlite_tables
+
+__SIMULATOR_PORT__ = 5600
+__REPEAT__ = 200
+# Units behind simulated gateway (Modbus unit IDs 1-247) and their response timeout in seconds
+__GATEWAY_UNITS__ = 64
+__GATEWAY_UNIT_TIMEOUT__ = 0.5
+# Ratio over which --compare reports regression
+__REGRESSION_THRESHOLD__ = 1.2
+
+
+def timing(samples: list) -> dict:
+    """
+    :param samples: Durations in seconds
+    :return: Summary in ms
+    """
+    ordered = sorted(samples)
+    return {'value': round(median(ordered) * 1000, 4), 'unit': 'ms', 'min': round(ordered[0] * 1000, 4),
+            'p95': round(ordered[int(len(ordered) * 0.95) - 1 if len(ordered) > 1 else 0] * 1000, 4),
+            'samples': len(ordered)}
+
+
+def measure(function, repeat: int) -> dict:
+    """
+    Calls function repeat times
+    :param function: Callable without arguments
+    :param repeat: Count of calls
+    :return: Timing summary in ms
+    """
+    samples = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        samples.append(perf_counter() - start)
+    return timing(samples)
+
+
+def start_simulator(config_path: str, port: int, count: int, options: tuple = ()) -> subprocess.Popen:
+    """
+    Starts simulated fleet in separate process and waits until last device accepts connections
+    :param config_path: Test configuration
+    :param port: First port
+    :param count: Count of devices
+    :param options: Extra simulator arguments
+    :return: Simulator process
+    """
+    process = subprocess.Popen([sys.executable, os.path.join(__ROOT__, 'simulator.py'), '--config', config_path,
+                                '--port', str(port), '--count', str(count), *options], stdout=subprocess.DEVNULL)
+    probe = ModbusTransport('127.0.0.1', port + count - 1, attempts=50, backoff=0.1)
+    if not probe.open():
+        process.kill()
+        raise ConnectionError("Simulator did not start")
+    probe.close()
+    return process
+
+
+def synthetic_block_readings(plan, probe_count: int) -> list:
+    """
+    :param plan: Compiled test plan
+    :param probe_count: Count of probes
+    :return: Raw registers per planned block of every probe
+    """
+    return [[[(probe + offset) & 0x7FFF for offset in range(block.count)] for block in plan.read_plan]
+            for probe in range(probe_count)]
+
+
+def synthetic_results(config: dict, probe_count: int) -> dict:
+    """
+    Creates results with columnar probe store and evaluation as produced by device_measurement_read_test
+    :param config: Test configuration
+    :param probe_count: Count of probes
+    :return: dict of test results
+    """
+    results = build_results(config, 0)
+    plan = compile_plan(config)
+    store = ProbeStore(plan.readings_sequence(), plan.read_plan, probe_count)
+    evaluator = Evaluator(plan.readings_sequence())
+    for probe, block_readings in enumerate(synthetic_block_readings(plan, probe_count)):
+        store.store(probe, block_readings)
+        evaluator.add_probe(plan.read_plan, block_readings)
+    results['ReadValuesTest'] = store
+    results['Evaluation'] = evaluate_results(results, evaluator, plan.pass_score)
+    return results
+
+
+def protocol_benchmarks(config: dict, config_path: str, args) -> dict:
+    """
+    :param config: Test configuration
+    :param config_path: Path of test configuration (simulator)
+    :param args: Command line arguments
+    :return: {name: measurement}
+    """
+    measurements = {}
+    simulator = start_simulator(config_path, args.port, max(args.devices))
+    try:
+        def connect():
+            transport = ModbusTransport('127.0.0.1', args.port)
+            transport.open()
+            transport.close()
+        measurements['protocol.connect'] = measure(connect, args.repeat)
+        transport = ModbusTransport('127.0.0.1', args.port)
+        transport.open()
+        for count in (1, 32, 125):
+            measurements['protocol.read_holding_registers[count=' + str(count) + ']'] = measure(
+                lambda count=count: transport.read_holding_registers(1000, count), args.repeat)
+        transport.close()
+
+        # Measurement loop without configured pacing (probe offset, read timeout)
+        plan = compile_plan(config)
+        modbus_protocol.__PROBE_OFFSET__, test_sequences.__READ_TIMEOUT__ = 0, 0
+        for depth in (1, 4):
+            transport = ModbusTransport('127.0.0.1', args.port, depth=depth)
+            transport.open()
+            for probes in args.probes:
+                modbus_protocol.__PROBE_COUNT__ = probes
+                start = perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    modbus_protocol.device_measurement_read_test(transport, plan)
+                elapsed = perf_counter() - start
+                measurements['protocol.measurement_loop[depth=' + str(depth) + ',probes=' + str(probes) + ']'] = {
+                    'value': round(probes / elapsed, 2), 'unit': 'probes/s'}
+            transport.close()
+
+        for devices in args.devices:
+            inventory = [{'name': 'sim_' + str(index), 'address': '127.0.0.1', 'port': args.port + index,
+                          'probe_count': min(args.probes), 'probe_offset': 0} for index in range(devices)]
+            start = perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                fleet_results = asyncio.run(async_engine.run_fleet(inventory, plan))
+            elapsed = perf_counter() - start
+            measurements['protocol.fleet[devices=' + str(devices) + ']'] = {
+                'value': round(elapsed * 1000, 2), 'unit': 'ms',
+                'devices_per_s': round(devices / elapsed, 2),
+                'errors': sum(1 for results in fleet_results if 'Error' in results)}
+
+        # Largest fleet sharded across poll worker processes
+        inventory = [{'name': 'sim_' + str(index), 'address': '127.0.0.1', 'port': args.port + index,
+                      'probe_count': min(args.probes), 'probe_offset': 0} for index in range(max(args.devices))]
+        for workers in args.workers:
+            fleet_results = []
+            start = perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                sharding.run_sharded_fleet(inventory, plan, workers, fleet_results.append)
+            elapsed = perf_counter() - start
+            measurements['protocol.sharded_fleet[devices=' + str(len(inventory)) + ',workers=' + str(workers) +
+                         ']'] = {'value': round(len(inventory) / elapsed, 2), 'unit': 'devices/s',
+                                 'errors': sum(1 for results in fleet_results if 'Error' in results)}
+    finally:
+        simulator.kill()
+        simulator.wait()
+
+    # Units behind one simulated TCP-to-serial gateway sharing its connection, offline unit must not stall others
+    units = min(max(args.devices), __GATEWAY_UNITS__)
+    simulator = start_simulator(config_path, args.port + max(args.devices), 1,
+                                ('--gateway', '--offline_units', str(units + 1)))
+    try:
+        inventory = [{'name': 'unit_' + str(unit), 'address': '127.0.0.1', 'port': args.port + max(args.devices),
+                      'unit_id': unit, 'probe_count': min(args.probes), 'probe_offset': 0,
+                      'timeout': __GATEWAY_UNIT_TIMEOUT__} for unit in range(1, units + 2)]
+        start = perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fleet_results = asyncio.run(async_engine.run_fleet(inventory, plan))
+        elapsed = perf_counter() - start
+        measurements['protocol.gateway_fleet[units=' + str(units) + ',offline=1]'] = {
+            'value': round(units / elapsed, 2), 'unit': 'units/s',
+            'passed': sum(1 for results in fleet_results
+                          if results.get('Evaluation', {}).get('verdict') == "Pass")}
+    finally:
+        simulator.kill()
+        simulator.wait()
+    return measurements
+
+
+def output_benchmarks(config: dict, args) -> dict:
+    """
+    :param config: Test configuration
+    :param args: Command line arguments
+    :return: {name: measurement}
+    """
+    measurements = {}
+    directory = tempfile.mkdtemp()
+    output_config = dict(config['config'], dump_dir=directory + os.sep, report_dir=directory + os.sep,
+                         template_dir=os.path.join(__ROOT__, config['config']['template_dir']))
+    db_config = config['config']['db']
+    path = os.path.join(directory, "benchmark.db")
+    create_sqlite_tables(path, db_config)
+    pool = DbConnectionPool(db_config, 1, lambda: sqlite3.connect(path, check_same_thread=False))
+    outputs = {'html': lambda results: generate_test_report_html(results, output_config),
+               'json': lambda results: generate_test_report_json(results, output_config),
+               'binary': lambda results: generate_test_report_binary(results, output_config),
+               'db': lambda results: write_test_results_2_db(results, db_config, pool, "?")}
+    plan = compile_plan(config)
+    for probes in args.probes:
+        # Streaming statistics and limit checks of raw block reads
+        block_readings = synthetic_block_readings(plan, probes)
+        evaluator = Evaluator(plan.readings_sequence())
+        start = perf_counter()
+        for readings in block_readings:
+            evaluator.add_probe(plan.read_plan, readings)
+        evaluate_results({}, evaluator, plan.pass_score)
+        measurements['output.evaluation[probes=' + str(probes) + ']'] = {
+            'value': round(probes / (perf_counter() - start), 2), 'unit': 'probes/s'}
+        for devices in args.devices:
+            fleet = [synthetic_results(config, probes) for _ in range(devices)]
+            for name, output in outputs.items():
+                start = perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for results in fleet:
+                        output(results)
+                measurements['output.' + name + '[probes=' + str(probes) + ',devices=' + str(devices) + ']'] = {
+                    'value': round((perf_counter() - start) * 1000, 3), 'unit': 'ms'}
+    pool.close()
+    return measurements
+
+
+def compare(current: dict, previous: dict, threshold: float = __REGRESSION_THRESHOLD__) -> int:
+    """
+    Prints ratio current/previous per measurement, throughput units are inverted so ratio > 1 is always slower
+    :param current: Current measurements
+    :param previous: Previous measurements
+    :param threshold: Ratio reported as regression
+    :return: Count of regressions
+    """
+    regressions = 0
+    for name, measurement in current.items():
+        old = previous.get(name)
+        if not old or not old['value'] or not measurement['value']:
+            continue
+        ratio = measurement['value'] / old['value']
+        if measurement['unit'].endswith('/s'):
+            ratio = 1 / ratio
+        flag = "REGRESSION" if ratio > threshold else ""
+        regressions += 1 if flag else 0
+        print("   " + name.ljust(64) + " " + str(old['value']).rjust(12) + " -> " +
+              str(measurement['value']).rjust(12) + " " + measurement['unit'].ljust(9) + " x" + str(round(ratio, 2)) +
+              " " + flag)
+    return regressions
+
+
+def git_revision() -> str:
+    """
+    :return: Current commit or None
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=__ROOT__, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    """
+    Runs benchmark suite and writes results file
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark suite')
+    parser.add_argument('--config', dest='config', type=str, default=os.path.join(__ROOT__, "config/config.yaml"),
+                        required=False)
+    parser.add_argument('--phases', dest='phases', type=str, help="protocol, output, all", default="all",
+                        required=False)
+    parser.add_argument('--probes', dest='probes', type=int, nargs='+', default=[10, 100, 1000], required=False)
+    parser.add_argument('--devices', dest='devices', type=int, nargs='+', default=[1, 10, 50], required=False)
+    parser.add_argument('--workers', dest='workers', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}),
+                        required=False)
+    parser.add_argument('--repeat', dest='repeat', type=int, default=__REPEAT__, required=False)
+    parser.add_argument('--port', dest='port', type=int, default=__SIMULATOR_PORT__, required=False)
+    parser.add_argument('--output', dest='output', type=str, help="Results file, default: bench_<time>.json",
+                        default=None, required=False)
+    parser.add_argument('--compare', dest='compare', type=str, help="Previous results file", default=None,
+                        required=False)
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config, 'r', encoding="utf-8"))
+    # Simulator answers immediately, fixed sleeps of the test sequence are not benchmarked
+    config['config']['actuation_settle'] = 0
+
+    measurements = {}
+    if args.phases in ("protocol", "all"):
+        print("-> Protocol benchmarks")
+        measurements.update(protocol_benchmarks(config, args.config, args))
+    if args.phases in ("output", "all"):
+        print("-> Output benchmarks")
+        measurements.update(output_benchmarks(config, args))
+    for name, measurement in measurements.items():
+        print("   " + name.ljust(64) + " " + str(measurement['value']).rjust(12) + " " + measurement['unit'])
+
+    report = {'meta': {'time': datetime.now().isoformat(timespec='seconds'), 'revision': git_revision(),
+                       'python': platform.python_version(), 'platform': platform.platform(),
+                       'probes': args.probes, 'devices': args.devices, 'workers': args.workers, 'repeat': args.repeat,
+                       'cpus': os.cpu_count()},
+              'measurements': measurements}
+    output = args.output or "bench_" + datetime.now().strftime('%Y%m%d_%H%M%S') + ".json"
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    print("-> Results saved: " + output)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            previous = json.load(file)
+        print("-> Compared with " + args.compare + " (" + str(previous['meta'].get('revision')) + "):")
+        if compare(measurements, previous['measurements']):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Exiting on Interupt!")
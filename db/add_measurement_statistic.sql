@@ -0,0 +1,24 @@
+-- Aggregates of every value_name per test (schema version 2), run after db/create_table_v2.sql.
+-- Written by addons.write_test_results_2_db_v2() when statistic_table is set in config.
+CREATE TABLE `measurement_statistic` (
+    `test_id` VARCHAR(100) NOT NULL,
+    `measurement_type` VARCHAR(32) NOT NULL,
+    `value_name` VARCHAR(32) NOT NULL,
+    `sample_count` INT NOT NULL,
+    -- Samples reported as not available
+    `nan_count` INT NOT NULL,
+    -- NULL when value has no samples
+    `min_value` DOUBLE,
+    `max_value` DOUBLE,
+    `mean_value` DOUBLE,
+    `stdev_value` DOUBLE,
+    -- Streaming (P-square) percentile estimates
+    `p5_value` DOUBLE,
+    `p50_value` DOUBLE,
+    `p95_value` DOUBLE,
+    -- NULL when value is not limited
+    `low_limit` DOUBLE,
+    `high_limit` DOUBLE,
+    `violations` INT NOT NULL,
+    PRIMARY KEY (`test_id`, `measurement_type`, `value_name`)
+    );
@@ -0,0 +1,53 @@
+-- Schema version 2: typed test table and one row per (device, test, probe, value_name) measurement
+CREATE TABLE `device_test` (
+    `test_id` VARCHAR(100) NOT NULL,
+    `device` VARCHAR(100) NOT NULL,
+    `test_timestamp` DATETIME(6) NOT NULL,
+    `device_id` VARCHAR(100),
+    `device_status` SMALLINT,
+    `device_motor_status` SMALLINT,
+    `unit_status` SMALLINT,
+    `t_on_c_break` TINYINT,
+    `t_off_c_break` TINYINT,
+    `t_reset_c_break` TINYINT,
+    `test_score` DOUBLE,
+    PRIMARY KEY (`test_id`),
+    KEY `device_test_time` (`device`, `test_timestamp`) USING BTREE
+    );
+CREATE TABLE `measurement_value` (
+    `device` VARCHAR(100) NOT NULL,
+    `test_id` VARCHAR(100) NOT NULL,
+    `probe_number` INT NOT NULL,
+    `measurement_type` VARCHAR(32) NOT NULL,
+    `value_name` VARCHAR(32) NOT NULL,
+    `probe_timestamp` DATETIME(6) NOT NULL,
+    -- NULL when device reports value as not available
+    `value` DOUBLE,
+    -- Partition column has to be part of the primary key (see partition_by_day.sql),
+    -- value_name is unique within its measurement_type only
+    PRIMARY KEY (`device`, `test_id`, `probe_number`, `measurement_type`, `value_name`, `probe_timestamp`),
+    KEY `device_value_time` (`device`, `value_name`, `probe_timestamp`) USING BTREE
+    );
+-- Device of schema version 1 tests (db/migrate_v1_to_v2.sql), device_id is the stored JSON identity list,
+-- device is the name used by new rows (fleet device name or device address)
+CREATE TABLE `device_map` (
+    `device_id` VARCHAR(100) NOT NULL,
+    `device` VARCHAR(100) NOT NULL,
+    PRIMARY KEY (`device_id`)
+    );
+CREATE TABLE `schema_version` (
+    `version` INT NOT NULL,
+    `applied` DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+    PRIMARY KEY (`version`)
+    );
+INSERT INTO `schema_version` (`version`) VALUES (2);
+
+-- Example trend query, served from device_value_time index:
+-- SELECT DATE(probe_timestamp) AS day, MIN(value), AVG(value), MAX(value) FROM measurement_value
+--     WHERE device = '192.168.5.219' AND value_name = 'F' AND probe_timestamp >= NOW() - INTERVAL 30 DAY
+--     GROUP BY day;
+
+-- Tables created before measurement_type was part of the primary keys:
+-- ALTER TABLE `measurement_value` DROP PRIMARY KEY,
+--     ADD PRIMARY KEY (`device`, `test_id`, `probe_number`, `measurement_type`, `value_name`, `probe_timestamp`);
+-- ALTER TABLE `measurement_statistic` DROP PRIMARY KEY, ADD PRIMARY KEY (`test_id`, `measurement_type`, `value_name`);
@@ -0,0 +1,13 @@
+-- Migration of schema version 1 (db/create_table.sql) to version 2 (db/create_table_v2.sql).
+-- Run db/create_table_v2.sql first and fill `device_map` with the device of every v1 device_id, e.g.
+--     INSERT INTO `device_map` SELECT DISTINCT `device_id`, '192.168.5.219' FROM `device_remote_control_test`
+--         WHERE `device_id` IS NOT NULL;
+-- Tests without device_id or mapping get an empty device, same as addons.migrate_measurements_v1_to_v2().
+-- Stringified measurement lists are migrated by addons.migrate_measurements_v1_to_v2(), which maps list
+-- positions to value_name from config.
+INSERT INTO `device_test` (`test_id`, `device`, `test_timestamp`, `device_id`, `device_status`, `device_motor_status`,
+                           `unit_status`, `t_on_c_break`, `t_off_c_break`, `t_reset_c_break`, `test_score`)
+    SELECT t.`test_id`, COALESCE(d.`device`, ''), t.`test_timestamp`, t.`device_id`, t.`device_status`,
+           t.`device_motor_status`, t.`unit_status`, t.`t_on_c_break`, t.`t_off_c_break`, t.`t_reset_c_break`,
+           NULLIF(t.`test_score`, '')
+    FROM `device_remote_control_test` t LEFT JOIN `device_map` d ON d.`device_id` = t.`device_id`;
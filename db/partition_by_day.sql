@@ -0,0 +1,10 @@
+-- Optional daily partitioning of measurement_value (schema version 2).
+-- Old partitions can be dropped instantly instead of running DELETE over millions of rows.
+ALTER TABLE `measurement_value` PARTITION BY RANGE COLUMNS (`probe_timestamp`) (
+    PARTITION p20220422 VALUES LESS THAN ('2022-04-23'),
+    PARTITION pmax VALUES LESS THAN (MAXVALUE)
+    );
+-- New day is added by splitting the last partition, e.g. from cron:
+-- ALTER TABLE `measurement_value` REORGANIZE PARTITION pmax INTO (
+--     PARTITION p20220423 VALUES LESS THAN ('2022-04-24'),
+--     PARTITION pmax VALUES LESS THAN (MAXVALUE));
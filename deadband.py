@@ -0,0 +1,83 @@
+#!/usr/bin/python3.10
+"""
+Change detection (report by exception): values are emitted only when they leave the deadband around the last
+emitted value or when they were silent for max_silence seconds
+"""
+import math
+
+# Values are re-emitted at least this often (seconds) even without change, keeps stored series alive
+__MAX_SILENCE__ = 60.0
+
+
+def compile_deadband(entry: dict, max_silence: float = __MAX_SILENCE__) -> tuple:
+    """
+    Aligns 'deadband' key of test_readings_sequence entry to its value_name list. Top level abs, percent and
+    max_silence apply to all values, {value_name: {abs, percent}} overrides them per value.
+    :param entry: test_readings_sequence entry
+    :param max_silence: Default max silence in seconds
+    :return: (absolute deadbands, percent deadbands, max silence), zero deadbands report every change
+    :raise ValueError: Deadband is malformed
+    """
+    deadband = entry.get('deadband', {})
+    if not isinstance(deadband, dict):
+        raise ValueError("deadband must be mapping")
+    names = entry.get('value_name', [])
+    unknown = [key for key in deadband if key not in ('abs', 'percent', 'max_silence') and key not in names]
+    if unknown:
+        raise ValueError("deadband of unknown value_name " + ", ".join(str(key) for key in unknown))
+    absolute, percent = [], []
+    for name in names:
+        bounds = dict(deadband, **deadband[name]) if isinstance(deadband.get(name), dict) else deadband
+        for key, target in (('abs', absolute), ('percent', percent)):
+            value = bounds.get(key, 0)
+            if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+                raise ValueError("deadband " + key + " of " + str(name) + " must be non-negative number, got " +
+                                 repr(value))
+            target.append(float(value))
+    silence = deadband.get('max_silence', max_silence)
+    if not isinstance(silence, (int, float)) or isinstance(silence, bool) or silence <= 0:
+        raise ValueError("deadband max_silence must be positive number, got " + repr(silence))
+    return tuple(absolute), tuple(percent), float(silence)
+
+
+class DeadbandFilter:
+    """
+    Change detection of all values of one measurement type, deadband is measured from the last emitted value
+    so slow drift is reported once it accumulates
+    """
+    __slots__ = ('absolute', 'percent', 'max_silence', 'last_values', 'last_times')
+
+    def __init__(self, entry: dict, max_silence: float = __MAX_SILENCE__):
+        self.absolute, self.percent, self.max_silence = compile_deadband(entry, max_silence)
+        self.last_values = [None] * len(self.absolute)
+        self.last_times = [-math.inf] * len(self.absolute)
+
+    def significant(self, index: int, value: float, timestamp: float) -> bool:
+        """
+        :param index: Value position
+        :param value: Decoded value
+        :param timestamp: Sample time in seconds
+        :return: True if value has to be emitted
+        """
+        last = self.last_values[index]
+        if last is None or timestamp - self.last_times[index] >= self.max_silence:
+            return True
+        # Values becoming or stopping to be not available are always reported
+        if value != value or last != last:
+            return (value != value) != (last != last)
+        return abs(value - last) > max(self.absolute[index], self.percent[index] / 100 * abs(last))
+
+    def changes(self, values: list, timestamp: float) -> list:
+        """
+        Detects significant changes of one reading, emitted values become new reference
+        :param values: Decoded values in value_name order, empty if read failed
+        :param timestamp: Sample time in seconds
+        :return: [(index, value)] of values to emit
+        """
+        if len(values) != len(self.absolute):
+            return []
+        changed = [(index, value) for index, value in enumerate(values) if self.significant(index, value, timestamp)]
+        for index, value in changed:
+            self.last_values[index] = value
+            self.last_times[index] = timestamp
+        return changed
@@ -0,0 +1,99 @@
+#!/usr/bin/python3.10
+"""
+Config driven decoding of holding registers into engineering units
+"""
+import math
+import struct
+import sys
+from array import array
+from decimal import Decimal
+
+# Struct format and register count of supported data types
+__DATA_TYPES__ = {
+    'int16': ('h', 'H', 1),
+    'uint16': ('H', 'H', 1),
+    'int32': ('i', 'I', 2),
+    'uint32': ('I', 'I', 2),
+    'float32': ('f', 'I', 2),
+}
+# Defaults for entries without decode keys (signed 16 bit, 0x8000 means not available for int16 only)
+__DEFAULT_DATA_TYPE__ = 'int16'
+__DEFAULT_SCALE__ = 1
+__DEFAULT_NAN_VALUE__ = 32768
+__DEFAULT_WORD_ORDER__ = 'big'
+
+
+class BlockDecoder:
+    """
+    Decodes one test_readings_sequence entry ('data_type', 'scale', 'nan_value', 'word_order' keys)
+    """
+    __slots__ = ('count', 'value_count', 'value_format', 'raw_format', 'swap_words', 'nan_value', 'scales', 'digits')
+
+    def __init__(self, entry: dict):
+        data_type = entry.get('data_type', __DEFAULT_DATA_TYPE__)
+        try:
+            value_code, raw_code, width = __DATA_TYPES__[data_type]
+        except KeyError:
+            raise ValueError("Unsupported data_type " + str(data_type) + " (use " + ", ".join(__DATA_TYPES__) + ")")
+        self.count = entry['count']
+        if self.count % width:
+            raise ValueError("count of " + data_type + " must be a multiple of " + str(width) + ", got " +
+                             str(self.count))
+        self.value_count = self.count // width
+        self.value_format = struct.Struct('>' + str(self.value_count) + value_code)
+        self.raw_format = struct.Struct('>' + str(self.value_count) + raw_code)
+        # Low word first devices need register pairs swapped before unpacking
+        self.swap_words = width == 2 and entry.get('word_order', __DEFAULT_WORD_ORDER__) == 'little'
+        # Other types have no not available value unless configured, 0x8000 is a valid raw value there
+        self.nan_value = entry.get('nan_value', __DEFAULT_NAN_VALUE__ if data_type == 'int16' else None)
+        scale = entry.get('scale', __DEFAULT_SCALE__)
+        self.scales = list(scale) if isinstance(scale, list) else [scale] * self.value_count
+        if len(self.scales) != self.value_count:
+            raise ValueError("scale must list " + str(self.value_count) + " values, got " + str(len(self.scales)))
+        if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in self.scales):
+            raise ValueError("scale must be a number or list of numbers, got " + repr(scale))
+        # Rounds scaled values to the decimal places of the scale (0.1 -> 1, 0.25 -> 2), removes float noise only
+        self.digits = [max(0, -Decimal(repr(value)).normalize().as_tuple().exponent) for value in self.scales]
+
+    def to_bytes(self, words) -> bytes:
+        """
+        Converts registers to big endian bytes as sent on the wire
+        :param words: Registers (list or array('H'))
+        :return: Raw bytes
+        """
+        registers = array('H', words)
+        if self.swap_words:
+            registers[0::2], registers[1::2] = registers[1::2], registers[0::2]
+        if sys.byteorder == 'little':
+            registers.byteswap()
+        return registers.tobytes()
+
+    def decode(self, words) -> list:
+        """
+        Decodes registers of the entry at once
+        :param words: Registers (list or array('H')), empty if read failed
+        :return: Values in engineering units, NaN for not available values
+        """
+        if len(words) != self.count:
+            return []
+        raw = self.to_bytes(words)
+        values = self.value_format.unpack(raw)
+        nan_flags = self.raw_format.unpack(raw) if self.nan_value is not None else ()
+        decoded = []
+        for index, value in enumerate(values):
+            if nan_flags and nan_flags[index] == self.nan_value:
+                decoded.append(math.nan)
+            elif self.scales[index] == 1:
+                decoded.append(value)
+            else:
+                decoded.append(round(value * self.scales[index], self.digits[index]))
+        return decoded
+
+
+def compile_decoders(readings_sequence: dict) -> dict:
+    """
+    Compiles decoders of all measurement types
+    :param readings_sequence: test_readings_sequence section of the config
+    :return: {measurement_type: BlockDecoder}
+    """
+    return {measurement_type: BlockDecoder(entry) for measurement_type, entry in readings_sequence.items()}
@@ -0,0 +1,335 @@
+#!/usr/bin/python3.10
+"""
+Pass/fail evaluation of decoded readings against config limits with streaming statistics per value_name,
+probes are folded into aggregates as they arrive so long runs get a verdict without keeping raw samples
+"""
+import math
+from array import array
+from bisect import bisect_right, insort
+from decoding import compile_decoders
+
+# Estimated percentiles of every value
+__PERCENTILES__ = (0.05, 0.5, 0.95)
+# Score (0-100) a test needs for Pass verdict
+__PASS_SCORE__ = 100
+# Digits of reported statistics
+__DIGITS__ = 4
+
+
+class P2Quantile:
+    """
+    P-square streaming quantile estimate (Jain, Chlamtac), five markers instead of stored samples
+    """
+    __slots__ = ('quantile', 'heights', 'positions', 'desired', 'increments')
+
+    def __init__(self, quantile: float):
+        self.quantile = quantile
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value: float) -> None:
+        """
+        :param value: Sample
+        :return: None
+        """
+        heights = self.heights
+        if len(heights) < 5:
+            insort(heights, value)
+            return
+        # Cell of the sample, extreme markers follow new min and max
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = bisect_right(heights, value) - 1
+        positions = self.positions
+        for index in range(cell + 1, 5):
+            positions[index] += 1
+        for index in range(5):
+            self.desired[index] += self.increments[index]
+        # Middle markers are moved by one position towards desired position
+        for index in (1, 2, 3):
+            offset = self.desired[index] - positions[index]
+            if (offset >= 1 and positions[index + 1] - positions[index] > 1) or \
+                    (offset <= -1 and positions[index - 1] - positions[index] < -1):
+                step = 1 if offset > 0 else -1
+                height = heights[index] + step / (positions[index + 1] - positions[index - 1]) * (
+                    (positions[index] - positions[index - 1] + step) * (heights[index + 1] - heights[index]) /
+                    (positions[index + 1] - positions[index]) +
+                    (positions[index + 1] - positions[index] - step) * (heights[index] - heights[index - 1]) /
+                    (positions[index] - positions[index - 1]))
+                if not heights[index - 1] < height < heights[index + 1]:
+                    # Parabolic prediction out of order, linear one is used
+                    height = heights[index] + step * (heights[index + step] - heights[index]) / (
+                        positions[index + step] - positions[index])
+                heights[index] = height
+                positions[index] += step
+
+    def value(self) -> float:
+        """
+        :return: Quantile estimate, exact for less than five samples, NaN without samples
+        """
+        heights = self.heights
+        if not heights:
+            return math.nan
+        if len(heights) < 5:
+            return heights[round(self.quantile * (len(heights) - 1))]
+        return heights[2]
+
+
+class RunningStatistics:
+    """
+    Count, min, max, mean and variance (Welford) and percentile estimates of one value, NaN samples are only counted
+    """
+    __slots__ = ('count', 'nan', 'mean', 'm2', 'minimum', 'maximum', 'quantiles')
+
+    def __init__(self, percentiles: tuple = __PERCENTILES__):
+        self.count = 0
+        self.nan = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.quantiles = [P2Quantile(percentile) for percentile in percentiles]
+
+    def add(self, value: float) -> None:
+        """
+        :param value: Sample
+        :return: None
+        """
+        if value != value:
+            self.nan += 1
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        for quantile in self.quantiles:
+            quantile.add(value)
+
+    @property
+    def variance(self) -> float:
+        """
+        :return: Sample variance, 0 for less than two samples
+        """
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def statistics(self) -> dict:
+        """
+        :return: Aggregates, None where undefined (no samples)
+        """
+        if not self.count:
+            return {'count': 0, 'nan': self.nan, 'min': None, 'max': None, 'mean': None, 'stdev': None}
+        aggregates = {'count': self.count, 'nan': self.nan, 'min': round(self.minimum, __DIGITS__),
+                      'max': round(self.maximum, __DIGITS__), 'mean': round(self.mean, __DIGITS__),
+                      'stdev': round(math.sqrt(self.variance), __DIGITS__)}
+        for quantile in self.quantiles:
+            aggregates['p' + str(round(quantile.quantile * 100))] = round(quantile.value(), __DIGITS__)
+        return aggregates
+
+
+def compile_limits(entry: dict) -> tuple:
+    """
+    Aligns 'limits' key of test_readings_sequence entry to its value_name list. Top level min and max apply to all
+    values, {value_name: {min, max}} overrides them per value.
+    :param entry: test_readings_sequence entry
+    :return: (low bounds, high bounds), -inf/inf for unlimited values, None if entry has no limits
+    :raise ValueError: Limits are malformed
+    """
+    limits = entry.get('limits')
+    if limits is None:
+        return None
+    if not isinstance(limits, dict):
+        raise ValueError("limits must be mapping")
+    names = entry.get('value_name', [])
+    unknown = [key for key in limits if key not in ('min', 'max') and key not in names]
+    if unknown:
+        raise ValueError("limits of unknown value_name " + ", ".join(str(key) for key in unknown))
+    low, high = [], []
+    for name in names:
+        bounds = dict(limits, **limits[name]) if isinstance(limits.get(name), dict) else limits
+        minimum, maximum = bounds.get('min', -math.inf), bounds.get('max', math.inf)
+        for bound in (minimum, maximum):
+            if not isinstance(bound, (int, float)) or isinstance(bound, bool):
+                raise ValueError("limits of " + str(name) + " must be numbers, got " + repr(bound))
+        if minimum > maximum:
+            raise ValueError("limits of " + str(name) + " have min above max")
+        low.append(float(minimum))
+        high.append(float(maximum))
+    return tuple(low), tuple(high)
+
+
+class ValueEvaluator:
+    """
+    Limits and running statistics of all values of one measurement type
+    """
+    __slots__ = ('names', 'low', 'high', 'limited', 'statistics', 'violations', 'checked', 'reads', 'failed_reads')
+
+    def __init__(self, entry: dict):
+        self.names = list(entry.get('value_name', []))
+        limits = compile_limits(entry)
+        self.limited = limits is not None
+        low, high = limits or ((-math.inf,) * len(self.names), (math.inf,) * len(self.names))
+        # Bounds preallocated in value order, one probe is checked by a single pass over aligned arrays
+        self.low = array('d', low)
+        self.high = array('d', high)
+        self.statistics = [RunningStatistics() for _ in self.names]
+        self.violations = array('L', bytes(array('L').itemsize * len(self.names)))
+        self.checked = 0
+        self.reads = 0
+        self.failed_reads = 0
+
+    def add(self, values: list) -> int:
+        """
+        Folds one decoded reading into statistics and checks it against limits
+        :param values: Decoded values in value_name order, empty if read failed
+        :return: Count of values out of limits
+        """
+        self.reads += 1
+        if len(values) != len(self.names):
+            self.failed_reads += 1
+            return 0
+        for statistics, value in zip(self.statistics, values):
+            statistics.add(value)
+        if not self.limited:
+            return 0
+        # NaN (not available) is neither checked nor violation
+        checks = [(value == value, not low <= value <= high) for value, low, high in zip(values, self.low, self.high)]
+        self.checked += sum(valid for valid, _ in checks)
+        failed = 0
+        for index, (valid, outside) in enumerate(checks):
+            if valid and outside:
+                self.violations[index] += 1
+                failed += 1
+        return failed
+
+    def report(self) -> dict:
+        """
+        :return: {value_name: aggregates with limits and count of violations}
+        """
+        report = {}
+        for index, name in enumerate(self.names):
+            aggregates = self.statistics[index].statistics()
+            aggregates.update({'low': self.low[index] if self.low[index] > -math.inf else None,
+                               'high': self.high[index] if self.high[index] < math.inf else None,
+                               'violations': self.violations[index]})
+            report[name] = aggregates
+        return report
+
+
+class Evaluator:
+    """
+    Streaming evaluation of a test, {measurement_type: ValueEvaluator}
+    """
+
+    def __init__(self, readings_sequence: dict):
+        self.decoders = compile_decoders(readings_sequence)
+        self.values = {measurement_type: ValueEvaluator(entry) for measurement_type, entry in
+                       readings_sequence.items()}
+
+    def add(self, measurement_type: str, values: list, _timestamp: float = None) -> int:
+        """
+        Adds decoded reading, signature matches monitor on_sample callback
+        :param measurement_type: Key of test_readings_sequence
+        :param values: Decoded values
+        :param _timestamp: Unused, sample time
+        :return: Count of values out of limits
+        """
+        return self.values[measurement_type].add(values)
+
+    def add_block(self, block, registers: list) -> int:
+        """
+        Evaluates all members of one block read
+        :param block: ReadBlock
+        :param registers: Raw registers of the block, empty if read failed
+        :return: Count of values out of limits
+        """
+        failed = 0
+        for measurement_type, (offset, count) in block.members:
+            values = self.decoders[measurement_type].decode(registers[offset:offset + count]) if registers else []
+            failed += self.values[measurement_type].add(values)
+        return failed
+
+    def add_probe(self, read_plan: tuple, block_readings: list) -> int:
+        """
+        :param read_plan: ReadBlocks of the test plan
+        :param block_readings: Raw registers per planned block, empty list if block read failed
+        :return: Count of values out of limits
+        """
+        return sum(self.add_block(block, registers) for block, registers in zip(read_plan, block_readings))
+
+    @property
+    def checked(self) -> int:
+        """
+        :return: Count of values checked against limits
+        """
+        return sum(item.checked for item in self.values.values())
+
+    @property
+    def reads(self) -> int:
+        """
+        :return: Count of readings
+        """
+        return sum(item.reads for item in self.values.values())
+
+    @property
+    def failed_reads(self) -> int:
+        """
+        :return: Count of failed readings
+        """
+        return sum(item.failed_reads for item in self.values.values())
+
+    @property
+    def violations(self) -> int:
+        """
+        :return: Count of values out of limits
+        """
+        return sum(sum(item.violations) for item in self.values.values())
+
+    def report(self) -> dict:
+        """
+        :return: {measurement_type: {value_name: aggregates}}, types without samples are left out
+        """
+        return {measurement_type: item.report() for measurement_type, item in self.values.items()
+                if any(statistics.count or statistics.nan for statistics in item.statistics)}
+
+
+def evaluate_results(results: dict, evaluator: Evaluator = None, pass_score: float = __PASS_SCORE__) -> dict:
+    """
+    Scores test as mean pass ratio of its parts: control commands, status registers, endurance cycles, successful
+    readings and measured values within limits
+    :param results: dict of test results
+    :param evaluator: Evaluator of measurement or monitor test, None without measurements
+    :param pass_score: Min score of Pass verdict
+    :return: Evaluation section {score, verdict, pass_score, sections, values}
+    """
+    sections = {}
+    for name in ("ControlTest", "ReadInfoTest"):
+        statuses = [entry['status'] for entry in results.get(name, {}).values()
+                    if isinstance(entry, dict) and 'status' in entry]
+        if statuses:
+            sections[name] = sum(1 for status in statuses if status) / len(statuses)
+    endurance = results.get("EnduranceTest")
+    if endurance and endurance['cycles']:
+        failures = endurance['failures']
+        sections["EnduranceTest"] = 1 - sum(failures.values()) / (endurance['cycles'] * len(failures))
+    values = {}
+    if evaluator is not None:
+        values = evaluator.report()
+        if evaluator.reads:
+            sections["Readings"] = 1 - evaluator.failed_reads / evaluator.reads
+        if evaluator.checked:
+            sections["Limits"] = 1 - evaluator.violations / evaluator.checked
+    score = round(100 * sum(sections.values()) / len(sections), 2) if sections else 0.0
+    return {'score': score, 'verdict': "Pass" if sections and score >= pass_score else "Fail",
+            'pass_score': pass_score, 'sections': {name: round(ratio, __DIGITS__) for name, ratio in sections.items()},
+            'values': values}
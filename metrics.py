@@ -0,0 +1,237 @@
+#!/usr/bin/python3.10
+"""
+Low-overhead metrics (counters, latency histograms) with Prometheus text export over HTTP or to file,
+and optional trace spans in Chrome trace event format (chrome://tracing, Perfetto)
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter_ns, time
+from actuation import LatencyHistogram
+
+# Histogram bucket upper bounds in ms, from sub-millisecond LAN requests up to WAN and DB commits
+__METRIC_BUCKETS__ = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+__METRICS_ADDRESS__ = "127.0.0.1"
+__METRIC_PREFIX__ = "modbus_tester_"
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms keyed by name and label values, disabled registry only checks one flag per call
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.spans = None
+        self.trace_start = 0
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        """
+        Increments counter
+        :param name: Metric name
+        :param labels: ((label, value), ...)
+        :param value: Increment
+        :return: None
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name: str, labels: tuple, value_ms: float) -> None:
+        """
+        Adds latency to histogram
+        :param name: Metric name
+        :param labels: ((label, value), ...)
+        :param value_ms: Latency in ms
+        :return: None
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = LatencyHistogram(__METRIC_BUCKETS__)
+            histogram.add(value_ms)
+
+    @contextmanager
+    def span(self, name: str, labels: tuple = (), **attributes):
+        """
+        Times block into <name>_duration_seconds histogram and trace span (if tracing)
+        :param name: Span and metric name
+        :param labels: ((label, value), ...)
+        :param attributes: Extra trace attributes (e.g. test_id), track selects trace row (default thread)
+        :return: Context manager
+        """
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter_ns()
+        try:
+            yield
+        finally:
+            duration = perf_counter_ns() - start
+            self.observe(name, labels, duration / 1e6)
+            if self.spans is not None:
+                # Concurrent coroutines of one thread are put on separate tracks (e.g. per device)
+                track = attributes.pop('track', threading.get_ident())
+                with self.lock:
+                    self.spans.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': track,
+                                       'ts': (start - self.trace_start) / 1000, 'dur': duration / 1000,
+                                       'args': dict(labels, **attributes)})
+
+    def enable(self, trace: bool = False) -> None:
+        """
+        :param trace: Also record trace spans
+        :return: None
+        """
+        self.enabled = True
+        if trace and self.spans is None:
+            self.spans = []
+            self.trace_start = perf_counter_ns()
+
+    def render(self) -> str:
+        """
+        :return: Metrics in Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            snapshots = [(key, list(histogram.counts), histogram.count, histogram.total) for key, histogram in
+                         histograms]
+        declared = set()
+        for (name, labels), value in counters:
+            metric = __METRIC_PREFIX__ + name + "_total"
+            if metric not in declared:
+                lines.append("# TYPE " + metric + " counter")
+                declared.add(metric)
+            lines.append(metric + format_labels(labels) + " " + repr(value))
+        for (name, labels), counts, count, total in snapshots:
+            metric = __METRIC_PREFIX__ + name + "_duration_seconds"
+            if metric not in declared:
+                lines.append("# TYPE " + metric + " histogram")
+                declared.add(metric)
+            cumulative = 0
+            for bound, bucket_count in zip(__METRIC_BUCKETS__, counts):
+                cumulative += bucket_count
+                lines.append(metric + "_bucket" + format_labels(labels + (('le', repr(bound / 1000)),)) + " " +
+                             str(cumulative))
+            lines.append(metric + "_bucket" + format_labels(labels + (('le', "+Inf"),)) + " " + str(count))
+            lines.append(metric + "_sum" + format_labels(labels) + " " + repr(total / 1000))
+            lines.append(metric + "_count" + format_labels(labels) + " " + str(count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        Writes metrics file atomically (node_exporter textfile collector)
+        :param path: Output file
+        :return: None
+        """
+        with open(path + ".tmp", 'w', encoding='utf-8') as file:
+            file.write(self.render())
+        os.replace(path + ".tmp", path)
+
+    def write_trace(self, path: str) -> None:
+        """
+        Writes recorded spans in Chrome trace event format
+        :param path: Output file
+        :return: None
+        """
+        with self.lock:
+            events = list(self.spans or [])
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'traceEvents': events, 'otherData': {'created': time()}}, file)
+
+    def serve(self, port: int, address: str = __METRICS_ADDRESS__):
+        """
+        Serves /metrics in background thread, HTTP server is imported only when metrics are served
+        :param port: Listen port
+        :param address: Listen address
+        :return: Server object (http.server.ThreadingHTTPServer)
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # pylint: disable=import-outside-toplevel
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            """
+            GET /metrics handler
+            """
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def format_labels(labels: tuple) -> str:
+    """
+    :param labels: ((label, value), ...)
+    :return: Prometheus label set
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join(label + "=\"" + str(value).replace("\\", "\\\\").replace("\"", "\\\"") + "\""
+                          for label, value in labels) + "}"
+
+
+# Process wide registry
+METRICS = MetricsRegistry()
+
+
+def add_metrics_arguments(parser) -> None:
+    """
+    Adds metrics export options to command line parser
+    :param parser: argparse.ArgumentParser
+    :return: None
+    """
+    parser.add_argument('--metrics_port', dest='metrics_port', type=int,
+                        help="Serve Prometheus metrics on http://127.0.0.1:<port>/metrics while testing",
+                        default=None, required=False)
+    parser.add_argument('--metrics_file', dest='metrics_file', type=str,
+                        help="Write Prometheus metrics to file at the end of the run", default=None, required=False)
+    parser.add_argument('--trace', dest='trace', type=str,
+                        help="Write trace spans (chrome://tracing, Perfetto) to file at the end of the run",
+                        default=None, required=False)
+
+
+def start_metrics(args) -> None:
+    """
+    Enables global registry if any export is requested
+    :param args: Command line arguments
+    :return: None
+    """
+    if args.metrics_port is None and not args.metrics_file and not args.trace:
+        return
+    METRICS.enable(trace=bool(args.trace))
+    if args.metrics_port is not None:
+        METRICS.serve(args.metrics_port)
+        print("-> Metrics served on http://" + __METRICS_ADDRESS__ + ":" + str(args.metrics_port) + "/metrics")
+
+
+def export_metrics(args) -> None:
+    """
+    Writes metrics and trace files requested on command line
+    :param args: Command line arguments
+    :return: None
+    """
+    if args.metrics_file:
+        METRICS.write(args.metrics_file)
+        print("-> Metrics saved: " + args.metrics_file)
+    if args.trace:
+        METRICS.write_trace(args.trace)
+        print("-> Trace saved: " + args.trace)
@@ -0,0 +1,188 @@
+#!/usr/bin/python3.10
+"""
+Modbus TCP (MBAP) frame encoding and decoding for asyncio clients and the device simulator
+"""
+import struct
+
+# MBAP header -> transaction ID, protocol ID, length (unit ID + PDU), unit ID
+__MBAP_HEADER__ = struct.Struct('>HHHB')
+__MBAP_HEADER_SIZE__ = 7
+# Supported function codes
+READ_HOLDING_REGISTERS = 0x03
+WRITE_SINGLE_REGISTER = 0x06
+WRITE_MULTIPLE_REGISTERS = 0x10
+ENCAPSULATED_INTERFACE = 0x2B
+MEI_READ_DEVICE_ID = 0x0E
+# Exception codes
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+ILLEGAL_DATA_VALUE = 0x03
+SERVER_DEVICE_FAILURE = 0x04
+
+
+class ModbusExceptionResponse(Exception):
+    """
+    Device answered with Modbus exception code
+    """
+
+    def __init__(self, function_code: int, exception_code: int):
+        super().__init__("Function " + str(function_code) + " failed with exception code " + str(exception_code))
+        self.function_code = function_code
+        self.exception_code = exception_code
+
+
+def encode_frame(transaction_id: int, unit_id: int, pdu: bytes) -> bytes:
+    """
+    Wraps PDU into MBAP frame
+    :param transaction_id: MBAP transaction ID (0-65535)
+    :param unit_id: Slave unit ID
+    :param pdu: Protocol data unit
+    :return: Frame bytes
+    """
+    return __MBAP_HEADER__.pack(transaction_id & 0xFFFF, 0, len(pdu) + 1, unit_id) + pdu
+
+
+def decode_header(header: bytes) -> tuple:
+    """
+    Decodes MBAP header
+    :param header: First 7 bytes of the frame
+    :return: (transaction_id, unit_id, pdu_length)
+    """
+    transaction_id, _, length, unit_id = __MBAP_HEADER__.unpack(header)
+    return transaction_id, unit_id, length - 1
+
+
+def read_holding_registers_pdu(address: int, count: int) -> bytes:
+    """
+    Builds FC3 request
+    :param address: Start register
+    :param count: Count of registers
+    :return: PDU
+    """
+    return struct.pack('>BHH', READ_HOLDING_REGISTERS, address, count)
+
+
+def write_single_register_pdu(address: int, value: int) -> bytes:
+    """
+    Builds FC6 request
+    :param address: Register address
+    :param value: Register value
+    :return: PDU
+    """
+    return struct.pack('>BHH', WRITE_SINGLE_REGISTER, address, value & 0xFFFF)
+
+
+def write_multiple_registers_pdu(address: int, values: list) -> bytes:
+    """
+    Builds FC16 request
+    :param address: Start register
+    :param values: Register values
+    :return: PDU
+    """
+    return struct.pack('>BHHB%dH' % len(values), WRITE_MULTIPLE_REGISTERS, address, len(values), len(values) * 2,
+                       *[value & 0xFFFF for value in values])
+
+
+def read_device_information_pdu(read_code: int = 1, object_id: int = 0) -> bytes:
+    """
+    Builds FC43/14 Read Device Identification request
+    :param read_code: 1 basic, 2 regular, 3 extended, 4 specific object
+    :param object_id: First object ID
+    :return: PDU
+    """
+    return struct.pack('>BBBB', ENCAPSULATED_INTERFACE, MEI_READ_DEVICE_ID, read_code, object_id)
+
+
+def decode_response(pdu: bytes):
+    """
+    Decodes response PDU of supported function codes
+    :param pdu: Protocol data unit
+    :return: Registers for FC3, True for FC6/FC16, {object_id: bytes} for FC43/14
+    """
+    function_code = pdu[0]
+    if function_code & 0x80:
+        raise ModbusExceptionResponse(function_code & 0x7F, pdu[1])
+    if function_code == READ_HOLDING_REGISTERS:
+        return list(struct.unpack_from('>%dH' % (pdu[1] // 2), pdu, 2))
+    if function_code in (WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_REGISTERS):
+        return True
+    if function_code == ENCAPSULATED_INTERFACE and pdu[1] == MEI_READ_DEVICE_ID:
+        information = {}
+        # Skips read code, conformity level, more follows and next object ID
+        position, object_count = 7, pdu[6]
+        for _ in range(object_count):
+            object_id, length = pdu[position], pdu[position + 1]
+            information[object_id] = bytes(pdu[position + 2:position + 2 + length])
+            position += 2 + length
+        return information
+    raise ModbusExceptionResponse(function_code, ILLEGAL_FUNCTION)
+
+
+def describe_request(pdu: bytes) -> tuple:
+    """
+    Function code and start register of request (metrics labels)
+    :param pdu: Request PDU
+    :return: (function_code, address), address is None for FC43
+    """
+    if pdu[0] in (READ_HOLDING_REGISTERS, WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_REGISTERS):
+        return pdu[0], struct.unpack_from('>H', pdu, 1)[0]
+    return pdu[0], None
+
+
+def decode_request(pdu: bytes) -> tuple:
+    """
+    Decodes request PDU (simulator side)
+    :param pdu: Protocol data unit
+    :return: (function_code, arguments)
+    """
+    function_code = pdu[0]
+    if function_code in (READ_HOLDING_REGISTERS, WRITE_SINGLE_REGISTER):
+        return function_code, struct.unpack_from('>HH', pdu, 1)
+    if function_code == WRITE_MULTIPLE_REGISTERS:
+        address, count = struct.unpack_from('>HH', pdu, 1)
+        return function_code, (address, list(struct.unpack_from('>%dH' % count, pdu, 6)))
+    if function_code == ENCAPSULATED_INTERFACE and pdu[1] == MEI_READ_DEVICE_ID:
+        return function_code, (pdu[2], pdu[3])
+    return function_code, ()
+
+
+def read_holding_registers_response(values: list) -> bytes:
+    """
+    Builds FC3 response
+    :param values: Register values
+    :return: PDU
+    """
+    return struct.pack('>BB%dH' % len(values), READ_HOLDING_REGISTERS, len(values) * 2, *values)
+
+
+def write_response(request_pdu: bytes) -> bytes:
+    """
+    Builds FC6/FC16 response (echo of address and value/count)
+    :param request_pdu: Request PDU
+    :return: PDU
+    """
+    return bytes(request_pdu[:5])
+
+
+def read_device_information_response(read_code: int, objects: list) -> bytes:
+    """
+    Builds FC43/14 response
+    :param read_code: Read code of the request
+    :param objects: Object values in object ID order, starting with 0
+    :return: PDU
+    """
+    pdu = struct.pack('>BBBBBBB', ENCAPSULATED_INTERFACE, MEI_READ_DEVICE_ID, read_code, 0x01, 0, 0, len(objects))
+    for object_id, value in enumerate(objects):
+        encoded = value.encode('ascii')
+        pdu += struct.pack('>BB', object_id, len(encoded)) + encoded
+    return pdu
+
+
+def exception_response(function_code: int, exception_code: int) -> bytes:
+    """
+    Builds exception response
+    :param function_code: Function code of the request
+    :param exception_code: Modbus exception code
+    :return: PDU
+    """
+    return struct.pack('>BB', function_code | 0x80, exception_code)
@@ -3,18 +3,20 @@
 Simple Modbus testing script for Circuit Breakers
 """
 import argparse
-import socket
 import uuid
 from sys import exit as sys_exit
 from datetime import datetime
-from time import sleep
-import yaml
-from pyModbusTCP.client import ModbusClient as modbus_client
-from pymodbus.client.sync import ModbusTcpClient as modbus_client_custom
-from pymodbus.mei_message import ReadDeviceInformationRequest
-from addons import generate_test_report_json
-from addons import generate_test_report_html
-from addons import write_test_results_2_db
+from time import sleep, monotonic
+from probe_store import ProbeStore
+from evaluation import Evaluator, evaluate_results
+from monitor import PollSchedule, run_monitor
+from metrics import METRICS, add_metrics_arguments, export_metrics, start_metrics
+from sinks import ResultSink, DeltaSink, open_sink, replay_results
+from serialization import load_results
+from modbus_transport import ModbusTransport
+from test_plan import TestPlan, load_test_plan, __PLAN_CACHE_DIR__
+import test_sequences as sequences
+from test_sequences import run_sync, __WRITE_TIMEOUT__, __PROBE_OFFSET__, __PROBE_COUNT__
 
 
 # Global Variables
@@ -23,303 +25,196 @@ __TIME_FORMAT__ = '%Y-%m-%d %H:%M:%S'
 __DEFAULT_DEVICE_ADDRESS__ = "158.193.241.254"
 __DEFAULT_DEVICE_PORT__ = 502
 __DEFAULT_DEVICE_UNIT_ID__ = 255
-# Global variable for test configuration
-__TEST_CONFIGURATION__ = {}
-# Communication timeouts
-__WRITE_TIMEOUT__ = 0.5
-__READ_TIMEOUT__ = 0.1
-# Measurement timeouts
-__STEP_TIMEOUT__ = 2
-__PROBE_OFFSET__ = 2
-__PROBE_COUNT__ = 10
-# Print timeouts
-__PRINT_TIMEOUT__ = 0.5
-
-
-def normalize_integer_value(measurement_value: int) -> int:
-    """
-    Returns signed integer values
-    :param measurement_value: unsigned int
-    :return: signed int
-    """
-    if measurement_value == 32768:
-        return 0
-    if measurement_value > 32768:
-        return measurement_value - 65536
-    return measurement_value
+# Response timeout per unit in seconds
+__DEFAULT_DEVICE_TIMEOUT__ = 2
 
 
-def to_bool(bool_value: str) -> int:
-    """
-    Returns Bool equivalent in INT form
-    :param bool_value: bool
-    :return: int
+def load_test_configuration(file: str, overrides: dict = None, cache_dir: str = __PLAN_CACHE_DIR__) -> TestPlan:
     """
-    if bool_value:
-        return 1
-    return 0
-
-
-def load_test_configuration(file: str) -> None:
-    """
-    Loads config data to global variable
+    Loads compiled test plan, config file is parsed only when it changed since last launch
     :param file: Path to config file
-    :return: None
+    :param overrides: Values replacing keys of config section
+    :param cache_dir: Plan cache directory, empty disables cache
+    :return: Compiled test plan
     """
-    global __TEST_CONFIGURATION__
-    # Loads config file to global variable
     try:
-        __TEST_CONFIGURATION__ = yaml.safe_load(open(file, 'r', encoding="utf-8"))
+        return load_test_plan(file, overrides, cache_dir)
     except FileNotFoundError:
         print("Configuration file not found. Check config file.")
         exit(2)
+    except ValueError as error:
+        print("Configuration is not valid: " + str(error))
+        exit(2)
 
 
-def connection_test(address: str = __DEFAULT_DEVICE_ADDRESS__, port: int = __DEFAULT_DEVICE_PORT__) -> bool:
-    """
-    Simple socket test, checks if port is open
-    :param address: IPv4 address
-    :param port: Port
-    :return: Result of test
+def unit_connection(device_address: str = __DEFAULT_DEVICE_ADDRESS__, device_port: int = __DEFAULT_DEVICE_PORT__,
+                    unit_id: int = __DEFAULT_DEVICE_UNIT_ID__, depth: int = 1,
+                    timeout: float = __DEFAULT_DEVICE_TIMEOUT__, gateway: ModbusTransport = None) -> ModbusTransport:
     """
-    # Creates socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # Connects socket to given IP/port
-    result = sock.connect_ex((address, port))
-    # Closes socket
-    sock.close()
-    # Compares result
-    if result == 0:
-        print("Connection successful! Starting tests:")
-        return True
-    return False
-
-
-def send_init_sequence(modbus_connection: modbus_client) -> bool:
-    """
-    Sends init sequence for remote control testing
-    :param modbus_connection: Connection object
-    :return: Status of write
-    """
-    for key in __TEST_CONFIGURATION__['init_sequence']:
-        # Sends init sequence part
-        status = modbus_connection.write_single_register(__TEST_CONFIGURATION__['init_sequence'][key]['address_dec'],
-                                                         __TEST_CONFIGURATION__['init_sequence'][key]['data'])
-        # Checks if sequence successfully writen
-        if to_bool(status) == __TEST_CONFIGURATION__['init_sequence'][key]['pass_msg']:
-            __TEST_CONFIGURATION__['init_sequence'][key]['status'] = to_bool(status)
-        else:
-            __TEST_CONFIGURATION__['init_sequence'][key]['status'] = to_bool(status)
-        sleep(__WRITE_TIMEOUT__)
-    return __TEST_CONFIGURATION__['init_sequence']
-
-
-def send_password(modbus_connection: modbus_client) -> bool:
-    """
-    Writes password to specified registers
-    :param modbus_connection: Connection object
-    :return: Status of write
+    Creates transport of one (host, port, unit) target, units behind the gateway of an existing transport share
+    its connection (TCP-to-serial gateways accept one or two connections only)
+    :param device_address: IPv4 address of the TCP Modbus device or gateway
+    :param device_port: Port for modbus communication, default 502
+    :param unit_id: Slave unit ID, default 255
+    :param depth: Count of pipelined requests in flight, 1 for devices handling one request at a time
+    :param timeout: Response timeout of the unit in seconds
+    :param gateway: Open transport whose connection is shared when it targets the same host and port
+    :return: Connection object, not opened yet
     """
-    # Writes all keys in login section of the config file
-    for key in __TEST_CONFIGURATION__['login']:
-        # Sends passwd part
-        status = modbus_connection.write_single_register(__TEST_CONFIGURATION__['login'][key]['address_dec'],
-                                                         __TEST_CONFIGURATION__['login'][key]['data'])
-        # Checks if passwd successfully writen
-        if to_bool(status) == __TEST_CONFIGURATION__['login'][key]['pass_msg']:
-            __TEST_CONFIGURATION__['login'][key]['status'] = to_bool(status)
-        else:
-            __TEST_CONFIGURATION__['login'][key]['status'] = to_bool(status)
-        sleep(__WRITE_TIMEOUT__)
-    return __TEST_CONFIGURATION__['login']
-
-
-def device_connection(device_address: str = __DEFAULT_DEVICE_ADDRESS__, device_port: int = __DEFAULT_DEVICE_PORT__) \
-        -> modbus_client:
+    if gateway is not None and gateway.host == device_address and gateway.port == device_port:
+        return gateway.unit(unit_id, timeout)
+    return ModbusTransport(host=device_address, port=device_port, unit_id=unit_id, timeout=timeout, depth=depth)
+
+
+def device_connection(device_address: str = __DEFAULT_DEVICE_ADDRESS__, device_port: int = __DEFAULT_DEVICE_PORT__,
+                      unit_id: int = __DEFAULT_DEVICE_UNIT_ID__, depth: int = 1,
+                      timeout: float = __DEFAULT_DEVICE_TIMEOUT__) -> ModbusTransport:
     """
-    Base connetion method for modbus devices over TCP
+    Base connetion method for modbus devices over TCP, connection is kept open for all tests of the device
     :param device_address: IPv4 address of the TCP Modbus device
     :param device_port: Port for modbus communication, default 502
+    :param unit_id: Slave unit ID, default 255
+    :param depth: Count of pipelined requests in flight, 1 for devices handling one request at a time
+    :param timeout: Response timeout of the unit in seconds
     :return: Connection object
     """
-    # Creates object of ModbusClient
-    connection = modbus_client(host=device_address, port=device_port, timeout=2, auto_open=True, auto_close=False,
-                               unit_id=__DEFAULT_DEVICE_UNIT_ID__)
-    # Tries to open connection via TCP
-    connection.open()
+    # Creates transport, connection is reopened with backoff if it is lost during tests
+    connection = unit_connection(device_address, device_port, unit_id, depth, timeout)
     # Checks if connection is open, if true returns connection object, else exit with code 2 and a message
-    try:
-        if not connection.is_open:
-            raise ConnectionError
-    except ConnectionError:
+    if not connection.open():
         print("Connection problem, check device address!")
         sys_exit(2)
+    print("Connection successful! Starting tests:")
     return connection
 
 
-def read_device_id_information(device_address: str = __DEFAULT_DEVICE_ADDRESS__,
-                               device_port: int = __DEFAULT_DEVICE_PORT__) -> list:
-    """
-    Read Device Information using custom ReadDeviceInformationRequest
-    :param device_address: IPv4 address of the Modbus device
-    :param device_port: Port for modbus communication, default 502
-    :return: Device Information
-    """
-    # Response data initialisation
-    response_data = []
-    # Creates connection to Device
-    modbus_connection = modbus_client_custom(host=device_address, port=device_port)
-    # Creates request body using ReadDeviceInformationRequest
-    request = ReadDeviceInformationRequest(unit=__DEFAULT_DEVICE_UNIT_ID__)
-    # Execute request
-    response = modbus_connection.execute(request)
-    # Readout data from response and store in response_data
-    for key, value in response.information.items():
-        response_data.append(str(value).split("'")[1])
-    # Returns data from device
-    return response_data
-
-
-def remote_control_test(modbus_connection: modbus_client) -> dict:
+def remote_control_test(modbus_connection: ModbusTransport, plan: TestPlan) -> dict:
     """
     Remote control test of the Device
     :param modbus_connection: Connection object
+    :param plan: Test plan
     :return: Status data
     """
-    remote_control_status = {}
-    remote_control_status.update(send_init_sequence(modbus_connection))
-    print("-> Running Device Control Test Sequence:")
-    # OFF motor control test
-    remote_control_status.update(send_password(modbus_connection))
-    print("   Sending OFF to motor control... ", end='')
-    # Writes instruction
-    modbus_connection.write_single_register(
-        __TEST_CONFIGURATION__['remote_control_sequence']['t_off_c_break']['address_dec'],
-        __TEST_CONFIGURATION__['remote_control_sequence']['t_off_c_break']['data'])
-    # Reads status
-    status = modbus_connection.read_holding_registers(
-        __TEST_CONFIGURATION__['device_info']['get_dev_status']['address_dec'],
-        __TEST_CONFIGURATION__['device_info']['get_dev_status']['count'])
-    # Compare status with defined value
-    if status[0] == __TEST_CONFIGURATION__['remote_control_sequence']['t_off_c_break']['pass_msg']:
-        print("Pass")
-        __TEST_CONFIGURATION__['remote_control_sequence']['t_off_c_break']['status'] = 1
-    else:
-        print("Fail")
-        __TEST_CONFIGURATION__['remote_control_sequence']['t_off_c_break']['status'] = 0
-    remote_control_status.update({'t_off_c_break': __TEST_CONFIGURATION__['remote_control_sequence']['t_off_c_break']})
-    # ON motor control test
-    send_password(modbus_connection)
-    sleep(__STEP_TIMEOUT__)
-    print("   Sending ON to motor control... ", end='')
-    modbus_connection.write_single_register(
-        __TEST_CONFIGURATION__['remote_control_sequence']['t_on_c_break']['address_dec'],
-        __TEST_CONFIGURATION__['remote_control_sequence']['t_on_c_break']['data'])
-    status = modbus_connection.read_holding_registers(
-        __TEST_CONFIGURATION__['device_info']['get_dev_status']['address_dec'],
-        __TEST_CONFIGURATION__['device_info']['get_dev_status']['count'])
-    if status[0] == __TEST_CONFIGURATION__['remote_control_sequence']['t_on_c_break']['pass_msg']:
-        print("Pass")
-        __TEST_CONFIGURATION__['remote_control_sequence']['t_on_c_break']['status'] = 1
-    else:
-        print("Fail")
-        __TEST_CONFIGURATION__['remote_control_sequence']['t_on_c_break']['status'] = 0
-    remote_control_status.update({'t_on_c_break': __TEST_CONFIGURATION__['remote_control_sequence']['t_on_c_break']})
-    # RESET motor control test
-    send_password(modbus_connection)
-    sleep(__STEP_TIMEOUT__)
-    print("   Sending RESET to motor control... ", end='')
-    modbus_connection.write_single_register(
-        __TEST_CONFIGURATION__['remote_control_sequence']['t_reset_c_break']['address_dec'],
-        __TEST_CONFIGURATION__['remote_control_sequence']['t_reset_c_break']['data'])
-    status = modbus_connection.read_holding_registers(
-        __TEST_CONFIGURATION__['device_info']['get_dev_status']['address_dec'],
-        __TEST_CONFIGURATION__['device_info']['get_dev_status']['count'])
-    if status[0] == __TEST_CONFIGURATION__['remote_control_sequence']['t_reset_c_break']['pass_msg']:
-        print("Pass")
-        __TEST_CONFIGURATION__['remote_control_sequence']['t_reset_c_break']['status'] = 1
-    else:
-        print("Fail")
-        __TEST_CONFIGURATION__['remote_control_sequence']['t_reset_c_break']['status'] = 0
-    remote_control_status.update(
-        {'t_reset_c_break': __TEST_CONFIGURATION__['remote_control_sequence']['t_reset_c_break']})
+    return run_sync(sequences.remote_control_test(plan), modbus_connection)
 
-    print("   Done!")
-    return remote_control_status
 
+def device_endurance_test(modbus_connection: ModbusTransport, plan: TestPlan, cycles: int,
+                          sink: ResultSink = None) -> dict:
+    """
+    Cycles breaker through endurance_commands (default OFF, ON) as fast as confirmations allow
+    :param modbus_connection: Connection object
+    :param plan: Test plan
+    :param cycles: Count of cycles
+    :param sink: Optional streaming sink, each command is emitted as event
+    :return: Failures and actuation latency histogram per command
+    """
+    return run_sync(sequences.endurance_test(plan, cycles, sink), modbus_connection)
 
-def device_information_read_test(modbus_connection: modbus_client) -> bool:
+
+def device_information_read_test(modbus_connection: ModbusTransport, plan: TestPlan) -> dict:
     """
     Device information read test
     :param modbus_connection: Connection object
+    :param plan: Test plan
     :return: device information
     """
-    device_info = {}
-    print("-> Running Information Read Test:")
-    try:
-        print("   Read Device Identification ... ", end='')
-        data = read_device_id_information(modbus_connection.host, modbus_connection.port)
-        __TEST_CONFIGURATION__['device_id']['reading'] = data
-        sleep(__PRINT_TIMEOUT__)
-        print(data, " Pass")
-        device_info.update({'device_id': __TEST_CONFIGURATION__['device_id']})
-    except TypeError:
-        print("Could not readout device information.")
-        __TEST_CONFIGURATION__['device_id']['reading'] = []
-    sleep(__READ_TIMEOUT__)
-
-    for key in __TEST_CONFIGURATION__['device_info']:
-        print("   Read " + __TEST_CONFIGURATION__['device_info'][key]['comment'] + " ... ", end='')
-        data = modbus_connection.read_holding_registers(__TEST_CONFIGURATION__['device_info']
-                                                        [key]['address_dec'],
-                                                        __TEST_CONFIGURATION__['device_info']
-                                                        [key]['count'])
-        if key == "get_dev_motor_status":
-            # Manual defined pass values for motor control status
-            if str(data[0]) not in ["27", "31"]:
-                print(data[0], " Fail")
-            else:
-                print(data[0], " Pass")
-        else:
-            print(data[0], " Pass")
-        __TEST_CONFIGURATION__['device_info'][key]['reading'] = data[0]
-        device_info.update({key: __TEST_CONFIGURATION__['device_info'][key]})
-        sleep(__PRINT_TIMEOUT__)
-    sleep(__READ_TIMEOUT__)
-    print("   Done!")
-    return device_info
+    return run_sync(sequences.device_information_read_test(plan), modbus_connection)
 
 
-def device_measurement_read_test(modbus_connection: modbus_client) -> list:
+def device_measurement_read_test(modbus_connection: ModbusTransport, plan: TestPlan,
+                                 sink: ResultSink = None, evaluator: Evaluator = None) -> ProbeStore:
     """
     Readout of selected values
     :param modbus_connection: Connection object
-    :return: Selected values
+    :param plan: Test plan
+    :param sink: Optional streaming sink, each probe is emitted as it is captured
+    :param evaluator: Optional evaluator, each probe is checked against limits as it is captured
+    :return: Selected values, {probe number: {measurement type: decoded reading}} view over columnar store
+    """
+    return run_sync(sequences.device_measurement_read_test(plan, __PROBE_COUNT__, __PROBE_OFFSET__, sink, evaluator),
+                    modbus_connection)
+
+
+def device_monitor_test(modbus_connection: ModbusTransport, plan: TestPlan, duration: float = None,
+                        sink: ResultSink = None, evaluator: Evaluator = None) -> list:
     """
-    measurement_data_test = {}
-    measurement_data = {}
-    print("-> Running Measurement Read test: ")
-    print("   Measurement parameters -> Count: " + str(__PROBE_COUNT__) + " Offset: " + str(
-        __PROBE_OFFSET__) + "s Total time: " + str(__PROBE_COUNT__ * __PROBE_OFFSET__) + "s")
-    print("   ", end='')
-    for i in range(0, __PROBE_COUNT__):
-        print(". ", end='')
-        for measurement_type in __TEST_CONFIGURATION__['test_readings_sequence']:
-            data = modbus_connection.read_holding_registers(
-                __TEST_CONFIGURATION__['test_readings_sequence'][measurement_type]['address_dec'],
-                __TEST_CONFIGURATION__['test_readings_sequence'][measurement_type]['count'])
-            data_tmp = []
-            for data_entry in data:
-                data_tmp.append(normalize_integer_value(data_entry))
-            __TEST_CONFIGURATION__['test_readings_sequence'][measurement_type]['reading'] = data_tmp
-            measurement_data_test.update(
-                {measurement_type: __TEST_CONFIGURATION__['test_readings_sequence'][measurement_type]})
-            sleep(__READ_TIMEOUT__)
-        sleep(__PROBE_OFFSET__)
-        measurement_data.update({str(i): measurement_data_test})
-    print("Pass")
+    Continuous polling of selected values at per-block target rates (poll_rate_hz)
+    :param modbus_connection: Connection object
+    :param plan: Test plan
+    :param duration: Run time in seconds, None runs until interrupted
+    :param sink: Optional streaming sink, each sample is emitted as it is captured
+    :param evaluator: Optional evaluator, samples are folded into statistics instead of being kept
+    :return: Deadline, latency and jitter statistics per block
+    """
+    print("-> Running Measurement Monitor (Ctrl+C to stop): ")
+    schedules = []
+    start = monotonic()
+    # Blocks are planned per rate when the plan is compiled
+    for rate, block in plan.monitor_plan:
+        print("   Block " + str(block.address_dec) + "+" + str(block.count) + " @" + str(rate) + "Hz: " +
+              ", ".join(member for member, _ in block.members))
+        schedules.append(PollSchedule(block, rate, start))
+    callbacks = [callback for callback in (sink.sample if sink else None, evaluator.add if evaluator else None)
+                 if callback]
+
+    def on_sample(measurement_type: str, reading: list, timestamp: float) -> None:
+        for callback in callbacks:
+            callback(measurement_type, reading, timestamp)
+    statistics = run_monitor(modbus_connection, plan.readings_sequence(), schedules, duration,
+                             on_sample if callbacks else None)
     print("   Done!")
-    return measurement_data
+    return statistics
+
+
+def run_test(results: dict, name: str, test, *args) -> None:
+    """
+    Runs test and stores its result, test is timed as test_phase span
+    :param results: dict of test results
+    :param name: Result key
+    :param test: Test function
+    :param args: Test arguments
+    :return: None
+    """
+    with METRICS.span('test_phase', (('phase', name),), test_id=results['TestID']):
+        results.update({name: test(*args)})
+
+
+def emit_section(sink: ResultSink, results: dict, name: str) -> None:
+    """
+    Emits finished test section to streaming sink
+    :param sink: Streaming sink or None
+    :param results: dict of test results
+    :param name: Result key
+    :return: None
+    """
+    if sink:
+        sink.section(name, results[name])
+
+
+def write_output(results: dict, output: str, settings: dict) -> None:
+    """
+    Writes results in selected output format, writers (and DB driver) are imported only when used
+    :param results: dict of test results
+    :param output: json, binary, pdf, dump, db
+    :param settings: config section of the test configuration
+    :return: None
+    """
+    # pylint: disable=import-outside-toplevel
+    match output:
+        case "json":
+            from addons import generate_test_report_json
+            generate_test_report_json(results, settings)
+        case "binary":
+            from addons import generate_test_report_binary
+            generate_test_report_binary(results, settings)
+        case "dump":
+            print(results)
+        case "pdf":
+            from addons import generate_test_report_html
+            generate_test_report_html(results, settings)
+        case "db":
+            from addons import write_test_results_2_db
+            write_test_results_2_db(results, settings['db'], max_silence=settings['deadband_max_silence'])
 
 
 def main() -> None:
@@ -335,62 +230,139 @@ def main() -> None:
     now = now.strftime(__TIME_FORMAT__)
     results.update({"TestTime": now})
 
-    # Definition of variable connection (error suppress)
-    connection = None
     # Handling of input parameters with the module parser
     parser = argparse.ArgumentParser(description='Schneider circuit breaker Tester')
-    parser.add_argument('--test_mode', dest='mode', type=str, help='Test mode [full, split]',
+    parser.add_argument('--test_mode', dest='mode', type=str, help='Test mode [full, split, monitor, endurance]',
                         default="full", required=False)
-    parser.add_argument('--device_address', dest='address', type=str, help='Device IPv4 address', required=True)
-    parser.add_argument('--device_address_split', dest='address_split', type=str, help='Device IPv4 address',
+    parser.add_argument('--device_address', dest='address', type=str, help='Device IPv4 address', required=False)
+    parser.add_argument('--device_address_split', dest='address_split', type=str,
+                        help='Split device IPv4 address, default: device address (other unit behind the gateway)',
                         required=False)
     parser.add_argument('--device_port', dest='port', type=int, help='Modbus port, default: 502', default=502,
                         required=False)
     parser.add_argument('--device_port_split', dest='port_split', type=int, help='Modbus port, default: 502',
                         default=502,
                         required=False)
-    parser.add_argument('--device_uid', dest='uid', type=int, help="Slave UID, default: 255", default=255,
-                        required=False)
-    parser.add_argument('--device_uid_split', dest='uid_split', type=int, help="Slave UID, default: 255", default=255,
+    parser.add_argument('--device_uid', dest='uid', type=int, help="Slave UID, default: 255",
+                        default=__DEFAULT_DEVICE_UNIT_ID__, required=False)
+    parser.add_argument('--device_uid_split', dest='uid_split', type=int, help="Split device slave UID, default: 255",
+                        default=__DEFAULT_DEVICE_UNIT_ID__, required=False)
+    parser.add_argument('--device_timeout', dest='timeout', type=float, help="Response timeout in seconds, default: 2",
+                        default=__DEFAULT_DEVICE_TIMEOUT__, required=False)
+    parser.add_argument('--device_timeout_split', dest='timeout_split', type=float,
+                        help="Split device response timeout in seconds, default: device timeout", default=None,
                         required=False)
     parser.add_argument('--config', dest='config', type=str,
                         help="Path to configuration file, default: config/config.yaml",
                         default="config/config.yaml", required=False)
-    parser.add_argument('--output', dest='output', type=str, help="file, pdf, dump, db", default="dump", required=False)
+    parser.add_argument('--pipeline_depth', dest='depth', type=int,
+                        help="Requests in flight per connection, default: pipeline_depth from config or 1",
+                        default=None, required=False)
+    parser.add_argument('--single_writes', dest='single_writes', action='store_true',
+                        help="Device quirk, write sequences register by register (FC6) instead of block writes (FC16)",
+                        required=False)
+    parser.add_argument('--cycles', dest='cycles', type=int, help="Endurance test cycles, default: 100",
+                        default=100, required=False)
+    parser.add_argument('--duration', dest='duration', type=float,
+                        help="Monitor run time in seconds, default: until interrupted", default=None, required=False)
+    parser.add_argument('--stream', dest='stream', type=str,
+                        help="Append results to NDJSON log while testing, .mbd file stores only changed values "
+                             "(deadband) delta encoded", default=None, required=False)
+    parser.add_argument('--replay', dest='replay', type=str,
+                        help="Create output from NDJSON log or saved .json/.mbr/.mbd results instead of testing",
+                        default=None, required=False)
+    parser.add_argument('--replay_test_id', dest='replay_test_id', type=str,
+                        help="TestID to replay, default: last test in the log", default=None, required=False)
+    parser.add_argument('--output', dest='output', type=str, help="json, binary, pdf, dump, db", default="dump",
+                        required=False)
+    parser.add_argument('--plan_cache', dest='plan_cache', type=str,
+                        help="Compiled test plan cache directory, empty disables cache, default: " +
+                             __PLAN_CACHE_DIR__, default=__PLAN_CACHE_DIR__, required=False)
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
-    # Loading test settings
-    load_test_configuration(args.config)
-
-    if connection_test(args.address, args.port):
+    if not args.address and not args.replay:
+        parser.error("the following arguments are required: --device_address")
+    start_metrics(args)
+    # Loading compiled test plan, results are kept apart from the immutable plan
+    plan = load_test_configuration(args.config, {'single_writes': True} if args.single_writes else None,
+                                   args.plan_cache)
+    results.update({"Device": {"name": args.address, "address": args.address, "port": args.port,
+                               "unit_id": args.uid}})
+    sink = None
+
+    if args.replay:
+        # Saved results (.json, .mbr, .mbd) or NDJSON stream log
+        results = load_results(args.replay) if args.replay.endswith((".json", ".mbr", ".mbd")) else replay_results(
+            args.replay, args.replay_test_id)
+        if args.stream:
+            print("-> Replayed results are not streamed, --stream ignored")
+    else:
+        # Streaming sink, results are written as they are captured
+        if args.stream:
+            sink = open_sink(args.stream, plan.deadband_max_silence)
+            sink.test(results['TestID'], results['TestTime'], plan.readings_sequence())
+        # Single connection to the device is shared by all tests
+        connection = device_connection(args.address, args.port, args.uid, args.depth or plan.pipeline_depth,
+                                       args.timeout)
+        # Readings are evaluated as they arrive, only aggregates are kept for the verdict
+        evaluator = Evaluator(plan.readings_sequence()) if args.mode != "endurance" else None
         match args.mode:
             # If full then run all the tests
             case "full":
-                connection = device_connection(args.address, args.port)
-                results.update({"ControlTest": remote_control_test(connection)})
+                run_test(results, "ControlTest", remote_control_test, connection, plan)
+                emit_section(sink, results, "ControlTest")
                 sleep(__WRITE_TIMEOUT__)
-                results.update({"ReadInfoTest": device_information_read_test(connection)})
+                run_test(results, "ReadInfoTest", device_information_read_test, connection, plan)
+                emit_section(sink, results, "ReadInfoTest")
                 sleep(__WRITE_TIMEOUT__)
-                results.update({"ReadValuesTest": device_measurement_read_test(connection)})
+                run_test(results, "ReadValuesTest", device_measurement_read_test, connection, plan, sink, evaluator)
             # If split then run only remote control on first device, other tests on split device
             case "split":
-                connection = device_connection(args.address, args.port)
-                results.update({"ControlTest": remote_control_test(connection)})
+                run_test(results, "ControlTest", remote_control_test, connection, plan)
+                emit_section(sink, results, "ControlTest")
                 sleep(__WRITE_TIMEOUT__)
-                if connection_test(args.address_split, args.port_split):
-                    results.update({"ReadInfoTest": device_information_read_test(connection)})
+                # Split device behind the same gateway is another unit ID on the shared connection
+                split_address = args.address_split or args.address
+                split_connection = unit_connection(split_address, args.port_split, args.uid_split,
+                                                   args.depth or plan.pipeline_depth,
+                                                   args.timeout_split or args.timeout, connection)
+                if split_connection.open():
+                    print("Connection successful! Starting tests:")
+                    results.update({"SplitDevice": {"name": split_address, "address": split_address,
+                                                    "port": args.port_split, "unit_id": args.uid_split}})
+                    run_test(results, "ReadInfoTest", device_information_read_test, split_connection, plan)
+                    emit_section(sink, results, "ReadInfoTest")
                     sleep(__WRITE_TIMEOUT__)
-                    results.update({"ReadValuesTest": device_measurement_read_test(connection)})
-
-    match args.output:
-        case "json":
-            generate_test_report_json(results, __TEST_CONFIGURATION__['config'])
-        case "dump":
-            print(results)
-        case "pdf":
-            generate_test_report_html(results, __TEST_CONFIGURATION__['config'])
-        case "db":
-            write_test_results_2_db(results, __TEST_CONFIGURATION__['config']['db'])
+                    run_test(results, "ReadValuesTest", device_measurement_read_test, split_connection, plan, sink,
+                             evaluator)
+                    split_connection.close()
+            # If monitor then poll measurement blocks at configured rates
+            case "monitor":
+                run_test(results, "MonitorTest", device_monitor_test, connection, plan, args.duration, sink,
+                         evaluator)
+                emit_section(sink, results, "MonitorTest")
+            # If endurance then cycle breaker and report actuation latency histograms
+            case "endurance":
+                run_test(results, "EnduranceTest", device_endurance_test, connection, plan, args.cycles, sink)
+                emit_section(sink, results, "EnduranceTest")
+        connection.close()
+        results.update({"Evaluation": evaluate_results(results, evaluator, plan.pass_score)})
+        emit_section(sink, results, "Evaluation")
+        print("-> Test score: " + str(results['Evaluation']['score']) + " " + results['Evaluation']['verdict'])
+    if sink:
+        sink.close()
+        if isinstance(sink, DeltaSink):
+            stored = sink.statistics()
+            print("-> Stream saved: " + args.stream + ", " + str(stored['changes']) + " of " + str(stored['samples']) +
+                  " values stored")
+
+    if ("MonitorTest" in results or "EnduranceTest" in results) and args.output in ("pdf", "db", "binary"):
+        print("Monitor and endurance results support dump and json output only.")
+        export_metrics(args)
+        return
+    write_output(results, args.output, plan.output_config())
+    export_metrics(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,463 @@
+#!/usr/bin/python3.10
+"""
+Persistent Modbus TCP transport, one long-lived connection per device with keepalive, reconnect and health check
+"""
+import itertools
+import json
+import os
+import select
+import socket
+from time import monotonic, perf_counter_ns, sleep, time
+import modbus_frames as frames
+from metrics import METRICS
+
+__DEFAULT_TIMEOUT__ = 2
+# Reconnect attempts and exponential backoff in seconds
+__RECONNECT_ATTEMPTS__ = 4
+__RECONNECT_BACKOFF__ = 0.2
+__RECONNECT_BACKOFF_MAX__ = 5.0
+# Idle time after which socket is checked before next request
+__HEALTH_CHECK_INTERVAL__ = 5.0
+# TCP keepalive idle time, interval and probe count
+__KEEPALIVE__ = (30, 10, 3)
+# Default count of pipelined requests in flight
+__PIPELINE_DEPTH__ = 1
+# Device identity cache
+__IDENTITY_CACHE_FILE__ = "dumps/identity_cache.json"
+__IDENTITY_TTL__ = 86400
+
+
+class ModbusTransport:
+    """
+    Synchronous Modbus TCP client owning single socket, API compatible with pyModbusTCP ModbusClient
+    (read/write methods return None on error)
+    """
+
+    def __init__(self, host: str, port: int = 502, unit_id: int = 255, timeout: float = __DEFAULT_TIMEOUT__,
+                 attempts: int = __RECONNECT_ATTEMPTS__, backoff: float = __RECONNECT_BACKOFF__,
+                 depth: int = __PIPELINE_DEPTH__):
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+        self.timeout = timeout
+        # Max requests in flight on the connection, 1 for devices handling one request at a time
+        self.depth = max(1, depth)
+        self.attempts = attempts
+        self.backoff = backoff
+        self.sock = None
+        self.last_used = 0.0
+        self.connects = 0
+        self.transaction_ids = itertools.cycle(range(1, 65536))
+        self.device_labels = (('device', host + ":" + str(port) + "/" + str(unit_id)),)
+        # Connection shared by units of a gateway, timeout of one unit keeps it open
+        self.shared = False
+        # Timeout in the middle of a response frame, rest of the frame would be parsed as next response
+        self.unaligned = False
+
+    @property
+    def is_open(self) -> bool:
+        """
+        :return: True if connection is open
+        """
+        return self.sock is not None
+
+    def open(self) -> bool:
+        """
+        Opens TCP connection, retries with exponential backoff
+        :return: Status of connection
+        """
+        if self.sock is not None:
+            return True
+        delay = self.backoff
+        for attempt in range(self.attempts):
+            try:
+                self.sock = socket.create_connection((self.host, self.port), self.timeout)
+            except OSError:
+                if attempt + 1 < self.attempts:
+                    sleep(delay)
+                    delay = min(delay * 2, __RECONNECT_BACKOFF_MAX__)
+                continue
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # Keepalive tuning is Linux only
+            for option, value in zip(('TCP_KEEPIDLE', 'TCP_KEEPINTVL', 'TCP_KEEPCNT'), __KEEPALIVE__):
+                if hasattr(socket, option):
+                    self.sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+            if self.connects:
+                METRICS.inc('modbus_reconnects', self.device_labels)
+            self.connects += 1
+            self.last_used = monotonic()
+            return True
+        METRICS.inc('modbus_connect_failures', self.device_labels)
+        return False
+
+    def close(self) -> None:
+        """
+        Closes connection
+        :return: None
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.unaligned = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def check_health(self) -> bool:
+        """
+        Detects connection closed by the device (e.g. gateway idle timeout) without sending request
+        :return: True if connection is usable
+        """
+        if self.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            # Readable idle socket is either closed by peer or holds stale data of timed out request
+            if readable and not self.sock.recv(1024, socket.MSG_PEEK):
+                self.close()
+                return False
+        except OSError:
+            self.close()
+            return False
+        return True
+
+    def request_labels(self, pdu: bytes) -> tuple:
+        """
+        :param pdu: Request PDU
+        :return: Metric labels of device, function code and register block
+        """
+        function_code, address = frames.describe_request(pdu)
+        return self.device_labels + (('function', str(function_code)), ('block', str(address)))
+
+    def record(self, pdu: bytes, response: bytes, start_ns: int) -> None:
+        """
+        Records request latency, bytes and exception code
+        :param pdu: Request PDU
+        :param response: Response PDU
+        :param start_ns: perf_counter_ns() when request was sent
+        :return: None
+        """
+        if not METRICS.enabled:
+            return
+        labels = self.request_labels(pdu)
+        METRICS.observe('modbus_request', labels, (perf_counter_ns() - start_ns) / 1e6)
+        METRICS.inc('modbus_bytes_sent', self.device_labels, frames.__MBAP_HEADER_SIZE__ + len(pdu))
+        METRICS.inc('modbus_bytes_received', self.device_labels, frames.__MBAP_HEADER_SIZE__ + len(response))
+        if response[0] & 0x80:
+            METRICS.inc('modbus_exceptions', labels + (('code', str(response[1])),))
+
+    def _receive(self, size: int) -> bytes:
+        """
+        Reads exactly size bytes
+        :param size: Count of bytes
+        :return: Data
+        """
+        data = b''
+        while len(data) < size:
+            try:
+                chunk = self.sock.recv(size - len(data))
+            except socket.timeout:
+                self.unaligned = self.unaligned or bool(data)
+                raise
+            if not chunk:
+                raise ConnectionError("Connection closed by device")
+            data += chunk
+        return data
+
+    def _receive_frame(self) -> tuple:
+        """
+        Reads one response frame, timeout after part of the frame was read marks the stream unaligned
+        :return: (transaction ID, response PDU)
+        """
+        response_id, _, length = frames.decode_header(self._receive(frames.__MBAP_HEADER_SIZE__))
+        try:
+            return response_id, self._receive(length)
+        except socket.timeout:
+            self.unaligned = True
+            raise
+
+    def unit(self, unit_id: int, timeout: float = None) -> 'UnitTransport':
+        """
+        Transport of another unit ID behind the same gateway, requests are sent over this connection
+        :param unit_id: Slave unit ID
+        :param timeout: Response timeout of the unit, default timeout of this transport
+        :return: Unit transport
+        """
+        self.shared = True
+        return UnitTransport(self, unit_id, timeout)
+
+    def _transact(self, pdu: bytes, unit_id: int) -> bytes:
+        """
+        Sends request and returns response PDU with matching transaction ID, stale responses are dropped
+        :param pdu: Request PDU
+        :param unit_id: Slave unit ID
+        :return: Response PDU
+        """
+        transaction_id = next(self.transaction_ids)
+        self.sock.sendall(frames.encode_frame(transaction_id, unit_id, pdu))
+        while True:
+            response_id, response = self._receive_frame()
+            if response_id == transaction_id:
+                return response
+
+    def execute(self, pdu: bytes, unit_id: int = None, timeout: float = None):
+        """
+        Sends request, connection is reopened and request repeated once if it was lost
+        :param pdu: Request PDU
+        :param unit_id: Slave unit ID, default unit of this transport
+        :param timeout: Response timeout, default timeout of this transport
+        :return: Decoded response, None on error
+        """
+        if self.sock is not None and monotonic() - self.last_used > __HEALTH_CHECK_INTERVAL__:
+            self.check_health()
+        for attempt in range(2):
+            if not self.open():
+                return None
+            if attempt:
+                METRICS.inc('modbus_retries', self.device_labels)
+            try:
+                self.sock.settimeout(timeout or self.timeout)
+                start_ns = perf_counter_ns()
+                response = self._transact(pdu, self.unit_id if unit_id is None else unit_id)
+                self.last_used = monotonic()
+                self.record(pdu, response, start_ns)
+                return frames.decode_response(response)
+            except frames.ModbusExceptionResponse:
+                return None
+            except socket.timeout:
+                METRICS.inc('modbus_timeouts', self.device_labels)
+                # Late response would be matched to next request, socket is replaced. Shared gateway connection
+                # stays open, late responses are dropped by transaction ID, unless part of a frame was read.
+                if not self.shared or self.unaligned:
+                    self.close()
+                return None
+            except OSError:
+                self.close()
+        return None
+
+    def _pipeline(self, pdus: list, results: list, pending: list, unit_id: int) -> None:
+        """
+        Sends pending requests keeping up to depth of them in flight, responses are matched by transaction ID
+        in any order. Requests in flight fail on timeout, unsent requests stay in pending.
+        :param pdus: Request PDUs
+        :param results: Decoded responses by request index
+        :param pending: Indexes of requests still to be sent, updated in place
+        :param unit_id: Slave unit ID
+        :return: None
+        """
+        in_flight = {}
+        while pending or in_flight:
+            while pending and len(in_flight) < self.depth:
+                index = pending.pop(0)
+                transaction_id = next(self.transaction_ids)
+                in_flight[transaction_id] = (index, perf_counter_ns())
+                self.sock.sendall(frames.encode_frame(transaction_id, unit_id, pdus[index]))
+            try:
+                response_id, response = self._receive_frame()
+            except socket.timeout:
+                # Nothing arrived within timeout, requests in flight failed, socket is replaced unless shared
+                # and aligned on frame boundary
+                METRICS.inc('modbus_timeouts', self.device_labels, len(in_flight))
+                if not self.shared or self.unaligned:
+                    self.close()
+                return
+            except OSError:
+                # Requests in flight are repeated after reconnect
+                pending[:0] = sorted(index for index, _ in in_flight.values())
+                METRICS.inc('modbus_retries', self.device_labels, len(in_flight))
+                raise
+            # Responses of unknown transaction IDs (late answers of timed out requests) are dropped
+            index, start_ns = in_flight.pop(response_id, (None, 0))
+            if index is not None:
+                self.record(pdus[index], response, start_ns)
+                try:
+                    results[index] = frames.decode_response(response)
+                except frames.ModbusExceptionResponse:
+                    results[index] = None
+
+    def execute_many(self, pdus: list, unit_id: int = None, timeout: float = None) -> list:
+        """
+        Executes requests pipelined on one connection, up to depth requests in flight
+        :param pdus: Request PDUs
+        :param unit_id: Slave unit ID, default unit of this transport
+        :param timeout: Response timeout, default timeout of this transport
+        :return: Decoded responses in request order, None for failed requests
+        """
+        if self.sock is not None and monotonic() - self.last_used > __HEALTH_CHECK_INTERVAL__:
+            self.check_health()
+        results = [None] * len(pdus)
+        pending = list(range(len(pdus)))
+        for _ in range(2):
+            if not pending or not self.open():
+                break
+            try:
+                self.sock.settimeout(timeout or self.timeout)
+                self._pipeline(pdus, results, pending, self.unit_id if unit_id is None else unit_id)
+                self.last_used = monotonic()
+            except OSError:
+                self.close()
+        return results
+
+    def read_blocks(self, blocks: list) -> list:
+        """
+        Pipelined FC3 reads
+        :param blocks: (address, count) pairs
+        :return: Registers or None per block
+        """
+        return self.execute_many([frames.read_holding_registers_pdu(address, count) for address, count in blocks])
+
+    def read_holding_registers(self, address: int, count: int = 1) -> list:
+        """
+        FC3 read
+        :param address: Start register
+        :param count: Count of registers
+        :return: Registers or None
+        """
+        return self.execute(frames.read_holding_registers_pdu(address, count))
+
+    def write_single_register(self, address: int, value: int) -> bool:
+        """
+        FC6 write
+        :param address: Register address
+        :param value: Register value
+        :return: Status of write or None
+        """
+        return self.execute(frames.write_single_register_pdu(address, value))
+
+    def write_multiple_registers(self, address: int, values: list) -> bool:
+        """
+        FC16 write
+        :param address: Start register
+        :param values: Register values
+        :return: Status of write or None
+        """
+        return self.execute(frames.write_multiple_registers_pdu(address, values))
+
+    def read_device_identification(self) -> list:
+        """
+        FC43/14 basic device identification (MEI ReadDeviceInformationRequest)
+        :return: [vendor, product code, revision] or None
+        """
+        information = self.execute(frames.read_device_information_pdu())
+        if information is None:
+            return None
+        return [value.decode('ascii', 'replace') for _, value in sorted(information.items())]
+
+
+class UnitTransport(ModbusTransport):
+    """
+    Unit ID behind a Modbus TCP gateway (e.g. TCP-to-serial), requests go over the connection of the gateway
+    transport so many units need one TCP connection. Closing the unit keeps the shared connection open.
+    """
+
+    def __init__(self, gateway: ModbusTransport, unit_id: int, timeout: float = None):
+        super().__init__(gateway.host, gateway.port, unit_id, timeout or gateway.timeout, gateway.attempts,
+                         gateway.backoff, gateway.depth)
+        self.gateway = gateway
+
+    @property
+    def is_open(self) -> bool:
+        """
+        :return: True if shared connection is open
+        """
+        return self.gateway.is_open
+
+    def open(self) -> bool:
+        """
+        :return: Status of shared connection
+        """
+        return self.gateway.open()
+
+    def close(self) -> None:
+        """
+        Shared connection is closed by the gateway transport
+        :return: None
+        """
+
+    def check_health(self) -> bool:
+        """
+        :return: True if shared connection is usable
+        """
+        return self.gateway.check_health()
+
+    def execute(self, pdu: bytes, unit_id: int = None, timeout: float = None):
+        """
+        :param pdu: Request PDU
+        :param unit_id: Slave unit ID, default unit of this transport
+        :param timeout: Response timeout, default timeout of the unit
+        :return: Decoded response, None on error
+        """
+        return self.gateway.execute(pdu, self.unit_id if unit_id is None else unit_id, timeout or self.timeout)
+
+    def execute_many(self, pdus: list, unit_id: int = None, timeout: float = None) -> list:
+        """
+        :param pdus: Request PDUs
+        :param unit_id: Slave unit ID, default unit of this transport
+        :param timeout: Response timeout, default timeout of the unit
+        :return: Decoded responses in request order, None for failed requests
+        """
+        return self.gateway.execute_many(pdus, self.unit_id if unit_id is None else unit_id,
+                                         timeout or self.timeout)
+
+
+class IdentityCache:
+    """
+    Device identity cached on disk with TTL, keyed by host:port:unit_id
+    """
+
+    def __init__(self, path: str = __IDENTITY_CACHE_FILE__, ttl: float = __IDENTITY_TTL__):
+        self.path = path
+        self.ttl = ttl
+        self.entries = self.load()
+
+    def load(self) -> dict:
+        """
+        :return: Entries stored on disk
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def key(transport: ModbusTransport) -> str:
+        """
+        :param transport: Connection object
+        :return: Cache key of the device
+        """
+        return transport.host + ":" + str(transport.port) + ":" + str(transport.unit_id)
+
+    def get(self, transport: ModbusTransport) -> list:
+        """
+        :param transport: Connection object
+        :return: Cached identity or None if missing or expired
+        """
+        entry = self.entries.get(self.key(transport))
+        if entry is None or time() - entry['time'] > self.ttl:
+            return None
+        return entry['identity']
+
+    def put(self, transport: ModbusTransport, identity: list) -> None:
+        """
+        Stores identity, file is replaced atomically
+        :param transport: Connection object
+        :param identity: Device identity
+        :return: None
+        """
+        # Merged with entries stored meanwhile by other devices of the fleet
+        self.entries = dict(self.load(), **{self.key(transport): {'time': time(), 'identity': identity}})
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Temporary file per process, fleet workers share the cache
+        temporary = self.path + "." + str(os.getpid()) + ".tmp"
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump(self.entries, file)
+        os.replace(temporary, self.path)
+
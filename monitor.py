@@ -0,0 +1,132 @@
+#!/usr/bin/python3.10
+"""
+Continuous polling of measurement blocks at per-block target rates (deadline scheduling)
+"""
+import heapq
+from time import monotonic, sleep
+from decoding import compile_decoders
+from metrics import METRICS
+
+# Default target rate of entries without poll_rate_hz
+__DEFAULT_POLL_RATE__ = 1.0
+# Interval of progress prints
+__MONITOR_REPORT_INTERVAL__ = 10
+
+
+class PollSchedule:
+    """
+    Block read polled with fixed period, keeps deadline, latency and jitter statistics
+    """
+    __slots__ = ('block', 'period', 'deadline', 'samples', 'missed', 'errors', 'jitter_sum', 'jitter_max',
+                 'latency_sum', 'latency_max')
+
+    def __init__(self, block, rate: float, start: float):
+        self.block = block
+        self.period = 1.0 / rate
+        self.deadline = start
+        self.samples, self.missed, self.errors = 0, 0, 0
+        self.jitter_sum, self.jitter_max = 0.0, 0.0
+        self.latency_sum, self.latency_max = 0.0, 0.0
+
+    def record(self, started: float, finished: float, success: bool) -> None:
+        """
+        Records finished read and moves deadline to next period, overrun periods are counted as missed
+        :param started: Monotonic time the read was sent
+        :param finished: Monotonic time the read returned
+        :param success: Status of read
+        :return: None
+        """
+        jitter, latency = started - self.deadline, finished - started
+        self.samples += 1
+        self.errors += 0 if success else 1
+        self.jitter_sum += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.deadline += self.period
+        # Skips deadlines which already passed instead of bursting to catch up
+        if finished > self.deadline:
+            overrun = int((finished - self.deadline) / self.period) + 1
+            self.missed += overrun
+            self.deadline += overrun * self.period
+
+    def statistics(self) -> dict:
+        """
+        :return: Statistics of the schedule
+        """
+        samples = self.samples or 1
+        return {'rate_hz': round(1.0 / self.period, 3), 'address_dec': self.block.address_dec,
+                'count': self.block.count, 'members': [member for member, _ in self.block.members],
+                'samples': self.samples, 'missed': self.missed, 'errors': self.errors,
+                'jitter_avg_ms': round(self.jitter_sum / samples * 1000, 3),
+                'jitter_max_ms': round(self.jitter_max * 1000, 3),
+                'latency_avg_ms': round(self.latency_sum / samples * 1000, 3),
+                'latency_max_ms': round(self.latency_max * 1000, 3)}
+
+
+def group_by_rate(readings_sequence: dict) -> dict:
+    """
+    Groups entries by target rate (poll_rate_hz key)
+    :param readings_sequence: test_readings_sequence section of the config
+    :return: {rate: {measurement_type: entry}} fastest rate first
+    """
+    groups = {}
+    for measurement_type, entry in readings_sequence.items():
+        groups.setdefault(float(entry.get('poll_rate_hz', __DEFAULT_POLL_RATE__)), {})[measurement_type] = entry
+    return dict(sorted(groups.items(), reverse=True))
+
+
+def run_monitor(modbus_connection, readings_sequence: dict, schedules: list, duration: float = None,
+                on_sample=None) -> list:
+    """
+    Polls schedules until duration elapses or until interrupted
+    :param modbus_connection: Connection object
+    :param readings_sequence: test_readings_sequence section of the config
+    :param schedules: List of PollSchedule
+    :param duration: Run time in seconds, None runs until interrupted
+    :param on_sample: Optional callback(measurement_type, decoded reading, monotonic timestamp)
+    :return: Statistics per schedule
+    """
+    decoders = compile_decoders(readings_sequence)
+    queue = [(schedule.deadline, index) for index, schedule in enumerate(schedules)]
+    heapq.heapify(queue)
+    start = monotonic()
+    next_report = start + __MONITOR_REPORT_INTERVAL__
+    try:
+        while queue and (duration is None or monotonic() - start < duration):
+            deadline, index = heapq.heappop(queue)
+            delay = deadline - monotonic()
+            if delay > 0:
+                sleep(delay)
+            # Blocks due at the same time are read in one pipelined batch
+            due = [index]
+            while queue and queue[0][0] <= monotonic():
+                due.append(heapq.heappop(queue)[1])
+            started = monotonic()
+            readings = modbus_connection.read_blocks([(schedules[index].block.address_dec,
+                                                       schedules[index].block.count) for index in due])
+            finished = monotonic()
+            for index, data in zip(due, readings):
+                schedule = schedules[index]
+                if METRICS.enabled:
+                    labels = getattr(modbus_connection, 'device_labels', ()) + (
+                        ('block', str(schedule.block.address_dec)),)
+                    missed = schedule.missed
+                    METRICS.observe('monitor_jitter', labels, (started - schedule.deadline) * 1000)
+                schedule.record(started, finished, bool(data))
+                if METRICS.enabled:
+                    METRICS.inc('monitor_samples', labels)
+                    METRICS.inc('monitor_missed_deadlines', labels, schedule.missed - missed)
+                if data and on_sample:
+                    for measurement_type, (offset, count) in schedule.block.members:
+                        on_sample(measurement_type, decoders[measurement_type].decode(data[offset:offset + count]),
+                                  started)
+                heapq.heappush(queue, (schedule.deadline, index))
+            if finished >= next_report:
+                print("   " + str(round(finished - start)) + "s: " + ", ".join(
+                    str(item.samples) + "/" + str(item.missed) + " @" + str(round(1.0 / item.period, 3)) + "Hz"
+                    for item in schedules) + " (samples/missed)")
+                next_report += __MONITOR_REPORT_INTERVAL__
+    except KeyboardInterrupt:
+        print("   Monitor stopped.")
+    return [schedule.statistics() for schedule in schedules]
@@ -0,0 +1,144 @@
+#!/usr/bin/python3.10
+"""
+Columnar time-series store for measurement probes
+"""
+from array import array
+from collections.abc import Mapping
+from time import monotonic, time
+from decoding import compile_decoders
+from test_plan import ReadBlock
+
+
+class ProbeBuffer:
+    """
+    Preallocated uint16 register matrix [probe][register] of one planned block read
+    """
+    __slots__ = ('address_dec', 'count', 'members', 'registers', 'timestamps', 'valid')
+
+    def __init__(self, block: ReadBlock, probe_count: int):
+        self.address_dec = block.address_dec
+        self.count = block.count
+        self.members = dict(block.members)
+        self.registers = array('H', bytes(2 * self.count * probe_count))
+        self.timestamps = array('d', bytes(8 * probe_count))
+        self.valid = array('B', bytes(probe_count))
+
+    def store(self, probe: int, values: list, timestamp: float) -> None:
+        """
+        Stores registers of one probe
+        :param probe: Probe number
+        :param values: Raw register values, empty if read failed
+        :param timestamp: Monotonic timestamp of the read
+        :return: None
+        """
+        self.timestamps[probe] = timestamp
+        if len(values) == self.count:
+            self.registers[probe * self.count:(probe + 1) * self.count] = array('H', values)
+            self.valid[probe] = 1
+
+    def reading(self, probe: int, measurement_type: str) -> array:
+        """
+        :param probe: Probe number
+        :param measurement_type: Member of the block
+        :return: Raw registers of measurement type in given probe, empty if read failed
+        """
+        if not self.valid[probe]:
+            return array('H')
+        offset, count = self.members[measurement_type]
+        start = probe * self.count + offset
+        return self.registers[start:start + count]
+
+
+class ProbeView(Mapping):
+    """
+    Lazy per-probe projection {measurement_type: config entry with decoded reading}
+    """
+    __slots__ = ('store', 'probe')
+
+    def __init__(self, store: 'ProbeStore', probe: int):
+        self.store = store
+        self.probe = probe
+
+    def __getitem__(self, measurement_type: str) -> dict:
+        entry = dict(self.store.sequence[measurement_type])
+        entry['reading'] = self.store.decoders[measurement_type].decode(
+            self.store.buffers[self.store.block_of[measurement_type]].reading(self.probe, measurement_type))
+        return entry
+
+    def __iter__(self):
+        return iter(self.store.sequence)
+
+    def __len__(self) -> int:
+        return len(self.store.sequence)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class ProbeStore(Mapping):
+    """
+    Probe results of one measurement test, {str(probe): ProbeView} as returned by device_measurement_read_test
+    """
+
+    def __init__(self, sequence: dict, read_plan: list, probe_count: int):
+        self.sequence = sequence
+        self.buffers = [ProbeBuffer(block, probe_count) for block in read_plan]
+        self.block_of = {measurement_type: index for index, block in enumerate(read_plan)
+                         for measurement_type, _ in block.members}
+        self.decoders = compile_decoders(sequence)
+        self.probe_count = probe_count
+        self.captured = 0
+        # Offset of monotonic clock to wall clock, for timestamps written to reports and DB
+        self.epoch_offset = time() - monotonic()
+
+    def store(self, probe: int, block_readings: list, timestamp: float = None) -> None:
+        """
+        Stores raw registers of all planned blocks of one probe
+        :param probe: Probe number
+        :param block_readings: Registers per planned block, empty list if block read failed
+        :param timestamp: Monotonic timestamp, default now
+        :return: None
+        """
+        timestamp = monotonic() if timestamp is None else timestamp
+        for buffer, values in zip(self.buffers, block_readings):
+            buffer.store(probe, values, timestamp)
+        self.captured = max(self.captured, probe + 1)
+
+    def timestamp(self, probe: int) -> float:
+        """
+        :param probe: Probe number
+        :return: Monotonic timestamp of the probe
+        """
+        return self.buffers[0].timestamps[probe] if self.buffers else 0.0
+
+    def wall_time(self, probe: int) -> float:
+        """
+        :param probe: Probe number
+        :return: Wall clock timestamp (seconds since epoch) of the probe
+        """
+        return self.timestamp(probe) + self.epoch_offset
+
+    def __getstate__(self) -> dict:
+        # Pickled with raw register buffers only (process pool IPC), decoders hold struct objects
+        state = dict(self.__dict__)
+        del state['decoders']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.decoders = compile_decoders(self.sequence)
+
+    def __getitem__(self, probe: str) -> ProbeView:
+        index = int(probe) if str(probe).isdigit() else -1
+        if not 0 <= index < self.captured:
+            raise KeyError(probe)
+        return ProbeView(self, index)
+
+    def __iter__(self):
+        return (str(probe) for probe in range(self.captured))
+
+    def __len__(self) -> int:
+        return self.captured
+
+    def __repr__(self) -> str:
+        return repr({probe: dict(view) for probe, view in self.items()})
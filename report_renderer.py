@@ -0,0 +1,118 @@
+#!/usr/bin/python3.10
+"""
+Compiled single-pass template renderer for HTML reports.
+Syntax: {{ name }} or {{ name.key.0 }} slot (HTML escaped), {% for item in name %} ... {% endfor %} loop.
+"""
+import html
+import os
+import re
+
+__TOKEN__ = re.compile(r'\{\{\s*([\w.-]+)\s*\}\}|\{%\s*for\s+(\w+)\s+in\s+([\w.-]+)\s*%\}|\{%\s*endfor\s*%\}')
+# Compiled templates by path, invalidated by file modification time
+__TEMPLATE_CACHE__ = {}
+
+
+class TemplateSyntaxError(Exception):
+    """
+    Unbalanced loop tags in template
+    """
+
+
+def compile_template(text: str) -> list:
+    """
+    Compiles template into nodes: literal str, ('slot', path) and ('loop', name, path, nodes)
+    :param text: Template source
+    :return: List of nodes
+    """
+    stack = [[]]
+    loops = []
+    position = 0
+    for match in __TOKEN__.finditer(text):
+        if match.start() > position:
+            stack[-1].append(text[position:match.start()])
+        position = match.end()
+        if match.group(1):
+            stack[-1].append(('slot', tuple(match.group(1).split('.'))))
+        elif match.group(2):
+            loops.append((match.group(2), tuple(match.group(3).split('.'))))
+            stack.append([])
+        else:
+            if not loops:
+                raise TemplateSyntaxError("endfor without for at position " + str(match.start()))
+            body = stack.pop()
+            name, path = loops.pop()
+            stack[-1].append(('loop', name, path, body))
+    if loops:
+        raise TemplateSyntaxError("for " + loops[-1][0] + " is not closed")
+    if position < len(text):
+        stack[-1].append(text[position:])
+    return stack[0]
+
+
+def load_template(path: str) -> list:
+    """
+    Returns compiled template, file is read and compiled only when it changes
+    :param path: Path to template file
+    :return: List of nodes
+    """
+    modified = os.path.getmtime(path)
+    cached = __TEMPLATE_CACHE__.get(path)
+    if cached is None or cached[0] != modified:
+        with open(path, 'r', encoding='utf-8') as file:
+            cached = (modified, compile_template(file.read()))
+        __TEMPLATE_CACHE__[path] = cached
+    return cached[1]
+
+
+def lookup(scopes: list, path: tuple):
+    """
+    Resolves dotted path, innermost loop variable first
+    :param scopes: Context dicts, innermost last
+    :param path: Path parts
+    :return: Value, empty string if not found
+    """
+    for scope in reversed(scopes):
+        if path[0] in scope:
+            value = scope[path[0]]
+            break
+    else:
+        return ""
+    for part in path[1:]:
+        try:
+            value = value[int(part)] if isinstance(value, (list, tuple)) else value[part]
+        except (KeyError, IndexError, ValueError, TypeError):
+            return ""
+    return value
+
+
+def render_nodes(nodes: list, scopes: list, parts: list) -> None:
+    """
+    Appends rendered nodes to parts
+    :param nodes: Compiled nodes
+    :param scopes: Context dicts
+    :param parts: Output fragments
+    :return: None
+    """
+    for node in nodes:
+        if node.__class__ is str:
+            parts.append(node)
+        elif node[0] == 'slot':
+            parts.append(html.escape(str(lookup(scopes, node[1]))))
+        else:
+            _, name, path, body = node
+            for item in lookup(scopes, path) or ():
+                scopes.append({name: item})
+                render_nodes(body, scopes, parts)
+                scopes.pop()
+
+
+def render(nodes: list, context: dict) -> str:
+    """
+    Renders compiled template in one pass
+    :param nodes: Compiled nodes
+    :param context: Template values
+    :return: Rendered text
+    """
+    parts = []
+    render_nodes(nodes, [context], parts)
+    return ''.join(parts)
@@ -0,0 +1,509 @@
+#!/usr/bin/python3.10
+"""
+Result serialization: streaming JSON, struct-packed columnar binary format with memory-mapped loader and
+delta/run-length encoded series format for long monitoring runs
+"""
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Mapping
+from decoding import BlockDecoder
+
+# Binary format: magic, version, reserved, header length, JSON header, 8 byte aligned float64 little endian columns
+__BINARY_MAGIC__ = b'MBRS'
+__BINARY_VERSION__ = 1
+__BINARY_PREFIX__ = struct.Struct('<4sHHI')
+__JSON_ENCODER__ = json.JSONEncoder(allow_nan=False, separators=(', ', ': '))
+# Delta format: magic, version, reserved, header length (0), then appended chunks of kind and payload length,
+# JSON records (test, section, probes, events) and series blocks (JSON block header, varint streams)
+__DELTA_MAGIC__ = b'MBDS'
+__DELTA_VERSION__ = 2
+__DELTA_CHUNK__ = struct.Struct('<BI')
+__DELTA_RECORD__ = 1
+__DELTA_BLOCK__ = 2
+__DELTA_BLOCK_HEADER__ = struct.Struct('<I')
+__FLOAT_BITS__ = (struct.Struct('<d'), struct.Struct('<q'))
+
+
+def sanitize(value):
+    """
+    Converts value to JSON compatible types, NaN becomes null
+    :param value: Value
+    :return: JSON compatible value
+    """
+    if isinstance(value, float):
+        return None if math.isnan(value) else value
+    if isinstance(value, Mapping):
+        return {str(key): sanitize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, array)):
+        return [sanitize(item) for item in value]
+    return value
+
+
+def iter_json(value):
+    """
+    Encodes results incrementally, mappings (probe stores) are walked key by key so whole document is never built
+    :param value: Results or part of results
+    :return: Iterator of JSON text chunks
+    """
+    if isinstance(value, Mapping):
+        yield "{"
+        for index, (key, item) in enumerate(value.items()):
+            yield (", " if index else "") + __JSON_ENCODER__.encode(str(key)) + ": "
+            yield from iter_json(item)
+        yield "}"
+    else:
+        yield __JSON_ENCODER__.encode(sanitize(value))
+
+
+def write_json(results: dict, path: str) -> None:
+    """
+    Writes results as valid JSON
+    :param results: dict of test results
+    :param path: Output file
+    :return: None
+    """
+    with open(path, 'w', encoding='utf-8') as file:
+        for chunk in iter_json(results):
+            file.write(chunk)
+
+
+def load_json(path: str) -> dict:
+    """
+    Loads results written by write_json, null readings become NaN again
+    :param path: JSON file
+    :return: dict of test results
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        results = json.load(file)
+    for probe in results.get('ReadValuesTest', {}).values():
+        for entry in probe.values():
+            if entry.get('reading'):
+                entry['reading'] = [math.nan if value is None else value for value in entry['reading']]
+    return results
+
+
+def write_binary(results: dict, path: str) -> None:
+    """
+    Writes results into columnar binary file, one float64 [probe][value] matrix per measurement type
+    :param results: dict of test results
+    :param path: Output file
+    :return: None
+    """
+    probes = results.get('ReadValuesTest', {})
+    probe_keys = list(probes)
+    first = probes[probe_keys[0]] if probe_keys else {}
+    columns, blocks = [], []
+    for measurement_type in first:
+        entry = {key: value for key, value in first[measurement_type].items() if key != 'reading'}
+        width = len(entry['value_name'])
+        column = array('d')
+        for probe in probe_keys:
+            reading = probes[probe][measurement_type]['reading']
+            # Failed reads are stored as NaN rows
+            column.extend(reading if len(reading) == width else [math.nan] * width)
+        columns.append(column)
+        blocks.append({'measurement_type': measurement_type, 'entry': entry, 'width': width})
+    # Offsets are relative to 8 byte aligned data section
+    offset = 0
+    for block, column in zip(blocks, columns):
+        block['offset'] = offset
+        offset += len(column) * 8
+    columns.append(array('d', [probes.wall_time(int(probe)) if hasattr(probes, 'wall_time') else math.nan
+                               for probe in probe_keys]))
+    header = {key: sanitize(value) for key, value in results.items() if key != 'ReadValuesTest'}
+    header.update({'probes': probe_keys, 'blocks': blocks, 'timestamps_offset': offset})
+    encoded = json.dumps(header).encode('utf-8')
+    encoded += b' ' * (-(__BINARY_PREFIX__.size + len(encoded)) % 8)
+    with open(path, 'wb') as file:
+        file.write(__BINARY_PREFIX__.pack(__BINARY_MAGIC__, __BINARY_VERSION__, 0, len(encoded)))
+        file.write(encoded)
+        for column in columns:
+            if sys.byteorder == 'big':
+                column.byteswap()
+            column.tofile(file)
+
+
+class BinaryProbeStore(Mapping):
+    """
+    Lazy {str(probe): {measurement_type: entry with reading}} view over memory-mapped binary file
+    """
+
+    def __init__(self, data: memoryview, header: dict):
+        self.data = data
+        self.probes = {probe: index for index, probe in enumerate(header['probes'])}
+        self.blocks = {block['measurement_type']: block for block in header['blocks']}
+        self.timestamps_offset = header['timestamps_offset']
+
+    def reading(self, probe: int, measurement_type: str) -> list:
+        """
+        :param probe: Probe index
+        :param measurement_type: Measurement type
+        :return: Values of the probe
+        """
+        block = self.blocks[measurement_type]
+        start = block['offset'] // 8 + probe * block['width']
+        return self.data[start:start + block['width']].tolist()
+
+    def series(self, measurement_type: str) -> memoryview:
+        """
+        :param measurement_type: Measurement type
+        :return: Whole [probe][value] matrix of measurement type without copying
+        """
+        block = self.blocks[measurement_type]
+        start = block['offset'] // 8
+        return self.data[start:start + block['width'] * len(self.probes)]
+
+    def wall_time(self, probe: int) -> float:
+        """
+        :param probe: Probe index
+        :return: Wall clock timestamp of the probe
+        """
+        return self.data[self.timestamps_offset // 8 + probe]
+
+    def __getitem__(self, probe: str) -> dict:
+        index = self.probes[probe]
+        return {measurement_type: dict(block['entry'], reading=self.reading(index, measurement_type))
+                for measurement_type, block in self.blocks.items()}
+
+    def __iter__(self):
+        return iter(self.probes)
+
+    def __len__(self) -> int:
+        return len(self.probes)
+
+
+def load_binary(path: str) -> dict:
+    """
+    Memory-maps binary results, probes are decoded only when accessed
+    :param path: Binary file
+    :return: dict of test results with lazy ReadValuesTest
+    """
+    with open(path, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, _, header_length = __BINARY_PREFIX__.unpack_from(mapped, 0)
+    if magic != __BINARY_MAGIC__ or version != __BINARY_VERSION__:
+        raise ValueError("Unsupported results file " + path)
+    start = __BINARY_PREFIX__.size + header_length
+    header = json.loads(mapped[__BINARY_PREFIX__.size:start])
+    if sys.byteorder == 'little':
+        data = memoryview(mapped)[start:].cast('d')
+    else:
+        # Big endian hosts need a swapped copy instead of the zero-copy view
+        swapped = array('d')
+        swapped.frombytes(mapped[start:])
+        swapped.byteswap()
+        data = memoryview(swapped)
+    results = {key: value for key, value in header.items()
+               if key not in ('probes', 'blocks', 'timestamps_offset')}
+    results['ReadValuesTest'] = BinaryProbeStore(data, header)
+    return results
+
+
+def write_varint(buffer: bytearray, value: int) -> None:
+    """
+    Appends signed integer as zigzag LEB128 varint (small magnitudes take one byte)
+    :param buffer: Output buffer
+    :param value: Integer
+    :return: None
+    """
+    value = value * 2 if value >= 0 else -value * 2 - 1
+    while value > 0x7F:
+        buffer.append(value & 0x7F | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varints(data: bytes) -> list:
+    """
+    :param data: Stream written by write_varint
+    :return: Signed integers
+    """
+    values, value, shift = [], 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(value >> 1 if not value & 1 else -(value >> 1) - 1)
+        value, shift = 0, 0
+    return values
+
+
+class DeltaSeries:
+    """
+    Delta/RLE encoding of one measurement type. Sample timeline is stored as runs of equal time deltas in ms
+    (periodic polling collapses into one run), each value as (sample index delta, value delta) of its emitted
+    changes. Integer data types store raw steps (value / scale), float types the float64 bit pattern, so decoded
+    values are exactly the emitted ones. Encoded data is taken out in blocks, encoder state carries over so streams
+    of consecutive blocks are concatenated on load.
+    """
+
+    def __init__(self, measurement_type: str, entry: dict, start: float):
+        decoder = BlockDecoder(entry)
+        self.measurement_type = measurement_type
+        self.entry = {key: value for key, value in entry.items() if key != 'reading'}
+        self.scales = decoder.scales
+        self.float_values = entry.get('data_type') == 'float32'
+        self.start = start
+        self.samples = 0
+        self.timeline = bytearray()
+        self.last_ms = 0
+        # Pending run of equal time deltas [delta, length]
+        self.run = [0, 0]
+        self.streams = [bytearray() for _ in self.scales]
+        self.last_samples = [0] * len(self.scales)
+        self.last_steps = [0] * len(self.scales)
+        self.events = [0] * len(self.scales)
+        # Samples and changes since last block, first block carries the entry
+        self.block_samples = 0
+        self.block_events = [0] * len(self.scales)
+        self.blocks = 0
+
+    def step(self, index: int, value: float) -> int:
+        """
+        :param index: Value position
+        :param value: Decoded value
+        :return: Integer representation of the value
+        """
+        if self.float_values:
+            return __FLOAT_BITS__[1].unpack(__FLOAT_BITS__[0].pack(value))[0]
+        return round(value / self.scales[index])
+
+    def add(self, timestamp: float, changes: list) -> None:
+        """
+        Appends sample, only emitted changes of its values are stored
+        :param timestamp: Monotonic sample time in seconds
+        :param changes: [(index, value)] of emitted values
+        :return: None
+        """
+        elapsed_ms = round((timestamp - self.start) * 1000)
+        delta = elapsed_ms - self.last_ms
+        self.last_ms = elapsed_ms
+        if self.run[1] and delta != self.run[0]:
+            write_varint(self.timeline, self.run[1])
+            write_varint(self.timeline, self.run[0])
+            self.run[1] = 0
+        self.run[0] = delta
+        self.run[1] += 1
+        sample = self.samples
+        self.samples += 1
+        self.block_samples += 1
+        for index, value in changes:
+            stream = self.streams[index]
+            write_varint(stream, sample - self.last_samples[index])
+            self.last_samples[index] = sample
+            if value != value:
+                # Odd token marks not available value, reference step is kept
+                write_varint(stream, 1)
+            else:
+                step = self.step(index, value)
+                write_varint(stream, (step - self.last_steps[index]) * 2)
+                self.last_steps[index] = step
+            self.events[index] += 1
+            self.block_events[index] += 1
+
+    def encode_block(self) -> bytes:
+        """
+        Takes out samples added since last block, pending run is closed
+        :return: Block payload (header length, JSON block header, streams), empty if no sample was added
+        """
+        if not self.block_samples:
+            return b''
+        if self.run[1]:
+            write_varint(self.timeline, self.run[1])
+            write_varint(self.timeline, self.run[0])
+            self.run[1] = 0
+        streams = [self.timeline] + self.streams
+        header = {'measurement_type': self.measurement_type, 'samples': self.block_samples,
+                  'events': self.block_events, 'lengths': [len(stream) for stream in streams]}
+        if not self.blocks:
+            header.update({'entry': sanitize(self.entry), 'start': self.start, 'float_values': self.float_values})
+        encoded = json.dumps(header).encode('utf-8')
+        payload = __DELTA_BLOCK_HEADER__.pack(len(encoded)) + encoded + b''.join(streams)
+        self.timeline = bytearray()
+        self.streams = [bytearray() for _ in self.scales]
+        self.block_samples = 0
+        self.block_events = [0] * len(self.scales)
+        self.blocks += 1
+        return payload
+
+
+def decode_series(header: dict, streams: list, epoch_offset: float = 0.0) -> dict:
+    """
+    Decodes series back into full time series, values are held between emitted changes
+    :param header: Series header written by DeltaSeries.encode
+    :param streams: Encoded timeline and value streams
+    :param epoch_offset: Offset of monotonic clock to wall clock
+    :return: {'timestamps': wall clock times, 'values': {value_name: values per sample}, 'events': {value_name: count}}
+    """
+    timestamps, elapsed_ms = [], 0
+    timeline = read_varints(streams[0])
+    for length, delta in zip(timeline[0::2], timeline[1::2]):
+        for _ in range(length):
+            elapsed_ms += delta
+            timestamps.append(header['start'] + elapsed_ms / 1000 + epoch_offset)
+    decoder = BlockDecoder(header['entry'])
+    values = {}
+    for index, name in enumerate(header['entry']['value_name']):
+        series = [math.nan] * header['samples']
+        tokens = read_varints(streams[index + 1])
+        sample, step, value = 0, 0, math.nan
+        for sample_delta, token in zip(tokens[0::2], tokens[1::2]):
+            # Value of the previous change is held until this sample
+            series[sample:sample + sample_delta] = [value] * sample_delta
+            sample += sample_delta
+            if token == 1:
+                value = math.nan
+                continue
+            step += token // 2
+            if header['float_values']:
+                value = __FLOAT_BITS__[0].unpack(__FLOAT_BITS__[1].pack(step))[0]
+            elif decoder.scales[index] == 1:
+                value = step
+            else:
+                value = round(step * decoder.scales[index], decoder.digits[index])
+        series[sample:] = [value] * (header['samples'] - sample)
+        values[name] = series
+    return {'timestamps': timestamps, 'values': values,
+            'events': dict(zip(header['entry']['value_name'], header['events']))}
+
+
+class DeltaWriter:
+    """
+    Append-only delta file, data written before an interruption stays readable (truncated last chunk is skipped)
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, 'wb')
+        self.file.write(__BINARY_PREFIX__.pack(__DELTA_MAGIC__, __DELTA_VERSION__, 0, 0))
+
+    def chunk(self, kind: int, payload: bytes) -> None:
+        """
+        :param kind: __DELTA_RECORD__ or __DELTA_BLOCK__
+        :param payload: Chunk data
+        :return: None
+        """
+        self.file.write(__DELTA_CHUNK__.pack(kind, len(payload)))
+        self.file.write(payload)
+
+    def record(self, record: dict) -> None:
+        """
+        Appends JSON record, NaN is stored as null
+        :param record: Record with 'type' key
+        :return: None
+        """
+        self.chunk(__DELTA_RECORD__, json.dumps(sanitize(record), allow_nan=False).encode('utf-8'))
+
+    def block(self, series: DeltaSeries) -> None:
+        """
+        Appends samples of the series added since its last block
+        :param series: Series
+        :return: None
+        """
+        payload = series.encode_block()
+        if payload:
+            self.chunk(__DELTA_BLOCK__, payload)
+
+    def flush(self) -> None:
+        """
+        Writes appended chunks to disk
+        :return: None
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        """
+        :return: None
+        """
+        self.flush()
+        self.file.close()
+
+
+def read_delta_chunks(data: bytes):
+    """
+    :param data: Content of delta file
+    :return: Iterator of (kind, payload), stops at truncated chunk of interrupted run
+    """
+    magic, version, _, header_length = __BINARY_PREFIX__.unpack_from(data, 0)
+    if magic != __DELTA_MAGIC__ or version != __DELTA_VERSION__:
+        raise ValueError("Unsupported delta file version " + str(version))
+    position = __BINARY_PREFIX__.size + header_length
+    while position + __DELTA_CHUNK__.size <= len(data):
+        kind, length = __DELTA_CHUNK__.unpack_from(data, position)
+        position += __DELTA_CHUNK__.size
+        if position + length > len(data):
+            break
+        yield kind, data[position:position + length]
+        position += length
+
+
+def load_delta(path: str) -> dict:
+    """
+    Loads delta encoded results, series are decoded into full time series (Series key), streams of measurement
+    tests are rebuilt into ReadValuesTest probes instead, events (e.g. endurance commands) are listed under Events
+    :param path: Delta file
+    :return: dict of test results
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    results, probes, events, series, epoch_offset = {}, [], [], {}, 0.0
+    for kind, payload in read_delta_chunks(data):
+        if kind == __DELTA_RECORD__:
+            record = json.loads(payload)
+            match record['type']:
+                case 'test':
+                    results.update({'TestID': record['TestID'], 'TestTime': record['TestTime']})
+                    epoch_offset = record.get('epoch_offset', 0.0)
+                case 'section':
+                    results[record['name']] = record['data']
+                case 'probes':
+                    probes.extend(record['probes'])
+                case 'events':
+                    events.extend(record['events'])
+        elif kind == __DELTA_BLOCK__:
+            (length,) = __DELTA_BLOCK_HEADER__.unpack_from(payload, 0)
+            position = __DELTA_BLOCK_HEADER__.size + length
+            header = json.loads(payload[__DELTA_BLOCK_HEADER__.size:position])
+            if header['measurement_type'] not in series:
+                series[header['measurement_type']] = dict(
+                    header, samples=0, events=[0] * len(header['events']),
+                    streams=[bytearray() for _ in header['lengths']])
+            combined = series[header['measurement_type']]
+            combined['samples'] += header['samples']
+            combined['events'] = [total + count for total, count in zip(combined['events'], header['events'])]
+            # Encoder state carries over blocks, streams are concatenated
+            for stream, length in zip(combined['streams'], header['lengths']):
+                stream += payload[position:position + length]
+                position += length
+    decoded = {measurement_type: decode_series(header, header['streams'], epoch_offset)
+               for measurement_type, header in series.items()}
+    if probes:
+        results['ReadValuesTest'] = {
+            str(probe): {measurement_type: dict(header['entry'], reading=[
+                values[index] for values in decoded[measurement_type]['values'].values()])
+                for measurement_type, header in series.items()}
+            for index, probe in enumerate(probes)}
+    else:
+        results['Series'] = decoded
+    if events:
+        results['Events'] = [dict(event, timestamp=event['timestamp'] + epoch_offset) for event in events]
+    return results
+
+
+def load_results(path: str) -> dict:
+    """
+    Loads results by file extension (.json, .mbr or .mbd)
+    :param path: Results file
+    :return: dict of test results
+    """
+    if path.endswith(".mbr"):
+        return load_binary(path)
+    if path.endswith(".mbd"):
+        return load_delta(path)
+    return load_json(path)
@@ -0,0 +1,225 @@
+#!/usr/bin/python3.10
+"""
+Multi-process fleet testing: inventory is sharded across poll workers (one event loop each), results are collected
+in batches and handed to separate output stages (report rendering process pool, background DB writer)
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from async_engine import test_device, build_gateways, load_inventory, __GLOBAL_CONCURRENCY__, __DEVICE_CONCURRENCY__
+from modbus_protocol import load_test_configuration, write_output
+from test_plan import TestPlan, __PLAN_CACHE_DIR__
+
+# Results are sent to the coordinator in pickled batches of this many devices
+__RESULT_BATCH__ = 16
+# Coordinator checks for dead workers after this many seconds without results
+__WORKER_POLL__ = 1.0
+
+
+def shard_inventory(inventory: list, shards: int) -> list:
+    """
+    Splits inventory into balanced shards, devices of one host (gateway) stay in one shard
+    :param inventory: List of inventory entries
+    :param shards: Count of shards
+    :return: List of non-empty shards
+    """
+    hosts = {}
+    for device in inventory:
+        hosts.setdefault(device['address'], []).append(device)
+    buckets = [[] for _ in range(max(1, shards))]
+    # Largest hosts first, each goes to the currently smallest shard
+    for devices in sorted(hosts.values(), key=len, reverse=True):
+        min(buckets, key=len).extend(devices)
+    return [bucket for bucket in buckets if bucket]
+
+
+async def poll_shard(shard: list, plan: TestPlan, global_limit: int, device_limit: int, results_queue,
+                     batch_size: int) -> None:
+    """
+    Tests devices of the shard concurrently, units behind one gateway share its connection, finished devices are
+    sent in batches
+    :param shard: Inventory entries of the shard
+    :param plan: Compiled test plan
+    :param global_limit: Max count of concurrent requests of the shard
+    :param device_limit: Default max count of concurrent requests per device
+    :param results_queue: multiprocessing queue to the coordinator
+    :param batch_size: Count of results per batch
+    :return: None
+    """
+    limit = asyncio.Semaphore(global_limit)
+    gateways = build_gateways(shard)
+    batch = []
+    for finished in asyncio.as_completed([test_device(device, plan, limit, device_limit, gateways)
+                                          for device in shard]):
+        batch.append(await finished)
+        if len(batch) >= batch_size:
+            # Pickling and sending is done by the queue feeder thread, event loop is not blocked
+            results_queue.put(batch)
+            batch = []
+    if batch:
+        results_queue.put(batch)
+
+
+def poll_worker(shard: list, plan: TestPlan, global_limit: int, device_limit: int, results_queue,
+                batch_size: int = __RESULT_BATCH__) -> None:
+    """
+    Poll worker process entry point, None is sent when the shard is done
+    :param shard: Inventory entries of the shard
+    :param plan: Compiled test plan
+    :param global_limit: Max count of concurrent requests of the shard
+    :param device_limit: Default max count of concurrent requests per device
+    :param results_queue: multiprocessing queue to the coordinator
+    :param batch_size: Count of results per batch
+    :return: None
+    """
+    try:
+        asyncio.run(poll_shard(shard, plan, global_limit, device_limit, results_queue, batch_size))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        results_queue.put(None)
+
+
+class OutputStage:
+    """
+    Output of collected results: reports are rendered in process pool, DB rows are written by background thread
+    """
+
+    def __init__(self, output: str, settings: dict, workers: int):
+        self.output = output
+        self.settings = settings
+        self.pool = ProcessPoolExecutor(workers) if output in ("json", "binary", "pdf") else None
+        self.writer = None
+        self.futures = []
+        if output == "db":
+            # pylint: disable=import-outside-toplevel
+            from addons import BackgroundDbWriter
+            self.writer = BackgroundDbWriter(settings['db'], max_silence=settings['deadband_max_silence'])
+
+    def submit(self, results: dict) -> None:
+        """
+        Hands over results of one device
+        :param results: dict of test results
+        :return: None
+        """
+        if "Error" in results:
+            return
+        if self.pool:
+            self.futures.append(self.pool.submit(write_output, results, self.output, self.settings))
+        elif self.writer:
+            self.writer.submit(results)
+        else:
+            write_output(results, self.output, self.settings)
+
+    def close(self) -> None:
+        """
+        Waits for pending outputs
+        :return: None
+        """
+        for future in self.futures:
+            future.result()
+        if self.pool:
+            self.pool.shutdown()
+        if self.writer:
+            self.writer.close()
+
+
+def run_sharded_fleet(inventory: list, plan: TestPlan, workers: int, on_results,
+                      global_limit: int = __GLOBAL_CONCURRENCY__, device_limit: int = __DEVICE_CONCURRENCY__,
+                      batch_size: int = __RESULT_BATCH__) -> int:
+    """
+    Tests inventory in poll worker processes and passes results of each device to on_results as they arrive
+    :param inventory: List of inventory entries
+    :param plan: Compiled test plan
+    :param workers: Count of poll worker processes
+    :param on_results: Callable(results) run in the coordinator
+    :param global_limit: Max count of concurrent requests across all workers
+    :param device_limit: Default max count of concurrent requests per device
+    :param batch_size: Count of results per batch
+    :return: Count of collected results
+    """
+    shards = shard_inventory(inventory, workers)
+    results_queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=poll_worker, name="poll-" + str(index), daemon=True,
+                                         args=(shard, plan, max(1, global_limit // len(shards)), device_limit,
+                                               results_queue, batch_size))
+                 for index, shard in enumerate(shards)]
+    for process in processes:
+        process.start()
+    running, collected = len(processes), 0
+    while running:
+        try:
+            batch = results_queue.get(timeout=__WORKER_POLL__)
+        except queue.Empty:
+            # Worker killed without sending end of shard (e.g. out of memory)
+            if not any(process.is_alive() for process in processes):
+                print("Poll workers exited before finishing their shards!")
+                break
+            continue
+        if batch is None:
+            running -= 1
+            continue
+        for results in batch:
+            on_results(results)
+            collected += 1
+    for process in processes:
+        process.join()
+    return collected
+
+
+def main() -> None:
+    """
+    Runs tests across device inventory in multiple processes
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Schneider circuit breaker fleet Tester (multi-process)')
+    parser.add_argument('--inventory', dest='inventory', type=str,
+                        help="Path to inventory file, default: config/inventory.yaml",
+                        default="config/inventory.yaml", required=False)
+    parser.add_argument('--config', dest='config', type=str,
+                        help="Path to configuration file, default: config/config.yaml",
+                        default="config/config.yaml", required=False)
+    parser.add_argument('--workers', dest='workers', type=int,
+                        help="Poll worker processes, default: CPU count", default=os.cpu_count(), required=False)
+    parser.add_argument('--render_workers', dest='render_workers', type=int,
+                        help="Report rendering processes, default: half of CPU count",
+                        default=max(1, (os.cpu_count() or 2) // 2), required=False)
+    parser.add_argument('--global_limit', dest='global_limit', type=int,
+                        help="Max concurrent requests across all devices, default: 64",
+                        default=__GLOBAL_CONCURRENCY__, required=False)
+    parser.add_argument('--device_limit', dest='device_limit', type=int,
+                        help="Max concurrent requests per device, default: 1",
+                        default=__DEVICE_CONCURRENCY__, required=False)
+    parser.add_argument('--batch', dest='batch', type=int, help="Results per IPC batch, default: 16",
+                        default=__RESULT_BATCH__, required=False)
+    parser.add_argument('--output', dest='output', type=str, help="json, binary, pdf, dump, db", default="dump",
+                        required=False)
+    parser.add_argument('--plan_cache', dest='plan_cache', type=str,
+                        help="Compiled test plan cache directory, empty disables cache, default: " +
+                             __PLAN_CACHE_DIR__, default=__PLAN_CACHE_DIR__, required=False)
+    args = parser.parse_args()
+
+    # Plan is compiled once in the coordinator and pickled to the poll workers
+    plan = load_test_configuration(args.config, None, args.plan_cache)
+    inventory = load_inventory(args.inventory)
+    print("-> Testing " + str(len(inventory)) + " device(s) in " + str(min(args.workers, len(inventory))) +
+          " worker(s)")
+    stage = OutputStage(args.output, plan.output_config(), args.render_workers)
+    start = perf_counter()
+    try:
+        collected = run_sharded_fleet(inventory, plan, args.workers, stage.submit, args.global_limit,
+                                      args.device_limit, args.batch)
+    finally:
+        stage.close()
+    print("-> " + str(collected) + " device(s) done in " + str(round(perf_counter() - start, 2)) + "s")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Exiting on Interupt!")
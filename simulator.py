@@ -0,0 +1,342 @@
+#!/usr/bin/python3.10
+"""
+Local Modbus TCP device simulator for offline testing and benchmarking of modbus_protocol.py and async_engine.py.
+Register map is built from the test configuration, network behaviour from its simulator section.
+"""
+import argparse
+import asyncio
+import random
+from time import monotonic
+import yaml
+import modbus_frames as frames
+
+# Default values for simulated devices
+__DEFAULT_SIMULATOR_ADDRESS__ = "127.0.0.1"
+__DEFAULT_SIMULATOR_PORT__ = 5020
+__DEFAULT_IDENTITY__ = ["Schneider Electric", "LV434011", "003.009.010"]
+__LISTEN_BACKLOG__ = 256
+# Simulator settings, overridden by simulator section of the config and command line
+__DEFAULT_SETTINGS__ = {'latency_ms': 0.0, 'jitter_ms': 0.0, 'drop_rate': 0.0, 'max_requests': 0, 'max_connections': 0,
+                        'actuation_delay_ms': 0.0, 'login_required': True, 'identity': __DEFAULT_IDENTITY__,
+                        'gateway': False, 'offline_units': []}
+__RANDOM__ = random.Random()
+
+
+def build_register_map(config: dict) -> dict:
+    """
+    Creates holding register map from test configuration
+    :param config: Test configuration
+    :return: {address: value}
+    """
+    registers = {}
+    for section in ('init_sequence', 'login'):
+        for entry in config[section].values():
+            registers[entry['address_dec']] = 0
+    for entry in config['device_info'].values():
+        registers[entry['address_dec']] = entry['pass_msg']
+    for entry in config['test_readings_sequence'].values():
+        for offset, value in enumerate(entry['reading']):
+            registers[entry['address_dec'] + offset] = value & 0xFFFF
+    return registers
+
+
+class SimulatedDevice:
+    """
+    Register map and control behaviour of one simulated circuit breaker. Remote control commands are accepted only
+    after init_sequence and login were written, password is consumed by each command.
+    """
+
+    def __init__(self, config: dict, identity: list = None, actuation_delay: float = 0.0,
+                 login_required: bool = True):
+        self.registers = build_register_map(config)
+        self.identity = identity or __DEFAULT_IDENTITY__
+        # Remote control command (address, data) -> device status after command
+        self.commands = {(entry['address_dec'], entry['data']): entry['pass_msg']
+                         for entry in config['remote_control_sequence'].values()}
+        self.status_address = config['device_info']['get_dev_status']['address_dec']
+        self.init_values = {entry['address_dec']: entry['data'] for entry in config['init_sequence'].values()}
+        self.login_values = {entry['address_dec']: entry['data'] for entry in config['login'].values()}
+        self.login_required = login_required
+        # Status register changes actuation_delay seconds after accepted command
+        self.actuation_delay = actuation_delay
+        self.pending_status = None
+        self.connections = 0
+
+    def logged_in(self) -> bool:
+        """
+        :return: True if init sequence and password are written
+        """
+        return all(self.registers.get(address) == value for values in (self.init_values, self.login_values)
+                   for address, value in values.items())
+
+    def settle(self) -> None:
+        """
+        Applies status of command once its actuation delay passed
+        :return: None
+        """
+        if self.pending_status and monotonic() >= self.pending_status[0]:
+            self.registers[self.status_address] = self.pending_status[1]
+            self.pending_status = None
+
+    def write(self, address: int, value: int) -> bool:
+        """
+        Writes register and applies remote control commands
+        :param address: Register address
+        :param value: Register value
+        :return: False if command was rejected (not logged in)
+        """
+        if (address, value) in self.commands:
+            if self.login_required and not self.logged_in():
+                return False
+            self.pending_status = (monotonic() + self.actuation_delay, self.commands[(address, value)])
+            self.settle()
+            for login_address in self.login_values:
+                self.registers[login_address] = 0
+        self.registers[address] = value
+        return True
+
+    def handle(self, pdu: bytes, _unit_id: int = None) -> bytes:
+        """
+        Handles one request PDU
+        :param pdu: Request PDU
+        :param _unit_id: Unused, device answers any unit ID
+        :return: Response PDU
+        """
+        self.settle()
+        function_code, arguments = frames.decode_request(pdu)
+        if function_code == frames.READ_HOLDING_REGISTERS:
+            address, count = arguments
+            return frames.read_holding_registers_response(
+                [self.registers.get(register, 0) for register in range(address, address + count)])
+        if function_code == frames.WRITE_SINGLE_REGISTER:
+            if not self.write(*arguments):
+                return frames.exception_response(function_code, frames.ILLEGAL_DATA_VALUE)
+            return frames.write_response(pdu)
+        if function_code == frames.WRITE_MULTIPLE_REGISTERS:
+            address, values = arguments
+            if not all([self.write(address + offset, value) for offset, value in enumerate(values)]):
+                return frames.exception_response(function_code, frames.ILLEGAL_DATA_VALUE)
+            return frames.write_response(pdu)
+        if function_code == frames.ENCAPSULATED_INTERFACE:
+            return frames.read_device_information_response(arguments[0], self.identity)
+        return frames.exception_response(function_code, frames.ILLEGAL_FUNCTION)
+
+
+class SimulatedGateway:
+    """
+    Modbus TCP-to-serial gateway, one simulated device per unit ID. Requests of all connections share one serial
+    line and are answered one at a time, offline units never answer.
+    """
+
+    def __init__(self, config: dict, settings: dict):
+        self.config = config
+        self.settings = settings
+        self.devices = {}
+        self.offline_units = set(settings['offline_units'])
+        self.line = asyncio.Lock()
+        self.connections = 0
+
+    def handle(self, pdu: bytes, unit_id: int = None) -> bytes:
+        """
+        Handles one request PDU by device of the unit
+        :param pdu: Request PDU
+        :param unit_id: Slave unit ID
+        :return: Response PDU, None if unit is offline
+        """
+        if unit_id in self.offline_units:
+            return None
+        if unit_id not in self.devices:
+            self.devices[unit_id] = SimulatedDevice(self.config, self.settings['identity'],
+                                                    self.settings['actuation_delay_ms'] / 1000,
+                                                    self.settings['login_required'])
+        return self.devices[unit_id].handle(pdu)
+
+
+async def respond_later(writer: asyncio.StreamWriter, frame: bytes, latency: float) -> None:
+    """
+    Sends response after simulated network latency
+    :param writer: Stream writer
+    :param frame: Response frame
+    :param latency: Delay in seconds
+    :return: None
+    """
+    await asyncio.sleep(latency)
+    if not writer.is_closing():
+        writer.write(frame)
+
+
+async def handle_connection(device, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                            settings: dict = None) -> None:
+    """
+    Serves requests of one client connection
+    :param device: SimulatedDevice or SimulatedGateway
+    :param reader: Stream reader
+    :param writer: Stream writer
+    :param settings: Simulator settings (latency_ms, jitter_ms, drop_rate, max_requests, max_connections),
+                     delayed responses do not block following requests (pipelining) except behind gateway
+    :return: None
+    """
+    settings = settings or __DEFAULT_SETTINGS__
+    # Gateways cap count of open connections
+    if settings['max_connections'] and device.connections >= settings['max_connections']:
+        writer.close()
+        return
+    device.connections += 1
+    delayed = set()
+    served = 0
+    try:
+        while not settings['max_requests'] or served < settings['max_requests']:
+            header = await reader.readexactly(frames.__MBAP_HEADER_SIZE__)
+            transaction_id, unit_id, length = frames.decode_header(header)
+            pdu = await reader.readexactly(length)
+            served += 1
+            latency = (settings['latency_ms'] + __RANDOM__.uniform(0, settings['jitter_ms'])) / 1000
+            if isinstance(device, SimulatedGateway):
+                # Serial line is busy for latency of every request, also of offline units (gateway timeout)
+                async with device.line:
+                    await asyncio.sleep(latency)
+                    response = device.handle(pdu, unit_id)
+                if response is None or (settings['drop_rate'] and __RANDOM__.random() < settings['drop_rate']):
+                    continue
+                writer.write(frames.encode_frame(transaction_id, unit_id, response))
+                await writer.drain()
+                continue
+            frame = frames.encode_frame(transaction_id, unit_id, device.handle(pdu, unit_id))
+            if settings['drop_rate'] and __RANDOM__.random() < settings['drop_rate']:
+                continue
+            if latency:
+                task = asyncio.create_task(respond_later(writer, frame, latency))
+                delayed.add(task)
+                task.add_done_callback(delayed.discard)
+                continue
+            writer.write(frame)
+            await writer.drain()
+        # Connection closed by device after max_requests, pending responses are still sent
+        if delayed:
+            await asyncio.wait(delayed)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        device.connections -= 1
+        for task in delayed:
+            task.cancel()
+        writer.close()
+
+
+async def serve_device(device, address: str = __DEFAULT_SIMULATOR_ADDRESS__,
+                       port: int = __DEFAULT_SIMULATOR_PORT__, settings: dict = None) -> asyncio.AbstractServer:
+    """
+    Starts TCP server for simulated device
+    :param device: SimulatedDevice or SimulatedGateway
+    :param address: Listen address
+    :param port: Listen port
+    :param settings: Simulator settings
+    :return: Server object
+    """
+    return await asyncio.start_server(lambda reader, writer: handle_connection(device, reader, writer, settings),
+                                      address, port, backlog=__LISTEN_BACKLOG__)
+
+
+def simulator_settings(config: dict, overrides: dict = None) -> dict:
+    """
+    Merges defaults, simulator section of the config and command line overrides
+    :param config: Test configuration
+    :param overrides: Settings given on command line, None values are ignored
+    :return: Simulator settings
+    """
+    settings = dict(__DEFAULT_SETTINGS__)
+    settings.update(config.get('simulator') or {})
+    settings.update({key: value for key, value in (overrides or {}).items() if value is not None})
+    return settings
+
+
+def raise_file_limit(count: int) -> None:
+    """
+    Raises open file limit for hundreds of listening devices and their connections
+    :param count: Count of devices
+    :return: None
+    """
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = count * 4 + 64
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted if hard == resource.RLIM_INFINITY else min(wanted, hard),
+                                                    hard))
+
+
+async def run_simulator(config: dict, address: str, port: int, count: int, settings: dict = None) -> None:
+    """
+    Serves simulated devices (or gateways with a device per unit ID) on consecutive ports until interrupted
+    :param config: Test configuration
+    :param address: Listen address
+    :param port: First listen port
+    :param count: Count of devices
+    :param settings: Simulator settings
+    :return: None
+    """
+    settings = settings or simulator_settings(config)
+    raise_file_limit(count)
+    if settings['gateway']:
+        devices = [SimulatedGateway(config, settings) for _ in range(count)]
+    else:
+        devices = [SimulatedDevice(config, settings['identity'], settings['actuation_delay_ms'] / 1000,
+                                   settings['login_required']) for _ in range(count)]
+    servers = [await serve_device(device, address, port + index, settings) for index, device in enumerate(devices)]
+    print("-> Simulating " + str(count) + (" gateway(s)" if settings['gateway'] else " device(s)") + " on " +
+          address + ":" + str(port) + "-" + str(port + count - 1))
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+def main() -> None:
+    """
+    Simulator entry point
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Schneider circuit breaker Simulator')
+    parser.add_argument('--config', dest='config', type=str,
+                        help="Path to configuration file, default: config/config.yaml",
+                        default="config/config.yaml", required=False)
+    parser.add_argument('--address', dest='address', type=str, help="Listen address, default: 127.0.0.1",
+                        default=__DEFAULT_SIMULATOR_ADDRESS__, required=False)
+    parser.add_argument('--port', dest='port', type=int, help="First listen port, default: 5020",
+                        default=__DEFAULT_SIMULATOR_PORT__, required=False)
+    parser.add_argument('--count', dest='count', type=int, help="Count of simulated devices, default: 1", default=1,
+                        required=False)
+    parser.add_argument('--latency', dest='latency_ms', type=float, help="Response latency in ms", default=None,
+                        required=False)
+    parser.add_argument('--jitter', dest='jitter_ms', type=float, help="Random extra latency up to ms", default=None,
+                        required=False)
+    parser.add_argument('--drop_rate', dest='drop_rate', type=float, help="Share of dropped responses (0-1)",
+                        default=None, required=False)
+    parser.add_argument('--max_requests', dest='max_requests', type=int,
+                        help="Requests per connection before device closes it, 0 unlimited", default=None,
+                        required=False)
+    parser.add_argument('--max_connections', dest='max_connections', type=int,
+                        help="Open connections per device, 0 unlimited", default=None, required=False)
+    parser.add_argument('--actuation_delay', dest='actuation_delay_ms', type=float,
+                        help="Delay of status change after remote control command in ms", default=None,
+                        required=False)
+    parser.add_argument('--gateway', dest='gateway', action='store_const', const=True, default=None,
+                        help="Simulate TCP-to-serial gateways, device per unit ID, one request at a time",
+                        required=False)
+    parser.add_argument('--offline_units', dest='offline_units', type=int, nargs='+',
+                        help="Unit IDs behind gateway that never answer", default=None, required=False)
+    parser.add_argument('--seed', dest='seed', type=int, help="Random seed of jitter and drops", default=None,
+                        required=False)
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config, 'r', encoding="utf-8"))
+    if args.seed is not None:
+        __RANDOM__.seed(args.seed)
+    settings = simulator_settings(config, {key: getattr(args, key) for key in __DEFAULT_SETTINGS__
+                                           if hasattr(args, key)})
+    asyncio.run(run_simulator(config, args.address, args.port, args.count, settings))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Exiting on Interupt!")
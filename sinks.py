@@ -0,0 +1,292 @@
+#!/usr/bin/python3.10
+"""
+Streaming result sinks, test results are emitted as they are captured and can be replayed afterwards
+"""
+import json
+import math
+import os
+from time import monotonic, time
+from deadband import DeadbandFilter, __MAX_SILENCE__
+from serialization import DeltaSeries, DeltaWriter, sanitize
+
+# Flush after this count of records, fsync after this count of seconds
+__FLUSH_EVERY__ = 16
+__FSYNC_INTERVAL__ = 5.0
+# Changes captured since last checkpoint are appended to delta file after this count of seconds
+__CHECKPOINT_INTERVAL__ = 30.0
+
+
+class ResultSink:
+    """
+    Base sink, records are dicts with 'type' key (test, section, probe, sample, event)
+    """
+
+    def emit(self, record: dict) -> None:
+        """
+        Emits one record
+        :param record: Record
+        :return: None
+        """
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """
+        Flushes buffered records
+        :return: None
+        """
+
+    def close(self) -> None:
+        """
+        Flushes and closes sink
+        :return: None
+        """
+        self.flush()
+
+    def test(self, test_id: str, test_time: str, readings_sequence: dict) -> None:
+        """
+        Emits test header, readings sequence without readings makes the stream self-describing, offset of monotonic
+        clock to wall clock keeps probe timestamps replayable
+        :param test_id: TestID
+        :param test_time: TestTime
+        :param readings_sequence: test_readings_sequence section of the config
+        :return: None
+        """
+        self.emit({'type': 'test', 'TestID': test_id, 'TestTime': test_time, 'epoch_offset': time() - monotonic(),
+                   'test_readings_sequence': {key: {name: value for name, value in entry.items() if name != 'reading'}
+                                              for key, entry in readings_sequence.items()}})
+
+    def section(self, name: str, data: dict) -> None:
+        """
+        Emits finished test section (ControlTest, ReadInfoTest, MonitorTest, EnduranceTest)
+        :param name: Result key
+        :param data: Section data
+        :return: None
+        """
+        self.emit({'type': 'section', 'name': name, 'data': data})
+
+    def probe(self, probe: int, timestamp: float, readings: dict) -> None:
+        """
+        Emits one measurement probe
+        :param probe: Probe number
+        :param timestamp: Monotonic timestamp
+        :param readings: {measurement_type: decoded reading}
+        :return: None
+        """
+        self.emit({'type': 'probe', 'probe': probe, 'timestamp': timestamp, 'readings': readings})
+
+    def sample(self, measurement_type: str, reading: list, timestamp: float) -> None:
+        """
+        Emits one monitor sample
+        :param measurement_type: Measurement type
+        :param reading: Decoded reading
+        :param timestamp: Monotonic timestamp
+        :return: None
+        """
+        self.emit({'type': 'sample', 'measurement_type': measurement_type, 'timestamp': timestamp,
+                   'reading': reading})
+
+    def event(self, name: str, data: dict, timestamp: float) -> None:
+        """
+        Emits one event that is not a register reading (e.g. endurance command result)
+        :param name: Event name
+        :param data: Event data
+        :param timestamp: Monotonic timestamp
+        :return: None
+        """
+        self.emit({'type': 'event', 'name': name, 'timestamp': timestamp, 'data': data})
+
+
+class NdjsonSink(ResultSink):
+    """
+    Append-only newline delimited JSON log with periodic flush and fsync
+    """
+
+    def __init__(self, path: str, flush_every: int = __FLUSH_EVERY__, fsync_interval: float = __FSYNC_INTERVAL__):
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+        self.flush_every = flush_every
+        self.fsync_interval = fsync_interval
+        self.pending = 0
+        self.last_fsync = monotonic()
+
+    def emit(self, record: dict) -> None:
+        # Not available values (NaN) are written as null, bare NaN is not valid JSON
+        self.file.write(json.dumps(sanitize(record), allow_nan=False, separators=(',', ':')) + "\n")
+        self.pending += 1
+        # Test headers and sections are flushed immediately, probes and samples in batches
+        if self.pending >= self.flush_every or record['type'] in ('test', 'section'):
+            self.flush()
+
+    def flush(self) -> None:
+        self.file.flush()
+        self.pending = 0
+        if monotonic() - self.last_fsync >= self.fsync_interval:
+            os.fsync(self.file.fileno())
+            self.last_fsync = monotonic()
+
+    def close(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+class DeltaSink(ResultSink):
+    """
+    Change detection and delta/RLE encoded series (.mbd), only values leaving their deadband are stored.
+    Changes are appended to the file at checkpoints, so interrupted runs keep their data. Samples of unknown
+    measurement types and events are stored as raw records.
+    """
+
+    def __init__(self, path: str, max_silence: float = __MAX_SILENCE__,
+                 checkpoint_interval: float = __CHECKPOINT_INTERVAL__):
+        self.path = path
+        self.writer = DeltaWriter(path)
+        self.max_silence = max_silence
+        self.checkpoint_interval = checkpoint_interval
+        self.sequence = {}
+        self.filters = {}
+        self.series = {}
+        # Probe numbers and raw events since last checkpoint
+        self.probes = []
+        self.events = []
+        self.last_checkpoint = monotonic()
+
+    def add(self, measurement_type: str, reading: list, timestamp: float) -> None:
+        """
+        Detects changes of one reading and appends them to the series of measurement type
+        :param measurement_type: Measurement type
+        :param reading: Decoded reading, empty if read failed
+        :param timestamp: Monotonic timestamp
+        :return: None
+        """
+        entry = self.sequence.get(measurement_type)
+        if entry is None:
+            # Not a configured reading, kept as raw record instead of a series
+            self.events.append({'name': measurement_type, 'timestamp': timestamp, 'data': reading})
+            return
+        if measurement_type not in self.series:
+            self.filters[measurement_type] = DeadbandFilter(entry, self.max_silence)
+            self.series[measurement_type] = DeltaSeries(measurement_type, entry, timestamp)
+        # Failed read keeps the series aligned to the timeline as not available values
+        values = list(reading) if reading else [math.nan] * len(entry['value_name'])
+        self.series[measurement_type].add(timestamp, self.filters[measurement_type].changes(values, timestamp))
+
+    def emit(self, record: dict) -> None:
+        match record['type']:
+            case 'test':
+                self.sequence = record['test_readings_sequence']
+                self.writer.record(dict(record, epoch_offset=record.get('epoch_offset', time() - monotonic())))
+            case 'section':
+                self.flush()
+                self.writer.record(record)
+                self.writer.flush()
+            case 'probe':
+                self.probes.append(record['probe'])
+                for measurement_type, reading in record['readings'].items():
+                    self.add(measurement_type, reading, record['timestamp'])
+            case 'sample':
+                self.add(record['measurement_type'], record['reading'], record['timestamp'])
+            case 'event':
+                self.events.append({'name': record['name'], 'timestamp': record['timestamp'], 'data': record['data']})
+        if monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        # Only changes since last checkpoint are appended
+        for series in self.series.values():
+            self.writer.block(series)
+        if self.probes:
+            self.writer.record({'type': 'probes', 'probes': self.probes})
+            self.probes = []
+        if self.events:
+            self.writer.record({'type': 'events', 'events': self.events})
+            self.events = []
+        self.writer.flush()
+        self.last_checkpoint = monotonic()
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+
+    def statistics(self) -> dict:
+        """
+        :return: Count of samples and stored changes over all series
+        """
+        return {'samples': sum(series.samples * len(series.events) for series in self.series.values()),
+                'changes': sum(sum(series.events) for series in self.series.values())}
+
+
+def open_sink(path: str, max_silence: float = __MAX_SILENCE__) -> ResultSink:
+    """
+    Opens streaming sink by file extension, .mbd stores changes only, other files are NDJSON logs
+    :param path: Output file
+    :param max_silence: Max seconds between stored values of .mbd series
+    :return: Sink
+    """
+    if path.endswith(".mbd"):
+        return DeltaSink(path, max_silence)
+    return NdjsonSink(path)
+
+
+def read_stream(path: str):
+    """
+    Reads records of NDJSON log, incomplete last line of interrupted run is skipped
+    :param path: Path to log
+    :return: Iterator of records
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.endswith("\n"):
+                break
+            yield json.loads(line)
+
+
+class ReplayedProbes(dict):
+    """
+    {str(probe): {measurement_type: entry with reading}} of a replayed log with wall clock time of each probe
+    """
+
+    def __init__(self, epoch_offset: float):
+        super().__init__()
+        self.epoch_offset = epoch_offset
+        self.timestamps = {}
+
+    def wall_time(self, probe: int) -> float:
+        """
+        :param probe: Probe number
+        :return: Wall clock timestamp (seconds since epoch) of the probe
+        """
+        return self.timestamps[probe] + self.epoch_offset
+
+
+def replay_results(path: str, test_id: str = None) -> dict:
+    """
+    Rebuilds results dict of main() from NDJSON log for report and DB outputs
+    :param path: Path to log
+    :param test_id: TestID to replay, default last test in the log
+    :return: Results
+    """
+    results, sequence, epoch_offset = {}, {}, None
+    for record in read_stream(path):
+        if record['type'] == 'test':
+            if test_id and results.get('TestID') == test_id:
+                break
+            results = {'TestID': record['TestID'], 'TestTime': record['TestTime']}
+            sequence = record['test_readings_sequence']
+            # Logs written before the offset was recorded replay without probe times
+            epoch_offset = record.get('epoch_offset')
+        elif record['type'] == 'section':
+            results[record['name']] = record['data']
+        elif record['type'] == 'probe':
+            if 'ReadValuesTest' not in results:
+                results['ReadValuesTest'] = ReplayedProbes(epoch_offset) if epoch_offset is not None else {}
+            probes = results['ReadValuesTest']
+            probes[str(record['probe'])] = {
+                key: dict(sequence[key], reading=[math.nan if value is None else value for value in reading])
+                for key, reading in record['readings'].items()}
+            if isinstance(probes, ReplayedProbes):
+                probes.timestamps[record['probe']] = record['timestamp']
+    if test_id and results.get('TestID') != test_id:
+        print("TestID " + test_id + " not found in " + path)
+        exit(2)
+    return results
@@ -0,0 +1,370 @@
+#!/usr/bin/python3.10
+"""
+Test plan compiled once from YAML configuration: validated and immutable, parsed configuration is cached on disk by
+config hash
+"""
+import hashlib
+import json
+import os
+from collections import namedtuple
+from decoding import BlockDecoder
+from evaluation import compile_limits, __PASS_SCORE__
+from deadband import compile_deadband, __MAX_SILENCE__
+from monitor import group_by_rate
+
+# Read planner limits (Modbus allows max 125 holding registers per request)
+__MAX_READ_REGISTERS__ = 125
+__READ_GAP_TOLERANCE__ = 0
+# Block writes (Modbus allows max 123 registers per FC16 request)
+__MAX_WRITE_REGISTERS__ = 123
+# Parsed configs are cached as JSON by hash of config file, overrides, plan compiler and cache format, plans are
+# compiled (validated) again from the cached config, cache holds data only
+__PLAN_CACHE_DIR__ = "dumps/plan_cache/"
+__PLAN_FORMAT__ = 4
+# Sections every test configuration has to define
+__REQUIRED_SECTIONS__ = ('config', 'init_sequence', 'login', 'remote_control_sequence', 'device_id', 'device_info',
+                         'test_readings_sequence')
+__CONTROL_COMMANDS__ = ('t_off_c_break', 't_on_c_break', 't_reset_c_break')
+
+
+class Register(namedtuple('Register', ['key', 'address_dec', 'count', 'data', 'pass_msg', 'comment', 'entry',
+                                       'pass_values'])):
+    """
+    Config entry of one register range, results are new dicts so the plan is never modified
+    """
+    __slots__ = ()
+
+    def result(self, **values) -> dict:
+        """
+        :param values: Result keys (status, reading, latency_ms)
+        :return: Config entry with results
+        """
+        return dict(thaw(self.entry), **values)
+
+    def passes(self, value) -> bool:
+        """
+        :param value: Register value read from device
+        :return: True if value is one of pass_values, registers without pass_values always pass
+        """
+        return self.pass_values is None or value in self.pass_values
+
+
+# Planned FC3 read, members are ((measurement_type, (offset, count)), ...)
+ReadBlock = namedtuple('ReadBlock', ['address_dec', 'count', 'members'])
+# Planned FC16 write (FC6 for single value), members are keys of written entries
+WriteBlock = namedtuple('WriteBlock', ['address_dec', 'values', 'members'])
+
+
+class TestPlan(namedtuple('TestPlan', [
+        'config_hash', 'settings', 'init_sequence', 'init_writes', 'login', 'login_writes', 'commands',
+        'status_register', 'device_id', 'device_info', 'readings', 'read_plan', 'monitor_plan', 'pipeline_depth',
+        'single_writes', 'write_readback', 'write_verify_timeout', 'actuation_timeout', 'actuation_settle',
+        'endurance_commands', 'identity_cache', 'identity_ttl', 'pass_score', 'deadband_max_silence'])):
+    """
+    Compiled test configuration, named tuples keep the plan immutable with fast attribute access
+    """
+    __slots__ = ()
+
+    def command(self, key: str) -> Register:
+        """
+        :param key: Key of remote_control_sequence entry
+        :return: Command register
+        """
+        for command in self.commands:
+            if command.key == key:
+                return command
+        raise KeyError(key)
+
+    def output_config(self) -> dict:
+        """
+        :return: Copy of config section for report and DB writers, defaults of plan settings resolved
+        """
+        return dict(thaw(self.settings), deadband_max_silence=self.deadband_max_silence)
+
+    def readings_sequence(self) -> dict:
+        """
+        :return: Copy of test_readings_sequence section
+        """
+        return {register.key: thaw(register.entry) for register in self.readings}
+
+    def with_single_writes(self, single_writes: bool) -> 'TestPlan':
+        """
+        Replans write batches for a device quirk of one fleet member
+        :param single_writes: One write per entry
+        :return: Plan with init and login writes planned for single_writes
+        """
+        if bool(single_writes) == self.single_writes:
+            return self
+        return self._replace(
+            single_writes=bool(single_writes),
+            init_writes=tuple(plan_block_writes({r.key: thaw(r.entry) for r in self.init_sequence}, single_writes)),
+            login_writes=tuple(plan_block_writes({r.key: thaw(r.entry) for r in self.login}, single_writes)))
+
+
+class FrozenDict(tuple):
+    """
+    Mapping frozen by freeze, tuple of (key, value) items
+    """
+    __slots__ = ()
+
+
+def freeze(value):
+    """
+    :param value: Parsed YAML value
+    :return: Value with mappings converted to FrozenDict and lists to tuples
+    """
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """
+    :param value: Value converted by freeze
+    :return: New dicts and lists, results never share containers with the plan
+    """
+    if isinstance(value, FrozenDict):
+        return {key: thaw(item) for key, item in value}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+def plan_block_reads(readings_sequence: dict, max_count: int = __MAX_READ_REGISTERS__,
+                     gap_tolerance: int = __READ_GAP_TOLERANCE__) -> list:
+    """
+    Merges adjacent and overlapping register ranges into as few read requests as possible
+    :param readings_sequence: test_readings_sequence section of the config
+    :param max_count: Max count of registers in one read request
+    :param gap_tolerance: Max count of unused registers read in between two ranges
+    :return: List of ReadBlock
+    """
+    blocks = []
+    # Ranges sorted by start address, longer range first on the same address
+    ranges = sorted(readings_sequence.items(), key=lambda item: (item[1]['address_dec'], -item[1]['count']))
+    for measurement_type, entry in ranges:
+        start, count = entry['address_dec'], entry['count']
+        if blocks:
+            block = blocks[-1]
+            block_end = block['address_dec'] + block['count']
+            new_end = max(block_end, start + count)
+            # Extends last block if range fits into gap tolerance and request limit
+            if start - block_end <= gap_tolerance and new_end - block['address_dec'] <= max_count:
+                block['count'] = new_end - block['address_dec']
+                block['members'][measurement_type] = (start - block['address_dec'], count)
+                continue
+        blocks.append({'address_dec': start, 'count': count, 'members': {measurement_type: (0, count)}})
+    return [ReadBlock(block['address_dec'], block['count'], tuple(block['members'].items())) for block in blocks]
+
+
+def plan_block_writes(sequence: dict, single_writes: bool = False) -> list:
+    """
+    Groups config write sequence into FC16 writes, consecutive entries with contiguous addresses share one write
+    :param sequence: Config section (init_sequence, login)
+    :param single_writes: Device quirk, one write per entry
+    :return: List of WriteBlock in config order
+    """
+    blocks = []
+    for key, entry in sequence.items():
+        last = blocks[-1] if blocks else None
+        if last and not single_writes and entry['address_dec'] == last['address_dec'] + len(last['values']) \
+                and len(last['values']) < __MAX_WRITE_REGISTERS__:
+            last['values'].append(entry['data'])
+            last['members'].append(key)
+        else:
+            blocks.append({'address_dec': entry['address_dec'], 'values': [entry['data']], 'members': [key]})
+    return [WriteBlock(block['address_dec'], tuple(block['values']), tuple(block['members'])) for block in blocks]
+
+
+def check_integer(errors: list, name: str, value, minimum: int, maximum: int) -> None:
+    """
+    Records error if value is not integer in range
+    :param errors: Collected validation errors
+    :param name: Name used in error message
+    :param value: Checked value
+    :param minimum: Min value
+    :param maximum: Max value
+    :return: None
+    """
+    if not isinstance(value, int) or isinstance(value, bool) or not minimum <= value <= maximum:
+        errors.append(name + " must be integer " + str(minimum) + "-" + str(maximum) + ", got " + repr(value))
+
+
+def compile_registers(errors: list, section: str, entries, write: bool) -> tuple:
+    """
+    Validates config section of register entries
+    :param errors: Collected validation errors
+    :param section: Section name
+    :param entries: {key: entry}
+    :param write: Entries are written (data key required)
+    :return: Tuple of Register
+    """
+    if not isinstance(entries, dict) or not entries:
+        errors.append(section + " must be non-empty mapping")
+        return ()
+    registers = []
+    for key, entry in entries.items():
+        name = section + "." + str(key)
+        if not isinstance(entry, dict):
+            errors.append(name + " must be mapping")
+            continue
+        check_integer(errors, name + ".address_dec", entry.get('address_dec'), 0, 0xFFFF)
+        check_integer(errors, name + ".count", entry.get('count', 1), 1, __MAX_READ_REGISTERS__)
+        if write:
+            check_integer(errors, name + ".data", entry.get('data'), 0, 0xFFFF)
+        pass_values = entry.get('pass_values')
+        if pass_values is not None:
+            if not isinstance(pass_values, list) or not pass_values:
+                errors.append(name + ".pass_values must be non-empty list")
+                pass_values = []
+            for value in pass_values:
+                check_integer(errors, name + ".pass_values", value, 0, 0xFFFF)
+            pass_values = frozenset(pass_values)
+        registers.append(Register(str(key), entry.get('address_dec'), entry.get('count', 1), entry.get('data'),
+                                  entry.get('pass_msg'), entry.get('comment', ""), freeze(entry), pass_values))
+    return tuple(registers)
+
+
+def compile_readings(errors: list, entries, max_count: int) -> tuple:
+    """
+    Validates test_readings_sequence, decode keys are checked by compiling decoders, limits and deadbands by
+    aligning them to value_name
+    :param errors: Collected validation errors
+    :param entries: test_readings_sequence section
+    :param max_count: Max count of registers in one read request
+    :return: Tuple of Register
+    """
+    registers = compile_registers(errors, 'test_readings_sequence', entries, False)
+    for register in registers:
+        name = 'test_readings_sequence.' + register.key
+        entry = thaw(register.entry)
+        if isinstance(register.count, int) and register.count > max_count:
+            errors.append(name + ".count exceeds max_read_registers " + str(max_count))
+        try:
+            decoder = BlockDecoder(entry)
+        except (ValueError, TypeError, KeyError) as error:
+            errors.append(name + ": " + str(error))
+            continue
+        if len(entry.get('value_name', [])) != decoder.value_count:
+            errors.append(name + ".value_name must name " + str(decoder.value_count) + " decoded values")
+        for compile_bounds in (compile_limits, compile_deadband):
+            try:
+                compile_bounds(entry)
+            except ValueError as error:
+                errors.append(name + ": " + str(error))
+        if not isinstance(entry.get('poll_rate_hz', 1), (int, float)) or entry.get('poll_rate_hz', 1) <= 0:
+            errors.append(name + ".poll_rate_hz must be positive number")
+    return registers
+
+
+def compile_plan(config: dict, config_hash: str = "") -> TestPlan:
+    """
+    Validates configuration and precomputes read and write batches
+    :param config: Parsed test configuration
+    :param config_hash: Hash of the configuration source
+    :return: Compiled test plan
+    :raise ValueError: Configuration is invalid, message lists all problems
+    """
+    if not isinstance(config, dict):
+        raise ValueError("Configuration must be mapping")
+    errors = ["missing section " + section for section in __REQUIRED_SECTIONS__ if section not in config]
+    if errors:
+        raise ValueError("; ".join(errors))
+    settings = config['config']
+    max_count = settings.get('max_read_registers', __MAX_READ_REGISTERS__)
+    gap_tolerance = settings.get('read_gap_tolerance', __READ_GAP_TOLERANCE__)
+    check_integer(errors, "config.max_read_registers", max_count, 1, __MAX_READ_REGISTERS__)
+    check_integer(errors, "config.read_gap_tolerance", gap_tolerance, 0, __MAX_READ_REGISTERS__)
+    check_integer(errors, "config.pipeline_depth", settings.get('pipeline_depth', 1), 1, 0xFFFF)
+    single_writes = bool(settings.get('single_writes', False))
+    pass_score = settings.get('pass_score', __PASS_SCORE__)
+    if not isinstance(pass_score, (int, float)) or isinstance(pass_score, bool) or not 0 <= pass_score <= 100:
+        errors.append("config.pass_score must be number 0-100, got " + repr(pass_score))
+    max_silence = settings.get('deadband_max_silence', __MAX_SILENCE__)
+    if not isinstance(max_silence, (int, float)) or isinstance(max_silence, bool) or max_silence <= 0:
+        errors.append("config.deadband_max_silence must be positive number, got " + repr(max_silence))
+
+    init_sequence = compile_registers(errors, 'init_sequence', config['init_sequence'], True)
+    login = compile_registers(errors, 'login', config['login'], True)
+    commands = compile_registers(errors, 'remote_control_sequence', config['remote_control_sequence'], True)
+    device_id = compile_registers(errors, 'device_id', {'device_id': config['device_id']}, False)
+    device_info = compile_registers(errors, 'device_info', config['device_info'], False)
+    readings = compile_readings(errors, config['test_readings_sequence'], max_count)
+    endurance_commands = tuple(settings.get('endurance_commands', ('t_off_c_break', 't_on_c_break')))
+    command_keys = [command.key for command in commands]
+    for key in __CONTROL_COMMANDS__ + endurance_commands:
+        if key not in command_keys:
+            errors.append("remote_control_sequence." + str(key) + " is missing")
+    status_register = [register for register in device_info if register.key == 'get_dev_status']
+    if not status_register:
+        errors.append("device_info.get_dev_status is missing")
+    if errors:
+        raise ValueError("; ".join(errors))
+
+    readings_sequence = config['test_readings_sequence']
+    monitor_plan = tuple((rate, block) for rate, entries in group_by_rate(readings_sequence).items()
+                         for block in plan_block_reads(entries, max_count, gap_tolerance))
+    return TestPlan(
+        config_hash=config_hash, settings=freeze(settings),
+        init_sequence=init_sequence, init_writes=tuple(plan_block_writes(config['init_sequence'], single_writes)),
+        login=login, login_writes=tuple(plan_block_writes(config['login'], single_writes)),
+        commands=commands, status_register=status_register[0], device_id=device_id[0], device_info=device_info,
+        readings=readings, read_plan=tuple(plan_block_reads(readings_sequence, max_count, gap_tolerance)),
+        monitor_plan=monitor_plan, pipeline_depth=settings.get('pipeline_depth', 1), single_writes=single_writes,
+        write_readback=bool(settings.get('write_readback', False)),
+        write_verify_timeout=settings.get('write_verify_timeout', 0.5),
+        actuation_timeout=settings.get('actuation_timeout', 2), actuation_settle=settings.get('actuation_settle', 0),
+        endurance_commands=endurance_commands,
+        identity_cache=settings.get('identity_cache', "dumps/identity_cache.json"),
+        identity_ttl=settings.get('identity_ttl', 86400), pass_score=pass_score, deadband_max_silence=max_silence)
+
+
+def load_test_plan(path: str, overrides: dict = None, cache_dir: str = __PLAN_CACHE_DIR__) -> TestPlan:
+    """
+    Loads and compiles test plan, YAML is parsed only if config, overrides or plan compiler changed
+    :param path: Path to config file
+    :param overrides: Values replacing keys of config section (e.g. single_writes)
+    :param cache_dir: Parsed config cache directory, empty disables cache
+    :return: Compiled test plan
+    :raise FileNotFoundError: Config file does not exist
+    :raise ValueError: Configuration is invalid
+    """
+    with open(path, 'rb') as file:
+        source = file.read()
+    digest = hashlib.sha256(source)
+    with open(__file__, 'rb') as file:
+        digest.update(file.read())
+    digest.update(json.dumps([overrides or {}, __PLAN_FORMAT__], sort_keys=True).encode('utf-8'))
+    config_hash = digest.hexdigest()
+    cache_file = os.path.join(cache_dir, config_hash + ".json") if cache_dir else None
+    if cache_file:
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as file:
+                # Cached config is validated like parsed YAML
+                return compile_plan(json.load(file), config_hash)
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            # Missing, corrupted or invalid cache file, config is parsed again
+            pass
+
+    # Parser is imported only on cache miss
+    import yaml  # pylint: disable=import-outside-toplevel
+    config = yaml.load(source, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    if isinstance(config, dict) and isinstance(config.get('config'), dict) and overrides:
+        config['config'].update(overrides)
+    plan = compile_plan(config, config_hash)
+    if cache_file:
+        try:
+            encoded = json.dumps(config, allow_nan=False)
+            # Configs JSON can not represent exactly (dates, non-string keys) are parsed on every launch
+            if json.loads(encoded) == config:
+                os.makedirs(cache_dir, exist_ok=True)
+                temporary = cache_file + "." + str(os.getpid()) + ".tmp"
+                with open(temporary, 'w', encoding='utf-8') as file:
+                    file.write(encoded)
+                os.replace(temporary, cache_file)
+        except (OSError, TypeError, ValueError):
+            # Read-only or full disk, config is parsed on every launch
+            pass
+    return plan
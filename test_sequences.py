@@ -0,0 +1,377 @@
+#!/usr/bin/python3.10
+"""
+Test sequences shared by the blocking tester (modbus_protocol.py) and the asyncio fleet engine (async_engine.py).
+Sequences are generators over the compiled test plan yielding I/O operations, run_sync and run_async execute them
+on a ModbusTransport or AsyncModbusClient, so both engines run the same test logic.
+"""
+import asyncio
+from collections import namedtuple
+from time import monotonic, perf_counter_ns, sleep
+from actuation import LatencyHistogram, __POLL_INTERVAL_MIN__, __POLL_INTERVAL_MAX__
+from evaluation import Evaluator
+from metrics import METRICS
+from modbus_transport import IdentityCache
+from probe_store import ProbeStore
+from test_plan import Register, TestPlan, WriteBlock
+
+# Communication timeouts
+__WRITE_TIMEOUT__ = 0.5
+__READ_TIMEOUT__ = 0.1
+# Measurement timeouts
+__PROBE_OFFSET__ = 2
+__PROBE_COUNT__ = 10
+# Print timeouts
+__PRINT_TIMEOUT__ = 0.5
+# Write readback verification
+__WRITE_VERIFY_INTERVAL__ = 0.02
+# Endurance progress print interval in cycles
+__ENDURANCE_REPORT_EVERY__ = 10
+
+# Connection method call, result is sent back into the sequence
+Call = namedtuple('Call', ['method', 'args'])
+# Wait in seconds
+Pause = namedtuple('Pause', ['seconds'])
+# Progress output, pause in seconds follows printed text (skipped with output)
+Echo = namedtuple('Echo', ['text', 'end', 'pause'], defaults=("\n", 0.0))
+# Connection object the sequence runs on (identity cache key, metric labels, pipeline depth)
+Connection = namedtuple('Connection', [])
+
+
+def to_bool(bool_value: str) -> int:
+    """
+    Returns Bool equivalent in INT form
+    :param bool_value: bool
+    :return: int
+    """
+    if bool_value:
+        return 1
+    return 0
+
+
+def run_sync(sequence, connection, echo: bool = True):
+    """
+    Runs test sequence on blocking transport, interrupt is raised inside the sequence so it can stop gracefully
+    :param sequence: Test sequence generator
+    :param connection: ModbusTransport
+    :param echo: Print progress
+    :return: Result of the sequence
+    """
+    value, error = None, None
+    while True:
+        try:
+            operation = sequence.throw(error) if error else sequence.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value, error = None, None
+        try:
+            if isinstance(operation, Call):
+                value = getattr(connection, operation.method)(*operation.args)
+            elif isinstance(operation, Pause):
+                sleep(operation.seconds)
+            elif isinstance(operation, Echo):
+                if echo:
+                    print(operation.text, end=operation.end)
+                    if operation.pause:
+                        sleep(operation.pause)
+            else:
+                value = connection
+        except KeyboardInterrupt as interrupt:
+            error = interrupt
+
+
+async def run_async(sequence, client, echo: bool = False):
+    """
+    Runs test sequence on asyncio client, progress is not printed by default (devices run concurrently)
+    :param sequence: Test sequence generator
+    :param client: AsyncModbusClient
+    :param echo: Print progress
+    :return: Result of the sequence
+    """
+    value = None
+    while True:
+        try:
+            operation = sequence.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value = None
+        if isinstance(operation, Call):
+            value = await getattr(client, operation.method)(*operation.args)
+        elif isinstance(operation, Pause):
+            await asyncio.sleep(operation.seconds)
+        elif isinstance(operation, Echo):
+            if echo:
+                print(operation.text, end=operation.end)
+                if operation.pause:
+                    await asyncio.sleep(operation.pause)
+        else:
+            value = client
+
+
+def read_planned_blocks(read_plan: tuple, depth: int = 1):
+    """
+    Executes planned block reads
+    :param read_plan: ReadBlocks of the test plan
+    :param depth: Requests in flight of the connection
+    :return: Raw registers per block, empty list if block read failed
+    """
+    # Pipelined connection sends all blocks at once, cycle costs about one round trip
+    if depth > 1:
+        readings = yield Call('read_blocks', ([(block.address_dec, block.count) for block in read_plan],))
+        return [data or [] for data in readings]
+    block_readings = []
+    for block in read_plan:
+        data = yield Call('read_holding_registers', (block.address_dec, block.count))
+        block_readings.append(data or [])
+        yield Pause(__READ_TIMEOUT__)
+    return block_readings
+
+
+def write_block(block: WriteBlock):
+    """
+    Writes planned block, falls back to single writes if device rejects FC16
+    :param block: WriteBlock of the test plan
+    :return: Status of write
+    """
+    if len(block.values) == 1:
+        return to_bool((yield Call('write_single_register', (block.address_dec, block.values[0]))))
+    status = yield Call('write_multiple_registers', (block.address_dec, list(block.values)))
+    if status is None:
+        statuses = []
+        for offset, value in enumerate(block.values):
+            statuses.append((yield Call('write_single_register', (block.address_dec + offset, value))))
+        status = all(statuses)
+    return to_bool(status)
+
+
+def wait_for_condition(request: Call, condition, timeout: float, start_ns: int = None):
+    """
+    Repeats request until condition(value) is met or deadline passes, poll interval doubles from min to max
+    :param request: Read call
+    :param condition: Callable(value) -> bool
+    :param timeout: Deadline in seconds from start
+    :param start_ns: perf_counter_ns() of the event the latency is measured from, default now
+    :return: (condition met, last value, latency in ns from start to the read which met the condition)
+    """
+    start_ns = perf_counter_ns() if start_ns is None else start_ns
+    deadline_ns = start_ns + int(timeout * 1e9)
+    interval = __POLL_INTERVAL_MIN__
+    while True:
+        value = yield request
+        now_ns = perf_counter_ns()
+        if value is not None and condition(value):
+            return True, value, now_ns - start_ns
+        if now_ns >= deadline_ns:
+            return False, value, now_ns - start_ns
+        yield Pause(min(interval, (deadline_ns - now_ns) / 1e9))
+        interval = min(interval * 2, __POLL_INTERVAL_MAX__)
+
+
+def wait_for_readback(address: int, values: tuple, timeout: float):
+    """
+    Reads written registers back until device reflects the values
+    :param address: Start register
+    :param values: Written values
+    :param timeout: Max wait in seconds
+    :return: True if values were read back before timeout
+    """
+    deadline = monotonic() + timeout
+    while (yield Call('read_holding_registers', (address, len(values)))) != list(values):
+        if monotonic() >= deadline:
+            return False
+        yield Pause(__WRITE_VERIFY_INTERVAL__)
+    return True
+
+
+def send_write_sequence(plan: TestPlan, sequence: tuple, writes: tuple):
+    """
+    Writes config defined sequence grouped into block writes, each write is verified by readback
+    (write_readback) or followed by fixed __WRITE_TIMEOUT__
+    :param plan: Test plan
+    :param sequence: Registers of the sequence (init_sequence, login)
+    :param writes: Planned block writes of the sequence
+    :return: Status of writes {key: entry with status}
+    """
+    connection = yield Connection()
+    statuses = {}
+    for block in writes:
+        with METRICS.span('write_sequence', connection.device_labels + (('block', str(block.address_dec)),)):
+            status = yield from write_block(block)
+            if plan.write_readback:
+                status = to_bool(status and (yield from wait_for_readback(block.address_dec, block.values,
+                                                                          plan.write_verify_timeout)))
+            else:
+                yield Pause(__WRITE_TIMEOUT__)
+        for key in block.members:
+            statuses[key] = status
+    return {register.key: register.result(status=statuses[register.key]) for register in sequence}
+
+
+def actuate(command: Register, status_register: Register, timeout: float):
+    """
+    Writes remote control command and waits until status register reports pass_msg
+    :param command: Register of remote_control_sequence entry
+    :param status_register: Register of device_info get_dev_status entry
+    :param timeout: Max actuation time in seconds
+    :return: (status, actuation latency in ms)
+    """
+    start_ns = perf_counter_ns()
+    if not (yield Call('write_single_register', (command.address_dec, command.data))):
+        return 0, None
+    reached, _, latency_ns = yield from wait_for_condition(
+        Call('read_holding_registers', (status_register.address_dec, status_register.count)),
+        lambda value: value[0] == command.pass_msg, timeout, start_ns)
+    return (1 if reached else 0), latency_ns / 1e6
+
+
+def control_command(plan: TestPlan, key: str, histogram: LatencyHistogram = None):
+    """
+    Logs in, sends remote control command and waits until status register confirms it
+    :param plan: Test plan
+    :param key: Key of remote_control_sequence section
+    :param histogram: Optional histogram of actuation latencies
+    :return: (login status, command entry with status and latency_ms)
+    """
+    login = yield from send_write_sequence(plan, plan.login, plan.login_writes)
+    command = plan.command(key)
+    status, latency_ms = yield from actuate(command, plan.status_register, plan.actuation_timeout)
+    if status and histogram is not None:
+        histogram.add(latency_ms)
+    # Rest time of breaker mechanism after confirmed command
+    yield Pause(plan.actuation_settle)
+    return login, command.result(status=status, latency_ms=latency_ms)
+
+
+def remote_control_test(plan: TestPlan):
+    """
+    Remote control test of the Device
+    :param plan: Test plan
+    :return: Status data
+    """
+    remote_control_status = {}
+    remote_control_status.update((yield from send_write_sequence(plan, plan.init_sequence, plan.init_writes)))
+    yield Echo("-> Running Device Control Test Sequence:")
+    # OFF, ON and RESET motor control tests, each waits for status register instead of fixed step timeout
+    for key, name in (('t_off_c_break', "OFF"), ('t_on_c_break', "ON"), ('t_reset_c_break', "RESET")):
+        yield Echo("   Sending " + name + " to motor control... ", "")
+        login, command = yield from control_command(plan, key)
+        if command['status']:
+            yield Echo("Pass (" + str(round(command['latency_ms'], 3)) + " ms)")
+        else:
+            yield Echo("Fail")
+        remote_control_status.update(login)
+        remote_control_status.update({key: command})
+    yield Echo("   Done!")
+    return remote_control_status
+
+
+def endurance_test(plan: TestPlan, cycles: int, sink=None):
+    """
+    Cycles breaker through endurance_commands (default OFF, ON) as fast as confirmations allow
+    :param plan: Test plan
+    :param cycles: Count of cycles
+    :param sink: Optional streaming sink, each command is emitted as event
+    :return: Failures and actuation latency histogram per command
+    """
+    commands = plan.endurance_commands
+    histograms = {key: LatencyHistogram() for key in commands}
+    failures = {key: 0 for key in commands}
+    yield Echo("-> Running Endurance Test: " + str(cycles) + " cycles of " + ", ".join(commands))
+    yield from send_write_sequence(plan, plan.init_sequence, plan.init_writes)
+    completed = 0
+    try:
+        for completed in range(1, cycles + 1):
+            for key in commands:
+                _, command = yield from control_command(plan, key, histograms[key])
+                failures[key] += 0 if command['status'] else 1
+                if sink:
+                    sink.event(key, {'status': command['status'], 'latency_ms': command['latency_ms']}, monotonic())
+            if completed % __ENDURANCE_REPORT_EVERY__ == 0:
+                yield Echo("   " + str(completed) + "/" + str(cycles) + " cycles, failures: " +
+                           str(sum(failures.values())))
+    except KeyboardInterrupt:
+        yield Echo("   Endurance test stopped.")
+    for key in commands:
+        yield Echo("   " + key + " actuation latency:")
+        for line in histograms[key].render():
+            yield Echo("   " + line)
+    yield Echo("   Done!")
+    return {'cycles': completed, 'failures': failures,
+            'latency': {key: histograms[key].statistics() for key in commands}}
+
+
+def device_information_read_test(plan: TestPlan):
+    """
+    Device information read test
+    :param plan: Test plan
+    :return: device information
+    """
+    connection = yield Connection()
+    device_info = {}
+    yield Echo("-> Running Information Read Test:")
+    yield Echo("   Read Device Identification ... ", "")
+    # Identity is cached on disk, repeated runs do not query device again until TTL expires
+    cache = IdentityCache(plan.identity_cache, plan.identity_ttl)
+    data = cache.get(connection)
+    if data is None:
+        data = yield Call('read_device_identification', ())
+        if data is not None:
+            cache.put(connection, data)
+    if data is None:
+        yield Echo("Could not readout device information.")
+    else:
+        yield Echo(str(data) + "  Pass", "\n", __PRINT_TIMEOUT__)
+        device_info.update({'device_id': plan.device_id.result(reading=data)})
+    yield Pause(__READ_TIMEOUT__)
+
+    # Status registers are requested together, pipelined if connection allows more requests in flight
+    readings = yield Call('read_blocks', ([(register.address_dec, register.count) for register in plan.device_info],))
+    for register, data in zip(plan.device_info, readings):
+        yield Echo("   Read " + register.comment + " ... ", "")
+        if data is None:
+            yield Echo("Fail", "\n", __PRINT_TIMEOUT__)
+            data = [None]
+        else:
+            # Registers with pass_values in config are checked, others pass when read
+            yield Echo(str(data[0]) + ("  Pass" if register.passes(data[0]) else "  Fail"), "\n", __PRINT_TIMEOUT__)
+        device_info.update({register.key: register.result(
+            reading=data[0], status=to_bool(data[0] is not None and register.passes(data[0])))})
+    yield Pause(__READ_TIMEOUT__)
+    yield Echo("   Done!")
+    return device_info
+
+
+def device_measurement_read_test(plan: TestPlan, probe_count: int = __PROBE_COUNT__,
+                                 probe_offset: float = __PROBE_OFFSET__, sink=None, evaluator: Evaluator = None):
+    """
+    Readout of selected values
+    :param plan: Test plan
+    :param probe_count: Count of probes
+    :param probe_offset: Time between probes in seconds
+    :param sink: Optional streaming sink, each probe is emitted as it is captured
+    :param evaluator: Optional evaluator, each probe is checked against limits as it is captured
+    :return: Selected values, {probe number: {measurement type: decoded reading}} view over columnar store
+    """
+    connection = yield Connection()
+    yield Echo("-> Running Measurement Read test: ")
+    yield Echo("   Measurement parameters -> Count: " + str(probe_count) + " Offset: " + str(probe_offset) +
+               "s Total time: " + str(probe_count * probe_offset) + "s")
+    yield Echo("   ", "")
+    # Preallocated register matrix per planned block read
+    measurement_data = ProbeStore(plan.readings_sequence(), plan.read_plan, probe_count)
+    for i in range(0, probe_count):
+        block_readings = yield from read_planned_blocks(plan.read_plan, connection.depth)
+        measurement_data.store(i, block_readings)
+        # Probe with values out of limits or failed reads is marked by x
+        failed = evaluator.add_probe(plan.read_plan, block_readings) if evaluator else 0
+        yield Echo("x " if failed or not all(block_readings) else ". ", "")
+        if sink:
+            probe = measurement_data[str(i)]
+            sink.probe(i, measurement_data.timestamp(i), {key: probe[key]['reading'] for key in probe})
+        yield Pause(probe_offset)
+    if evaluator and (evaluator.violations or evaluator.failed_reads):
+        yield Echo("Fail (" + str(evaluator.violations) + " values out of limits, " + str(evaluator.failed_reads) +
+                   " failed reads)")
+    else:
+        yield Echo("Pass")
+    yield Echo("   Done!")
+    return measurement_data
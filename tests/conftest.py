@@ -0,0 +1,7 @@
+"""
+Test setup, modules of the tester live in the repository root
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
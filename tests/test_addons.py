@@ -0,0 +1,73 @@
+"""
+DB rows of schema version 2 built from captured and replayed results and migrated from schema version 1
+"""
+import json
+import os
+import sqlite3
+from test_plan import load_test_plan
+from addons import __DB_MEASUREMENT_COLUMNS__, __DB_TEST_COLUMNS__, __DB_VALUE_COLUMNS__, DbConnectionPool, \
+    build_measurement_value_rows, migrate_measurements_v1_to_v2
+
+__CONFIG__ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'config.yaml')
+
+
+def replayed_results(probes: int) -> dict:
+    """
+    :param probes: Count of probes
+    :return: Results as loaded from JSON, not available frequency is null in probe 1
+    """
+    sequence = load_test_plan(__CONFIG__, None, '').readings_sequence()
+    results = {'TestID': "T1", 'TestTime': "2022-04-22 10:00:00", 'Device': {'name': "breaker"},
+               'ReadValuesTest': {str(probe): {key: dict(entry, reading=[1.0] * len(entry['value_name']))
+                                               for key, entry in sequence.items()} for probe in range(probes)}}
+    results['ReadValuesTest']['1']['frequency']['reading'] = [None]
+    return results
+
+
+def test_deadband_rows_with_null_readings():
+    results = replayed_results(5)
+    rows = [row for row in build_measurement_value_rows(results, True) if row[3] == 'frequency']
+    # Value becoming and stopping to be not available is stored, unchanged values are not
+    assert [(row[2], row[6]) for row in rows] == [(0, 1.0), (1, None), (2, 1.0)]
+    assert [row[6] for row in build_measurement_value_rows(results) if row[3] == 'frequency'] == \
+        [1.0, None, 1.0, 1.0, 1.0]
+
+
+def test_deadband_rows_max_silence():
+    results = replayed_results(5)
+    # Replayed results count one second per probe, every value is silent for max_silence
+    silent = [row for row in build_measurement_value_rows(results, True, 1.0) if row[3] == 'voltage']
+    assert len(silent) == 5 * len(results['ReadValuesTest']['0']['voltage']['value_name'])
+
+
+def test_migration_device_key_matches_script(tmp_path):
+    sequence = load_test_plan(__CONFIG__, None, '').readings_sequence()
+    connection = sqlite3.connect(str(tmp_path / "v1.db"))
+    columns = ", ".join(__DB_MEASUREMENT_COLUMNS__)
+    connection.executescript(
+        "CREATE TABLE device_remote_control_test (test_id, test_timestamp, device_id, device_status, "
+        "device_motor_status, unit_status, t_on_c_break, t_off_c_break, t_reset_c_break, test_score);"
+        "CREATE TABLE device_measurement_test (measurement_id, test_id, test_timestamp, probe_number, " + columns + ");"
+        "CREATE TABLE device_test (" + ", ".join(__DB_TEST_COLUMNS__) + ");"
+        "CREATE TABLE measurement_value (" + ", ".join(__DB_VALUE_COLUMNS__) + ");"
+        "CREATE TABLE device_map (device_id, device);")
+    identity = json.dumps(["ACME", "BRK-1"])
+    connection.executemany("INSERT INTO device_remote_control_test VALUES (?, '2022-04-22', ?, 1, 1, 1, 1, 1, 1, '')",
+                           [("T1", identity), ("T2", None)])
+    frequency = str([500] * len(sequence['frequency']['value_name']))
+    for test_id in ("T1", "T2"):
+        connection.execute("INSERT INTO device_measurement_test (measurement_id, test_id, test_timestamp, "
+                           "probe_number, frequency) VALUES (?, ?, '2022-04-22', 0, ?)",
+                           (test_id + "-0", test_id, frequency))
+    connection.execute("INSERT INTO device_map VALUES (?, '192.168.5.219')", (identity,))
+    with open(os.path.join(os.path.dirname(__CONFIG__), '..', 'db', 'migrate_v1_to_v2.sql'), encoding='utf-8') as file:
+        connection.executescript(file.read())
+    db_config = {'base_table': "device_remote_control_test", 'measurement_table': "device_measurement_test"}
+    migrate_measurements_v1_to_v2(db_config, sequence, "2022-01-01", DbConnectionPool(db_config, 1, lambda: connection),
+                                  "?")
+    tests = dict(connection.execute("SELECT test_id, device FROM device_test"))
+    values = set(connection.execute("SELECT test_id, device FROM measurement_value"))
+    connection.close()
+    # Tests without device_id or mapping get empty device in both paths
+    assert tests == {'T1': "192.168.5.219", 'T2': ""}
+    assert values == set(tests.items())
@@ -0,0 +1,20 @@
+"""
+Decoding of registers: not available values and register widths of data types
+"""
+import math
+import pytest
+from decoding import BlockDecoder
+
+
+def test_default_nan_value_only_for_int16():
+    assert math.isnan(BlockDecoder({'count': 1}).decode([0x8000])[0])
+    assert BlockDecoder({'count': 1, 'data_type': 'uint16'}).decode([0x8000]) == [32768]
+    assert BlockDecoder({'count': 2, 'data_type': 'uint32'}).decode([0, 0x8000]) == [32768]
+    # Explicit nan_value still applies to other types
+    assert math.isnan(BlockDecoder({'count': 1, 'data_type': 'uint16', 'nan_value': 0xffff}).decode([0xffff])[0])
+
+
+@pytest.mark.parametrize('data_type', ['int32', 'uint32', 'float32'])
+def test_count_must_cover_register_pairs(data_type):
+    with pytest.raises(ValueError, match="multiple of 2"):
+        BlockDecoder({'count': 3, 'data_type': data_type})
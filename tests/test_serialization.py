@@ -0,0 +1,27 @@
+"""
+Result file formats: readings not available (NaN) survive conversion between formats
+"""
+import math
+import os
+from test_plan import load_test_plan
+from serialization import load_binary, load_json, write_binary, write_json
+
+__CONFIG__ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'config.yaml')
+
+
+def test_json_nan_readings_round_trip_to_binary(tmp_path):
+    sequence = load_test_plan(__CONFIG__, None, '').readings_sequence()
+    results = {'TestID': "T1", 'TestTime': "2022-04-22 10:00:00",
+               'ReadValuesTest': {str(probe): {key: dict(entry, reading=[float(probe)] * len(entry['value_name']))
+                                               for key, entry in sequence.items()} for probe in range(3)}}
+    measurement_type = next(iter(sequence))
+    results['ReadValuesTest']['1'][measurement_type]['reading'][0] = math.nan
+    json_path, binary_path = str(tmp_path / "T1.json"), str(tmp_path / "T1.mbr")
+    write_json(results, json_path)
+    loaded = load_json(json_path)
+    assert math.isnan(loaded['ReadValuesTest']['1'][measurement_type]['reading'][0])
+    write_binary(loaded, binary_path)
+    probes = load_binary(binary_path)['ReadValuesTest']
+    reading = probes['1'][measurement_type]['reading']
+    assert math.isnan(reading[0]) and reading[1:] == [1.0] * (len(reading) - 1)
+    assert probes['2'][measurement_type]['reading'] == [2.0] * len(reading)
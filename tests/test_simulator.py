@@ -0,0 +1,198 @@
+"""
+Transports and test sequences against simulator.py served in-process (event loop in a background thread)
+"""
+import asyncio
+import os
+import threading
+from time import perf_counter
+import pytest
+import yaml
+import modbus_frames as frames
+from async_engine import AsyncGateway, AsyncModbusClient, __UNIT_FAILURES__
+from modbus_protocol import device_endurance_test
+from modbus_transport import ModbusTransport
+from serialization import load_delta
+from simulator import SimulatedDevice, SimulatedGateway, serve_device, simulator_settings
+from sinks import DeltaSink
+from test_plan import load_test_plan
+
+__CONFIG__ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'config.yaml')
+
+
+@pytest.fixture(name='config', scope='module')
+def fixture_config() -> dict:
+    """
+    :return: Shipped test configuration, simulated register map is built from it
+    """
+    with open(__CONFIG__, 'r', encoding='utf-8') as file:
+        return yaml.safe_load(file)
+
+
+@pytest.fixture(name='plan', scope='module')
+def fixture_plan():
+    """
+    :return: Compiled plan of the shipped configuration
+    """
+    return load_test_plan(__CONFIG__, None, '')
+
+
+@pytest.fixture(name='simulator')
+def fixture_simulator(config):
+    """
+    Starts simulated devices or gateways on free ports, servers are closed after the test
+    :return: Callable(**settings) returning (port, server)
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="simulator", daemon=True)
+    thread.start()
+    servers = []
+
+    def start(**overrides) -> tuple:
+        settings = simulator_settings(config, overrides)
+        if settings['gateway']:
+            device = SimulatedGateway(config, settings)
+        else:
+            device = SimulatedDevice(config, settings['identity'], settings['actuation_delay_ms'] / 1000,
+                                     settings['login_required'])
+        server = asyncio.run_coroutine_threadsafe(serve_device(device, '127.0.0.1', 0, settings), loop).result()
+        servers.append(server)
+        return server.sockets[0].getsockname()[1], server
+
+    async def stop() -> None:
+        for server in servers:
+            server.close()
+        # Connection handlers still waiting for requests
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    yield start
+    asyncio.run_coroutine_threadsafe(stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def test_reconnect_after_device_closes_connection(simulator, plan):
+    # Device closes connection after every third request
+    port, _ = simulator(max_requests=3)
+    block = plan.read_plan[0]
+    transport = ModbusTransport('127.0.0.1', port, timeout=1)
+    readings = [transport.read_holding_registers(block.address_dec, block.count) for _ in range(10)]
+    transport.close()
+    assert all(reading is not None and len(reading) == block.count for reading in readings)
+    assert transport.connects >= 4
+
+
+def test_async_reconnect_after_device_closes_connection(simulator, plan):
+    port, _ = simulator(max_requests=3)
+    block = plan.read_plan[0]
+
+    async def scenario() -> tuple:
+        client = AsyncModbusClient('127.0.0.1', port, timeout=1)
+        try:
+            assert await client.open()
+            readings = [await client.read_holding_registers(block.address_dec, block.count) for _ in range(10)]
+            # Concurrent requests fail over to one reopened connection
+            readings += await client.read_blocks([(block.address_dec, block.count)] * 4)
+            return readings, client.connects
+        finally:
+            await client.close()
+
+    start = perf_counter()
+    readings, connects = asyncio.run(scenario())
+    assert all(reading is not None and len(reading) == block.count for reading in readings)
+    assert connects >= 4
+    # Lost connection is detected, requests don't wait out their timeout
+    assert perf_counter() - start < 1
+
+
+def test_async_reconnect_backoff(simulator):
+    port, server = simulator()
+    server.close()
+
+    async def scenario() -> tuple:
+        client = AsyncModbusClient('127.0.0.1', port, timeout=0.5, attempts=3, backoff=0.05)
+        start = perf_counter()
+        opened = await client.open()
+        elapsed = perf_counter() - start
+        reading = await client.read_holding_registers(0, 1)
+        await client.close()
+        return opened, elapsed, reading
+
+    opened, elapsed, reading = asyncio.run(scenario())
+    assert not opened and reading is None
+    assert elapsed >= 0.05 + 0.1
+
+
+def test_reconnect_backoff(simulator):
+    port, server = simulator()
+    server.close()
+    transport = ModbusTransport('127.0.0.1', port, timeout=0.5, attempts=3, backoff=0.05)
+    start = perf_counter()
+    assert not transport.open()
+    # Two waits between three attempts, backoff doubles
+    assert perf_counter() - start >= 0.05 + 0.1
+    assert transport.read_holding_registers(0, 1) is None
+
+
+def test_pipelined_responses_matched_by_transaction_id(simulator, plan):
+    reference_port, _ = simulator()
+    # Random latency answers pipelined requests out of order
+    port, _ = simulator(latency_ms=40, jitter_ms=40)
+    block = plan.read_plan[0]
+    blocks = [(block.address_dec + offset, block.count - offset) for offset in range(min(block.count, 8))]
+    reference = ModbusTransport('127.0.0.1', reference_port)
+    expected = [reference.read_holding_registers(address, count) for address, count in blocks]
+    reference.close()
+    transport = ModbusTransport('127.0.0.1', port, depth=len(blocks))
+    start = perf_counter()
+    readings = transport.read_blocks(blocks)
+    elapsed = perf_counter() - start
+    transport.close()
+    assert readings == expected
+    # All requests were in flight together, sequential reads take at least 40 ms each
+    assert elapsed < 0.04 * len(blocks)
+
+
+def test_offline_gateway_unit_suspended(simulator, plan):
+    port, _ = simulator(gateway=True, offline_units=[9], latency_ms=5)
+    block = plan.read_plan[0]
+    pdu = frames.read_holding_registers_pdu(block.address_dec, block.count)
+
+    async def scenario() -> tuple:
+        gateway = AsyncGateway('127.0.0.1', port, timeout=0.2)
+        try:
+            for _ in range(__UNIT_FAILURES__):
+                with pytest.raises(asyncio.TimeoutError):
+                    await gateway.request(9, pdu)
+            start = perf_counter()
+            # Suspended unit fails without waiting for its timeout, other units are served
+            results = await asyncio.gather(gateway.request(9, pdu), *(gateway.request(unit, pdu) for unit in (1, 2)),
+                                           return_exceptions=True)
+            return results, perf_counter() - start
+        finally:
+            await gateway.close()
+
+    results, elapsed = asyncio.run(scenario())
+    assert isinstance(results[0], ConnectionError)
+    assert all(isinstance(response, bytes) for response in results[1:])
+    assert elapsed < 0.2
+
+
+def test_endurance_with_delta_sink(simulator, plan, tmp_path):
+    port, _ = simulator(actuation_delay_ms=0)
+    path = str(tmp_path / "endurance.mbd")
+    sink = DeltaSink(path)
+    sink.test("T1", "2022-04-22 10:00:00", plan.readings_sequence())
+    transport = ModbusTransport('127.0.0.1', port)
+    results = device_endurance_test(transport, plan, 2, sink)
+    transport.close()
+    sink.section("EnduranceTest", results)
+    sink.close()
+    loaded = load_delta(path)
+    assert loaded['EnduranceTest']['cycles'] == 2
+    assert sum(loaded['EnduranceTest']['failures'].values()) == 0
+    assert [event['name'] for event in loaded['Events']] == list(plan.endurance_commands) * 2
+    assert all(event['data']['status'] for event in loaded['Events'])
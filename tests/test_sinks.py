@@ -0,0 +1,103 @@
+"""
+Streaming sinks: .mbd checkpoints are appended, raw events and NDJSON logs stay valid
+"""
+import json
+import math
+import os
+import pytest
+from test_plan import load_test_plan
+from serialization import load_delta
+from sinks import DeltaSink, NdjsonSink, replay_results
+
+__CONFIG__ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'config.yaml')
+
+
+@pytest.fixture(name='sequence')
+def fixture_sequence() -> dict:
+    """
+    :return: test_readings_sequence of the shipped config
+    """
+    return load_test_plan(__CONFIG__, None, '').readings_sequence()
+
+
+def readings(sequence: dict, probe: int) -> dict:
+    """
+    :param sequence: test_readings_sequence
+    :param probe: Probe number, values change every other probe
+    :return: {measurement_type: reading}
+    """
+    return {key: [float(probe // 2 * 10 + index) for index in range(len(entry['value_name']))]
+            for key, entry in sequence.items()}
+
+
+def test_endurance_events_in_delta_sink(tmp_path, sequence):
+    path = str(tmp_path / "endurance.mbd")
+    sink = DeltaSink(path)
+    sink.test("T1", "2022-04-22 10:00:00", sequence)
+    for cycle in range(3):
+        sink.event('t_off_c_break', {'status': 1, 'latency_ms': 80.0 + cycle}, 100.0 + cycle)
+        # Samples of keys outside test_readings_sequence are kept as raw records too
+        sink.sample('t_on_c_break', [1, 75.0], 100.5 + cycle)
+    sink.section('EnduranceTest', {'cycles': 3})
+    sink.close()
+    results = load_delta(path)
+    assert results['EnduranceTest'] == {'cycles': 3}
+    assert [event['name'] for event in results['Events']] == ['t_off_c_break', 't_on_c_break'] * 3
+    assert results['Events'][0]['data'] == {'status': 1, 'latency_ms': 80.0}
+
+
+def test_delta_checkpoints_append(tmp_path, sequence):
+    appended, single = str(tmp_path / "appended.mbd"), str(tmp_path / "single.mbd")
+    sinks = [DeltaSink(appended, checkpoint_interval=0), DeltaSink(single, checkpoint_interval=3600)]
+    for sink in sinks:
+        sink.test("T1", "2022-04-22 10:00:00", sequence)
+    previous = b''
+    for probe in range(20):
+        for sink in sinks:
+            sink.probe(probe, 100.0 + probe * 0.5, readings(sequence, probe))
+        with open(appended, 'rb') as file:
+            content = file.read()
+        # Checkpoint only appends, data written before is never rewritten
+        assert content.startswith(previous) and len(content) > len(previous)
+        previous = content
+    for sink in sinks:
+        sink.close()
+    first, second = load_delta(appended), load_delta(single)
+    assert len(first['ReadValuesTest']) == 20
+    assert first['ReadValuesTest'] == second['ReadValuesTest']
+    assert first['ReadValuesTest']['19']['frequency']['reading'] == [90.0]
+
+
+def test_truncated_delta_file(tmp_path, sequence):
+    path = str(tmp_path / "monitor.mbd")
+    sink = DeltaSink(path, checkpoint_interval=0)
+    sink.test("T1", "2022-04-22 10:00:00", sequence)
+    for sample in range(10):
+        sink.sample('frequency', [50.0 + sample], 100.0 + sample)
+    sink.close()
+    with open(path, 'rb') as file:
+        content = file.read()
+    # Interrupted write of the last checkpoint
+    with open(path, 'wb') as file:
+        file.write(content[:-3])
+    series = load_delta(path)['Series']['frequency']
+    assert 0 < len(series['timestamps']) < 10
+    assert series['values']['F'][:3] == [50.0, 51.0, 52.0]
+
+
+def test_ndjson_nan_and_replayed_times(tmp_path, sequence):
+    path = str(tmp_path / "stream.ndjson")
+    sink = NdjsonSink(path)
+    sink.test("T1", "2022-04-22 10:00:00", sequence)
+    for probe in range(3):
+        values = readings(sequence, probe)
+        values['frequency'] = [math.nan]
+        sink.probe(probe, 100.0 + probe, values)
+    sink.close()
+    with open(path, 'r', encoding='utf-8') as file:
+        records = [json.loads(line) for line in file]
+    assert records[1]['readings']['frequency'] == [None]
+    results = replay_results(path)
+    probes = results['ReadValuesTest']
+    assert math.isnan(probes['2']['frequency']['reading'][0])
+    assert probes.wall_time(2) - probes.wall_time(0) == pytest.approx(2.0)
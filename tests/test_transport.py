@@ -0,0 +1,60 @@
+"""
+ModbusTransport framing against scripted gateway answering the first request with a frame cut off by a stall
+"""
+import socket
+import threading
+from time import sleep
+import modbus_frames as frames
+from modbus_transport import ModbusTransport
+
+
+def serve_stalling_gateway(server: socket.socket, stall: float) -> None:
+    """
+    Answers FC3 requests with registers [unit ID] * count, first response stalls after its MBAP header
+    :param server: Listening socket
+    :param stall: Seconds before rest of the first response is sent
+    :return: None
+    """
+    first = True
+    while True:
+        try:
+            connection, _ = server.accept()
+        except OSError:
+            return
+        with connection:
+            try:
+                while True:
+                    header = connection.recv(frames.__MBAP_HEADER_SIZE__, socket.MSG_WAITALL)
+                    if len(header) < frames.__MBAP_HEADER_SIZE__:
+                        break
+                    transaction_id, unit_id, length = frames.decode_header(header)
+                    count = int.from_bytes(connection.recv(length, socket.MSG_WAITALL)[3:5], 'big')
+                    pdu = bytes([3, count * 2]) + b''.join(unit_id.to_bytes(2, 'big') for _ in range(count))
+                    frame = frames.encode_frame(transaction_id, unit_id, pdu)
+                    if first:
+                        first = False
+                        connection.sendall(frame[:frames.__MBAP_HEADER_SIZE__])
+                        sleep(stall)
+                        connection.sendall(frame[frames.__MBAP_HEADER_SIZE__:])
+                    else:
+                        connection.sendall(frame)
+            except OSError:
+                continue
+
+
+def test_shared_connection_reopened_after_partial_frame():
+    server = socket.create_server(('127.0.0.1', 0))
+    thread = threading.Thread(target=serve_stalling_gateway, args=(server, 0.3), daemon=True)
+    thread.start()
+    gateway = ModbusTransport('127.0.0.1', server.getsockname()[1], unit_id=1, timeout=0.1)
+    unit = gateway.unit(2)
+    try:
+        assert gateway.read_holding_registers(0, 4) is None
+        # Rest of the cut off frame must not be parsed as response of the next unit
+        sleep(0.3)
+        assert unit.read_holding_registers(0, 4) == [2] * 4
+        assert gateway.read_holding_registers(0, 2) == [1] * 2
+        assert gateway.connects == 2
+    finally:
+        gateway.close()
+        server.close()